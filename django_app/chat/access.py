@@ -0,0 +1,222 @@
+"""
+Cached authorization of WebSocket connections to conversations.
+
+A user may open a conversation's socket when they own it or it is shared.
+authorize() looks the decision up in a small in-process LRU, then in a
+Redis hash per conversation (``chat:access:<conversation_id>``, one field
+per user), and only then loads the conversation row, which the consumer
+keeps for the rest of the connection. A reconnect storm after a deploy is
+answered from Redis instead of the database.
+
+invalidate_access() runs when a conversation is deleted or its sharing or
+owner changes (see signals). It bumps the conversation's generation
+(``chat:access:gen:<conversation_id>`` in Redis, and a counter for all
+conversations in this process) and deletes the Redis hash and this process's entries; other
+processes may keep a decision for up to ACCESS_CACHE_LOCAL_TTL seconds.
+authorize() reads the generation before loading the row and only stores
+its decision if no invalidation ran in between, so a decision made from a
+row loaded before the change is never written back.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from redis.exceptions import WatchError
+
+from .counters import get_async_redis, get_redis
+from .models import Conversation
+
+logger = logging.getLogger('chat')
+
+KEY_PREFIX = 'chat:access:'
+GENERATION_PREFIX = 'chat:access:gen:'
+
+DENY = {'allowed': False, 'owner': False}
+
+_lock = threading.Lock()
+_local = OrderedDict()
+_generation = 0
+_stats = {'local_hits': 0, 'redis_hits': 0, 'misses': 0, 'denied': 0, 'stale': 0}
+
+
+def _access_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return {
+        'local_ttl': chat_settings.get('ACCESS_CACHE_LOCAL_TTL', 15),
+        'ttl': chat_settings.get('ACCESS_CACHE_TTL', 300),
+        'max_entries': chat_settings.get('ACCESS_CACHE_MAX_ENTRIES', 10000),
+    }
+
+
+def _count(stat):
+    with _lock:
+        _stats[stat] += 1
+
+
+def access_key(conversation_id):
+    return f"{KEY_PREFIX}{conversation_id}"
+
+
+def generation_key(conversation_id):
+    return f"{GENERATION_PREFIX}{conversation_id}"
+
+
+def decide(conversation, user_id):
+    """Allow/deny decision of a user on a conversation row (None when it does not exist)"""
+    if conversation is None:
+        return dict(DENY)
+    owner = conversation.user_id == str(user_id)
+    return {'allowed': owner or conversation.is_shared, 'owner': owner}
+
+
+def _encode(decision):
+    return f"{int(decision['allowed'])}{int(decision['owner'])}"
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return {'allowed': value[0] == '1', 'owner': value[1] == '1'}
+
+
+def _local_get(key, now):
+    with _lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        decision, expires = entry
+        if expires <= now:
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        return decision
+
+
+def _local_set(key, decision, now, options, generation):
+    with _lock:
+        if generation != _generation:
+            # Invalidated while the row was loading
+            return
+        _local[key] = (decision, now + options['local_ttl'])
+        _local.move_to_end(key)
+        while len(_local) > options['max_entries']:
+            _local.popitem(last=False)
+
+
+@database_sync_to_async
+def _load(conversation_id):
+    try:
+        return Conversation.objects.filter(pk=conversation_id).first()
+    except ValidationError:
+        # Not a UUID
+        return None
+
+
+async def authorize(user_id, conversation_id):
+    """
+    (decision, conversation) for a user opening a conversation's socket.
+
+    The conversation row is only loaded when no cached decision exists; it
+    is None otherwise.
+    """
+    options = _access_settings()
+    key = (str(user_id), str(conversation_id))
+    now = time.monotonic()
+
+    local_generation = _generation
+    decision = _local_get(key, now)
+    if decision is not None:
+        _count('local_hits')
+        return decision, None
+
+    client = get_async_redis()
+    if client is not None:
+        try:
+            value = await client.hget(access_key(conversation_id), key[0])
+        except Exception as e:
+            logger.warning(f"Access cache lookup failed for {conversation_id}: {str(e)}")
+            value = None
+        if value is not None:
+            decision = _decode(value)
+            _count('redis_hits')
+            _local_set(key, decision, now, options, _generation)
+            return decision, None
+
+    _count('misses')
+    generation = None
+    if client is not None:
+        try:
+            generation = await client.get(generation_key(conversation_id))
+        except Exception as e:
+            logger.warning(f"Access cache generation lookup failed for {conversation_id}: {str(e)}")
+            client = None
+    conversation = await _load(conversation_id)
+    decision = decide(conversation, user_id)
+    if not decision['allowed']:
+        _count('denied')
+    _local_set(key, decision, now, options, local_generation)
+    if client is not None:
+        await _store(client, conversation_id, key[0], decision, generation, options)
+    return decision, conversation
+
+
+async def _store(client, conversation_id, user_id, decision, generation, options):
+    """Cache a decision unless the conversation was invalidated since `generation` was read"""
+    try:
+        async with client.pipeline(transaction=True) as pipe:
+            await pipe.watch(generation_key(conversation_id))
+            if await pipe.get(generation_key(conversation_id)) != generation:
+                _count('stale')
+                return
+            pipe.multi()
+            pipe.hset(access_key(conversation_id), user_id, _encode(decision))
+            pipe.expire(access_key(conversation_id), options['ttl'])
+            await pipe.execute()
+    except WatchError:
+        _count('stale')
+    except Exception as e:
+        logger.warning(f"Access cache store failed for {conversation_id}: {str(e)}")
+
+
+def invalidate_access(conversation_id):
+    """Forget every cached decision on a conversation; never raises"""
+    global _generation
+    conversation_id = str(conversation_id)
+    with _lock:
+        _generation += 1
+        for key in [key for key in _local if key[1] == conversation_id]:
+            del _local[key]
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.incr(generation_key(conversation_id))
+        pipe.expire(generation_key(conversation_id), _access_settings()['ttl'])
+        pipe.delete(access_key(conversation_id))
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Access cache invalidation failed for {conversation_id}: {str(e)}")
+
+
+def get_access_stats():
+    """Where WebSocket authorizations were answered from, in this process"""
+    with _lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_local)
+    lookups = stats['local_hits'] + stats['redis_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['local_hits'] + stats['redis_hits']) / lookups if lookups else 0.0
+    return stats
+
+
+def reset_access_cache():
+    with _lock:
+        _local.clear()
+        for name in _stats:
+            _stats[name] = 0
@@ -57,7 +57,7 @@ class FileUploadInline(admin.TabularInline):
 class MessageAdmin(admin.ModelAdmin):
     list_display = ['conversation_title', 'role', 'content_preview', 'model', 'token_count', 'created_at']
     list_filter = ['role', 'model', 'created_at']
-    search_fields = ['content', 'conversation__title', 'conversation__user_id']
+    search_fields = ['conversation__title', 'conversation__user_id']
     readonly_fields = ['id', 'created_at', 'token_count', 'conversation_link']
     inlines = [FileUploadInline]
     
@@ -103,7 +103,7 @@ class MessageAdmin(admin.ModelAdmin):
 class FileUploadAdmin(admin.ModelAdmin):
     list_display = ['original_filename', 'content_type', 'file_size_display', 'message_preview', 'created_at']
     list_filter = ['content_type', 'created_at']
-    search_fields = ['original_filename', 'message__content', 'message__conversation__title']
+    search_fields = ['original_filename', 'message__conversation__title']
     readonly_fields = ['created_at', 'file_size_display', 'message_link']
     
     def file_size_display(self, obj):
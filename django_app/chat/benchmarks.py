@@ -0,0 +1,600 @@
+"""
+Benchmarks for chat hot paths.
+
+Scenarios are registered with @scenario and run through
+``python manage.py benchmark <name>``, which executes them against a
+throwaway test database.
+"""
+
+import asyncio
+import json
+import pickle
+import threading
+import time
+import tracemalloc
+
+import openai
+
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import AsyncClient
+from django.test.utils import override_settings
+
+from . import llm_clients as client_pool
+from . import wire
+from .coalescing import get_coalescing_stats, reset_coalescing_stats
+from .broadcast import get_broadcast_stats, reset_broadcast_stats
+from .completion_cache import get_completion_cache_stats, reset_completion_cache_stats
+from .encryption import get_key_ring
+from .fake_provider import FakeProvider
+from .models import Conversation, Message
+from .pagination import FORWARD, encode_cursor, paginate_messages
+from .tasks import process_ai_chat_request
+
+SCENARIOS = {}
+
+MODELS = ['openai/gpt-4o-mini', 'anthropic/claude-3.5-sonnet', 'google/gemini-flash-1.5']
+
+
+def scenario(name, help_text=''):
+    """Register a benchmark scenario"""
+    def register(func):
+        func.help_text = help_text or (func.__doc__ or '').strip()
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+class Report:
+    """
+    Collects timing rows and prints them as an aligned table
+    """
+
+    def __init__(self, stdout, title):
+        self.stdout = stdout
+        self.title = title
+        self.rows = []
+
+    def add(self, label, **values):
+        self.rows.append((label, values))
+
+    def render(self):
+        self.stdout.write(f"\n{self.title}")
+        self.stdout.write('-' * len(self.title))
+        columns = []
+        for _, values in self.rows:
+            for key in values:
+                if key not in columns:
+                    columns.append(key)
+        width = max([len(label) for label, _ in self.rows] + [5]) + 2
+        widths = [max(16, len(column) + 2) for column in columns]
+        self.stdout.write('path'.ljust(width) + ''.join(c.rjust(w) for c, w in zip(columns, widths)))
+        for label, values in self.rows:
+            cells = []
+            for column, column_width in zip(columns, widths):
+                value = values.get(column, '')
+                if isinstance(value, float):
+                    value = f"{value:.2f}"
+                cells.append(str(value).rjust(column_width))
+            self.stdout.write(label.ljust(width) + ''.join(cells))
+
+
+def timed(func, repeat=1):
+    """Run func `repeat` times and return (best milliseconds, last result)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def seed_conversation(message_count, user_id='benchmark', body_size=400):
+    """Create one conversation with `message_count` alternating messages"""
+    conversation = Conversation.objects.create(user_id=user_id, title='Benchmark conversation')
+    body = ('The quick brown fox jumps over the lazy dog. ' * (body_size // 45 + 1))[:body_size]
+    batch = []
+    for index in range(message_count):
+        role = 'user' if index % 2 == 0 else 'assistant'
+        batch.append(Message(
+            conversation=conversation,
+            role=role,
+            content=f"{index}: {body}",
+            model=MODELS[index % len(MODELS)] if role == 'assistant' else None,
+            token_count=len(body) // 4,
+        ))
+        if len(batch) >= 1000:
+            Message.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Message.objects.bulk_create(batch)
+    Conversation.objects.filter(pk=conversation.pk).update(message_count=message_count)
+    return conversation
+
+
+def crypto_cost(func, repeat):
+    """Best time for func plus the number of decryptions a single run performs"""
+    key_ring = get_key_ring()
+    elapsed, _ = timed(func, repeat)
+    key_ring.reset_stats()
+    func()
+    return elapsed, key_ring.get_stats()['decrypt_count']
+
+
+@scenario('lazy_decrypt', 'Crypto work done by analytics and listing paths with lazy decryption')
+def lazy_decrypt(stdout, messages=1000, repeat=5, **options):
+    conversation = seed_conversation(messages)
+
+    def analytics_model_usage(eager=False):
+        # Mirrors ConversationViewSet.analytics
+        usage = {}
+        for message in conversation.messages.filter(model__isnull=False, is_deleted=False):
+            if eager:
+                message.content
+            entry = usage.setdefault(message.model, {'count': 0, 'tokens': 0})
+            entry['count'] += 1
+            entry['tokens'] += message.token_count
+        return usage
+
+    def analytics_report(eager=False):
+        # Mirrors chat.tasks.generate_analytics_report
+        usage = {}
+        for message in Message.objects.filter(model__isnull=False, is_deleted=False):
+            if eager:
+                message.content
+            usage[message.model] = usage.get(message.model, 0) + 1
+        return usage
+
+    def admin_listing(eager=False):
+        # Mirrors ConversationAdmin: prefetches messages only to count them
+        total = 0
+        for item in Conversation.objects.prefetch_related('messages'):
+            prefetched = list(item.messages.all())
+            if eager:
+                for message in prefetched:
+                    message.content
+            total += len(prefetched)
+        return total
+
+    def history(eager=False):
+        # Reads every body, so lazy and eager do the same crypto work
+        return [message.content for message in conversation.messages.order_by('created_at')]
+
+    report = Report(stdout, f"Lazy decryption, {messages} messages (best of {repeat})")
+    for label, path in [
+        ('analytics model_usage', analytics_model_usage),
+        ('generate_analytics_report', analytics_report),
+        ('admin conversation list', admin_listing),
+        ('full history read', history),
+    ]:
+        eager_ms, eager_decrypts = crypto_cost(lambda: path(eager=True), repeat)
+        lazy_ms, lazy_decrypts = crypto_cost(lambda: path(eager=False), repeat)
+        report.add(
+            label,
+            eager_ms=eager_ms,
+            lazy_ms=lazy_ms,
+            eager_decrypts=eager_decrypts,
+            lazy_decrypts=lazy_decrypts,
+        )
+    report.render()
+
+
+@scenario('bulk_decrypt', 'Row-by-row versus batched decryption of a history page')
+def bulk_decrypt(stdout, messages=1000, repeat=5, **options):
+    conversation = seed_conversation(messages)
+    page = conversation.messages.order_by('created_at')
+
+    def row_by_row():
+        return [message.content for message in page.all()]
+
+    def batched():
+        return [message.content for message in page.all().decrypted()]
+
+    report = Report(stdout, f"History page of {messages} messages (best of {repeat})")
+    for label, path in [('row by row', row_by_row), ('decrypted() batch', batched)]:
+        elapsed, _ = timed(path, repeat)
+        report.add(label, ms=elapsed, per_message_us=elapsed * 1000 / max(messages, 1))
+    report.render()
+
+
+@scenario('storage_size', 'Stored bytes and crypto time of the legacy text format versus the binary envelope')
+def storage_size(stdout, messages=1000, repeat=5, **options):
+    key_ring = get_key_ring()
+    filler = 'The quick brown fox jumps over the lazy dog. '
+    report = Report(stdout, f"Storage per message, {messages} bodies per size (best of {repeat})")
+    for size in (80, 400, 2000, 8000):
+        bodies = [f"{index}: {filler * (size // len(filler) + 1)}"[:size] for index in range(messages)]
+        legacy_ms, legacy = timed(lambda: [key_ring.encrypt(body) for body in bodies], repeat)
+        envelope_ms, envelopes = timed(lambda: [key_ring.seal(body) for body in bodies], repeat)
+        legacy_read_ms, _ = timed(lambda: [key_ring.decrypt(value) for value in legacy], repeat)
+        envelope_read_ms, _ = timed(lambda: [key_ring.open(value) for value in envelopes], repeat)
+        legacy_bytes = sum(len(value.encode()) for value in legacy) / messages
+        envelope_bytes = sum(len(value) for value in envelopes) / messages
+        report.add(
+            f"{size} chars",
+            legacy_bytes=legacy_bytes,
+            envelope_bytes=envelope_bytes,
+            saved_pct=100 * (1 - envelope_bytes / legacy_bytes),
+            legacy_write_ms=legacy_ms,
+            envelope_write_ms=envelope_ms,
+            legacy_read_ms=legacy_read_ms,
+            envelope_read_ms=envelope_read_ms,
+        )
+    report.render()
+
+
+@scenario('deep_pages', 'Offset versus keyset pagination at increasing page depth')
+def deep_pages(stdout, messages=100000, repeat=5, page_size=50, **options):
+    conversation = seed_conversation(messages, body_size=80)
+    history = Message.objects.filter(conversation=conversation, is_deleted=False)
+    last_page = max(messages // page_size, 1)
+    depths = sorted(depth for depth in {1, 10, 100, last_page // 2, last_page} if 1 <= depth <= last_page)
+
+    # The cursor that opens page N points at the last row of page N-1
+    cursors = {1: None}
+    for page in depths[1:]:
+        boundary = history.order_by('created_at', 'id')[(page - 1) * page_size - 1]
+        cursors[page] = encode_cursor(boundary, FORWARD)
+
+    report = Report(stdout, f"Page of {page_size} from {messages} messages (best of {repeat})")
+    for page in depths:
+        offset = (page - 1) * page_size
+        offset_ms, _ = timed(
+            lambda: history.order_by('created_at')[offset:offset + page_size].decrypted(), repeat
+        )
+        keyset_ms, _ = timed(
+            lambda: paginate_messages(history, cursor=cursors[page], page_size=page_size), repeat
+        )
+        report.add(f"page {page}", offset_ms=offset_ms, keyset_ms=keyset_ms)
+    report.render()
+
+
+@scenario('conversation_list', 'Cached sidebar: prefetched model graph versus summary rows')
+def conversation_list(stdout, messages=2000, repeat=5, conversations=50, **options):
+    for _ in range(conversations):
+        seed_conversation(messages // conversations, user_id='sidebar')
+    def model_graph():
+        # The previous get_user_conversations: instances plus every message
+        return list(
+            Conversation.objects.filter(user_id='sidebar')
+            .prefetch_related('messages')
+            .order_by('-updated_at')[:conversations]
+        )
+
+    def summary_rows():
+        return Conversation.objects.build_summaries(
+            Conversation.objects.filter(user_id='sidebar').order_by('-last_activity')[:conversations]
+        )
+
+    def peak_kib(func):
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak / 1024
+
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+        cache.clear()
+        cached_ms, _ = timed(
+            lambda: Conversation.objects.get_user_conversations('sidebar', limit=conversations), repeat
+        )
+
+    report = Report(stdout, f"{conversations} conversations, {messages} messages (best of {repeat})")
+    graph_ms, graph = timed(model_graph, repeat)
+    rows_ms, rows = timed(summary_rows, repeat)
+    report.add(
+        'prefetched model graph',
+        build_ms=graph_ms,
+        peak_kib=peak_kib(model_graph),
+        cached_kib=len(pickle.dumps(graph)) / 1024,
+    )
+    report.add(
+        'summary rows',
+        build_ms=rows_ms,
+        peak_kib=peak_kib(summary_rows),
+        cached_kib=len(json.dumps(rows)) / 1024,
+        cache_hit_ms=cached_ms,
+    )
+    report.render()
+
+
+async def run_sse_streams(user, conversations, body):
+    """
+    POST one stream per conversation to the async SSE view at once.
+
+    Returns (wall seconds, [(first token seconds, frames, bytes)], peak threads).
+    """
+    async def one_stream(client, conversation, started):
+        response = await client.post(
+            '/api/chat/stream/',
+            data=dict(body, conversation_id=str(conversation.id)),
+            content_type='application/json',
+        )
+        first_token = None
+        frames = 0
+        size = 0
+        async for frame in response.streaming_content:
+            if first_token is None and b'"content"' in frame:
+                first_token = time.perf_counter() - started
+            frames += 1
+            size += len(frame)
+        return first_token, frames, size
+
+    client = AsyncClient()
+    await client.aforce_login(user)
+    peak_threads = threading.active_count()
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(one_stream(client, c, started)) for c in conversations]
+    while not all(task.done() for task in tasks):
+        peak_threads = max(peak_threads, threading.active_count())
+        await asyncio.sleep(0.01)
+    return time.perf_counter() - started, [task.result() for task in tasks], peak_threads
+
+
+@scenario('sse_concurrency', 'Concurrent async SSE chat streams against a local fake provider (--messages = streams)')
+def sse_concurrency(stdout, messages=500, repeat=1, chunks=20, delay=0.05, **options):
+    streams = messages
+    user = User.objects.create_user(username='sse-benchmark')
+    conversations = [Conversation(user_id=str(user.id), title='Benchmark stream') for _ in range(streams)]
+    Conversation.objects.bulk_create(conversations)
+    body = {'message': 'Hello', 'model': 'fake/model', 'api_key': 'benchmark'}
+
+    with FakeProvider(chunks=chunks, delay=delay) as provider, override_settings(
+        OPENROUTER_BASE_URL=provider.base_url,
+        RATELIMIT_ENABLE=False,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    ):
+        baseline_threads = threading.active_count()
+        elapsed, results, peak_threads = asyncio.run(run_sse_streams(user, conversations, body))
+
+    first_tokens = sorted(result[0] for result in results if result[0] is not None)
+    completed = sum(1 for result in results if result[0] is not None)
+    percentile = lambda p: first_tokens[min(len(first_tokens) - 1, int(len(first_tokens) * p))] * 1000 if first_tokens else 0.0
+
+    report = Report(stdout, f"{streams} simultaneous streams, {chunks} chunks every {delay * 1000:.0f} ms")
+    report.add(
+        'async SSE view',
+        completed=completed,
+        wall_s=elapsed,
+        single_stream_s=chunks * delay,
+        peak_upstream=provider.peak,
+        ttft_p50_ms=percentile(0.5),
+        ttft_p95_ms=percentile(0.95),
+        extra_threads=peak_threads - baseline_threads,
+    )
+    report.render()
+
+
+@scenario('delta_coalescing', 'SSE frames and CPU per reply with and without delta coalescing (--messages = streams)')
+def delta_coalescing(stdout, messages=50, repeat=1, chunks=400, delay=0.002, **options):
+    streams = messages
+    user = User.objects.create_user(username='coalescing-benchmark')
+    body = {'message': 'Hello', 'model': 'fake/model', 'api_key': 'benchmark'}
+    report = Report(stdout, f"{streams} simultaneous streams, {chunks} one-token chunks every {delay * 1000:.0f} ms")
+
+    with FakeProvider(chunks=chunks, delay=delay, text='tok ') as provider:
+        for label, window in (('frame per delta', 0), ('coalesced 30 ms / 512 B', 30)):
+            conversations = [Conversation(user_id=str(user.id), title='Benchmark stream') for _ in range(streams)]
+            Conversation.objects.bulk_create(conversations)
+            chat_settings = dict(getattr(settings, 'CHAT_SETTINGS', {}), STREAM_COALESCE_WINDOW_MS=window)
+            with override_settings(
+                OPENROUTER_BASE_URL=provider.base_url,
+                RATELIMIT_ENABLE=False,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                CHAT_SETTINGS=chat_settings,
+            ):
+                reset_coalescing_stats()
+                cpu_started = time.process_time()
+                elapsed, results, _ = asyncio.run(run_sse_streams(user, conversations, body))
+                cpu = time.process_time() - cpu_started
+            stats = get_coalescing_stats()
+            report.add(
+                label,
+                frames_per_reply=sum(result[1] for result in results) / streams,
+                bytes_per_frame=stats['bytes_per_frame'],
+                sse_bytes=sum(result[2] for result in results),
+                ttft_p50_ms=sorted(result[0] for result in results)[streams // 2] * 1000,
+                cpu_s=cpu,
+                wall_s=elapsed,
+            )
+    report.render()
+
+
+@scenario('completion_cache', 'Identical deterministic SSE requests with and without the completion cache (--messages = streams)')
+def completion_cache(stdout, messages=200, repeat=1, chunks=50, delay=0.02, **options):
+    streams = messages
+    user = User.objects.create_user(username='completion-cache-benchmark')
+    body = {'message': 'Hello', 'model': 'fake/model', 'api_key': 'benchmark', 'temperature': 0}
+    report = Report(stdout, f"1 request, then {streams} identical ones at once; {chunks} chunks every {delay * 1000:.0f} ms")
+
+    for label, enabled in (('cache off', False), ('cache on', True)):
+        chat_settings = dict(getattr(settings, 'CHAT_SETTINGS', {}), COMPLETION_CACHE_ENABLED=enabled)
+        with FakeProvider(chunks=chunks, delay=delay) as provider, override_settings(
+            OPENROUTER_BASE_URL=provider.base_url,
+            RATELIMIT_ENABLE=False,
+            # Room for every stream's keys, so culling does not drop cached replies
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'OPTIONS': {'MAX_ENTRIES': 100000},
+            }},
+            CHAT_SETTINGS=chat_settings,
+        ):
+            cache.clear()
+            reset_completion_cache_stats()
+            conversations = [Conversation(user_id=str(user.id), title='Benchmark stream') for _ in range(streams + 1)]
+            Conversation.objects.bulk_create(conversations)
+            asyncio.run(run_sse_streams(user, conversations[:1], body))
+            elapsed, results, _ = asyncio.run(run_sse_streams(user, conversations[1:], body))
+            stats = get_completion_cache_stats()
+        first_tokens = sorted(result[0] for result in results if result[0] is not None)
+        report.add(
+            label,
+            upstream_calls=provider.requests,
+            hit_rate=stats['hit_rate'],
+            wall_s=elapsed,
+            ttft_p50_ms=first_tokens[len(first_tokens) // 2] * 1000 if first_tokens else 0.0,
+            frames_per_reply=sum(result[1] for result in results) / streams,
+        )
+    report.render()
+
+
+class TimingChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory channel layer that records when each reply event is published
+    """
+
+    published = []
+
+    async def group_send(self, group, message):
+        TimingChannelLayer.published.append((time.perf_counter(), message.get('payload', {}).get('type')))
+        await super().group_send(group, message)
+
+
+@scenario('ws_delivery', 'First content a WebSocket client sees from a Celery-generated reply (--messages = replies)')
+def ws_delivery(stdout, messages=10, repeat=1, chunks=50, delay=0.02, **options):
+    replies = messages
+    report = Report(stdout, f"{replies} worker replies, {chunks} chunks every {delay * 1000:.0f} ms")
+    conversations = [Conversation(user_id='ws-benchmark', title='Benchmark reply') for _ in range(replies)]
+    Conversation.objects.bulk_create(conversations)
+
+    with FakeProvider(chunks=chunks, delay=delay) as provider, override_settings(
+        OPENROUTER_BASE_URL=provider.base_url,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        CHANNEL_LAYERS={'default': {'BACKEND': 'chat.benchmarks.TimingChannelLayer'}},
+    ):
+        reset_broadcast_stats()
+        first_chunk = []
+        finished = []
+        for conversation in conversations:
+            TimingChannelLayer.published.clear()
+            started = time.perf_counter()
+            process_ai_chat_request.run(str(conversation.id), 'Hello', 'fake/model', 'benchmark', 'ws-benchmark')
+            finished.append(time.perf_counter() - started)
+            first_chunk.append(next(
+                at for at, kind in TimingChannelLayer.published if kind == 'message_chunk'
+            ) - started)
+        stats = get_broadcast_stats()
+
+    median = lambda values: sorted(values)[len(values) // 2] * 1000
+    # Before: the reply reached the client through task_status once the task finished
+    report.add('reply on completion', first_content_p50_ms=median(finished), frames_per_reply=0.0)
+    report.add(
+        'pushed frames',
+        first_content_p50_ms=median(first_chunk),
+        frames_per_reply=stats['frames_per_reply'],
+        dropped=stats['dropped'],
+    )
+    report.render()
+
+
+def cpu_seconds(func, repeat):
+    """Best process CPU seconds of func over `repeat` runs"""
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        func()
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@scenario('ws_encoding', 'CPU and bytes per WebSocket message: JSON versus MessagePack, per recipient versus shared frames')
+def ws_encoding(stdout, messages=500, repeat=5, recipients=20, chunks=400, **options):
+    if wire.msgpack is None:
+        stdout.write('msgpack is not installed')
+        return
+    message_id = '8d3f5c2e-4b1a-4f7e-9c0d-2a6b8e1f3c5d'
+    stream = [
+        {'type': 'message_chunk', 'message_id': message_id, 'event_id': f'1718000000000-{index}',
+         'content': 'token ' * (3 + index % 5)}
+        for index in range(chunks)
+    ]
+    conversation = seed_conversation(messages)
+    history = {
+        'type': 'conversation_history',
+        'conversation_id': str(conversation.id),
+        'messages': [
+            {
+                'id': str(message.id),
+                'role': message.role,
+                'content': message.content,
+                'model': message.model,
+                'timestamp': message.created_at.isoformat(),
+                'metadata': message.metadata,
+            }
+            for message in Message.objects.filter(conversation=conversation).order_by('created_at').decrypted()
+        ],
+    }
+    report = Report(stdout, f"{chunks} stream chunks sent to {recipients} sockets; history replay of {messages} messages")
+
+    for codec in (wire.JSON, wire.MSGPACK):
+        def per_recipient():
+            for payload in stream:
+                for _ in range(recipients):
+                    wire.encode(payload, codec)
+
+        def shared():
+            for payload in stream:
+                wire.encode(payload, codec)
+
+        size = sum(len(wire.encode(payload, codec)) for payload in stream)
+        deliveries = chunks * recipients
+        if codec == wire.JSON:
+            report.add(
+                'chunks, json per recipient',
+                cpu_us_per_msg=cpu_seconds(per_recipient, repeat) * 1e6 / deliveries,
+                bytes_per_msg=size / chunks,
+            )
+        report.add(
+            f'chunks, {codec} shared',
+            cpu_us_per_msg=cpu_seconds(shared, repeat) * 1e6 / deliveries,
+            bytes_per_msg=size / chunks,
+        )
+
+    for codec in (wire.JSON, wire.MSGPACK):
+        report.add(
+            f'history, {codec}',
+            cpu_us_per_msg=cpu_seconds(lambda: wire.encode(history, codec), repeat) * 1e6 / messages,
+            bytes_per_msg=len(wire.encode(history, codec)) / messages,
+        )
+    wire.reset_wire_stats()
+    report.render()
+
+
+@scenario('llm_clients', 'Per-request upstream clients versus the pooled keep-alive client (--messages = requests)')
+def llm_clients(stdout, messages=200, repeat=1, **options):
+    requests = messages
+    history = [{'role': 'user', 'content': 'Hello'}]
+    report = Report(stdout, f"{requests} sequential chat completions against a local fake provider")
+
+    with FakeProvider(chunks=1, delay=0) as provider, override_settings(OPENROUTER_BASE_URL=provider.base_url):
+        def fresh():
+            for _ in range(requests):
+                client = openai.OpenAI(api_key='benchmark', base_url=provider.base_url)
+                client.chat.completions.create(model='fake/model', messages=history)
+                client.close()
+
+        def pooled():
+            for _ in range(requests):
+                client = client_pool.get_sync_client('benchmark')
+                client.chat.completions.create(model='fake/model', messages=history)
+
+        report.add('client per request', ms_per_request=timed(fresh, repeat)[0] / requests)
+
+        client_pool.close_all()
+        client_pool.reset_pool_stats()
+        elapsed, _ = timed(pooled, repeat)
+        stats = client_pool.get_pool_stats()
+        report.add(
+            'pooled client',
+            ms_per_request=elapsed / requests,
+            hit_rate=stats['hit_rate'],
+            new_connections=stats['new_connections'],
+            reuse_rate=stats['connection_reuse_rate'],
+        )
+        client_pool.close_all()
+    report.render()
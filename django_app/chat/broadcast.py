@@ -0,0 +1,184 @@
+"""
+Live WebSocket delivery of replies generated in Celery workers.
+
+process_ai_chat_request runs outside any consumer, so it publishes the reply
+to the conversation's channel-layer group while it streams: message_start,
+one message_chunk per coalesced frame (the frames that also go to the
+stream log, with their event ids), then message_complete, or error when an
+attempt fails. Each event is encoded once here (wire.group_event) and
+ChatConsumer.reply_event writes the shared frame, so sockets on the
+conversation show the first token as soon as the worker has it instead of
+polling task_status. Notifications for a user's notification sockets are
+built the same way (system_notification, task_completed).
+
+Group sends run on one event loop per worker process, on a background
+thread, so the channel layer keeps its Redis connections across frames
+instead of opening a loop and connections per send. Publishing never fails
+the task: when a send fails or does not finish within WS_STREAM_SEND_TIMEOUT
+seconds, the rest of that reply is not published and clients resume it
+from the stream log instead.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from . import wire
+
+logger = logging.getLogger('chat')
+
+_lock = threading.Lock()
+_stats = {'replies': 0, 'frames': 0, 'dropped': 0}
+
+_loop_lock = threading.Lock()
+_loop = None
+_loop_pid = None
+
+
+def _broadcast_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('WS_STREAM_ENABLED', True),
+        chat_settings.get('WS_STREAM_SEND_TIMEOUT', 2),
+    )
+
+
+def _count(stat, value=1):
+    with _lock:
+        _stats[stat] += value
+
+
+def conversation_group(conversation_id):
+    """Channel-layer group of the sockets open on a conversation"""
+    return f'chat_{conversation_id}'
+
+
+def notification_group(user_id):
+    """Channel-layer group of a user's notification sockets"""
+    return f'notifications_{user_id}'
+
+
+def system_notification(title, message, level='info'):
+    """Group event for NotificationConsumer.system_notification, encoded once"""
+    return wire.group_event('system_notification', {
+        'type': 'system_notification',
+        'title': title,
+        'message': message,
+        'level': level,
+        'timestamp': timezone.now().isoformat(),
+    })
+
+
+def task_completed(task_id, task_type, result):
+    """Group event for NotificationConsumer.task_completed, encoded once"""
+    return wire.group_event('task_completed', {
+        'type': 'task_completed',
+        'task_id': task_id,
+        'task_type': task_type,
+        'result': result,
+        'timestamp': timezone.now().isoformat(),
+    })
+
+
+def _publisher_loop():
+    """This process's publishing loop; started on first use, and again after a fork"""
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='chat-broadcast', daemon=True).start()
+            _loop, _loop_pid = loop, os.getpid()
+        return _loop
+
+
+class ReplyBroadcast:
+    """
+    Publishes the events of one reply to its conversation's group
+    """
+
+    def __init__(self, conversation_id, message_id, model):
+        enabled, self.timeout = _broadcast_settings()
+        self.layer = get_channel_layer() if enabled else None
+        self.group = conversation_group(conversation_id)
+        self.conversation_id = str(conversation_id)
+        self.message_id = str(message_id)
+        self.model = model
+
+    @property
+    def enabled(self):
+        return self.layer is not None
+
+    def _send(self, payload):
+        if self.layer is None:
+            return False
+        future = asyncio.run_coroutine_threadsafe(
+            self.layer.group_send(self.group, wire.group_event('reply_event', payload)),
+            _publisher_loop()
+        )
+        try:
+            # Waiting keeps the frames of a reply in order
+            future.result(self.timeout)
+            return True
+        except Exception as e:
+            future.cancel()
+            _count('dropped')
+            # The rest of this reply is left to the stream log
+            self.layer = None
+            logger.warning(f"Reply broadcast to {self.group} failed: {str(e) or type(e).__name__}")
+            return False
+
+    def start(self):
+        _count('replies')
+        return self._send({
+            'type': 'message_start',
+            'message_id': self.message_id,
+            'conversation_id': self.conversation_id,
+            'model': self.model,
+        })
+
+    def chunk(self, content, event_id=None):
+        sent = self._send({
+            'type': 'message_chunk',
+            'message_id': self.message_id,
+            'event_id': event_id,
+            'content': content,
+        })
+        if sent:
+            _count('frames')
+        return sent
+
+    def complete(self, message):
+        """`message` is the finished Message's get_summary()"""
+        return self._send({
+            'type': 'message_complete',
+            'message_id': self.message_id,
+            'content': message.get('content', ''),
+            'message': message,
+        })
+
+    def error(self, error):
+        return self._send({
+            'type': 'error',
+            'message_id': self.message_id,
+            'message': f"Reply failed: {error}",
+        })
+
+
+def get_broadcast_stats():
+    """Replies and frames published to WebSocket groups, in this process"""
+    with _lock:
+        stats = dict(_stats)
+    stats['frames_per_reply'] = stats['frames'] / stats['replies'] if stats['replies'] else 0.0
+    stats['enabled'] = _broadcast_settings()[0]
+    return stats
+
+
+def reset_broadcast_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
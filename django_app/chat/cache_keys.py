@@ -0,0 +1,84 @@
+"""
+Versioned cache namespaces.
+
+Every cached value that belongs to a conversation or a user embeds that
+owner's generation number in its key. Invalidating all of them (every page,
+limit and cursor variant) is a single INCR of the generation; the old
+entries are simply never read again and expire on their own TTL. This
+replaces wildcard deletes, which either did nothing (cache.delete with a
+literal '*') or SCANned the whole Redis keyspace (delete_pattern).
+"""
+
+import logging
+import time
+
+from django.core.cache import cache
+
+logger = logging.getLogger('chat')
+
+CONVERSATION = 'conversation'
+USER = 'user'
+# Bumped only when existing messages change, not when one is appended
+CONTEXT = 'context'
+
+
+def _generation_key(scope, owner_id):
+    return f"gen:{scope}:{owner_id}"
+
+
+def _fresh_generation():
+    # Seeded from the clock rather than 1, so a generation key that was evicted
+    # can never come back at a value that old entries are still stored under
+    return time.time_ns() // 1000
+
+
+def generation(scope, owner_id):
+    """Current generation for an owner, creating it on first use"""
+    key = _generation_key(scope, owner_id)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, _fresh_generation(), None)
+        value = cache.get(key)
+    return value
+
+
+def bump(scope, owner_id):
+    """Invalidate every key in the owner's namespace"""
+    key = _generation_key(scope, owner_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # No generation yet, so nothing was cached under one
+        cache.add(key, _fresh_generation(), None)
+    except Exception as e:
+        logger.warning(f"Cache invalidation failed for {key}: {str(e)}")
+
+
+def conversation_key(conversation_id, *parts):
+    """Cache key inside a conversation's namespace"""
+    suffix = ':'.join(str(part) for part in parts)
+    return f"{CONVERSATION}:{conversation_id}:g{generation(CONVERSATION, conversation_id)}:{suffix}"
+
+
+def user_key(user_id, *parts):
+    """Cache key inside a user's namespace"""
+    suffix = ':'.join(str(part) for part in parts)
+    return f"{USER}:{user_id}:g{generation(USER, user_id)}:{suffix}"
+
+
+def context_key(conversation_id, *parts):
+    """Cache key for assembled model context, which survives appends"""
+    suffix = ':'.join(str(part) for part in parts)
+    return f"{CONTEXT}:{conversation_id}:g{generation(CONTEXT, conversation_id)}:{suffix}"
+
+
+def invalidate_conversation(conversation_id):
+    bump(CONVERSATION, conversation_id)
+
+
+def invalidate_user(user_id):
+    bump(USER, user_id)
+
+
+def invalidate_context(conversation_id):
+    bump(CONTEXT, conversation_id)
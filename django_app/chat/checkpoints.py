@@ -0,0 +1,84 @@
+"""
+Checkpointing of assistant replies while they are generated.
+
+A reply is appended as a placeholder Message with status 'streaming' before
+the upstream call, so it survives a worker dying mid-generation. The text
+generated so far is written back to that row with one UPDATE per
+checkpoint, at most every CHECKPOINT_EVERY_TOKENS tokens or
+CHECKPOINT_EVERY_SECONDS seconds, whichever comes first, and never per
+token. MessageManager.finish() stores the final text with status
+'complete' or 'aborted'.
+"""
+
+import time
+
+from django.conf import settings
+
+from .models import Message
+
+
+def _checkpoint_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('CHECKPOINT_EVERY_TOKENS', 64),
+        chat_settings.get('CHECKPOINT_EVERY_SECONDS', 2),
+    )
+
+
+def start_reply(conversation, model, message_id):
+    """
+    Append the streaming placeholder for a reply.
+
+    A retried task finds its placeholder already there and reuses it.
+    """
+    existing = Message.objects.filter(pk=message_id).select_related('conversation').first()
+    if existing is not None:
+        return existing
+    return Message.objects.append(
+        conversation, 'assistant', '', model=model, status=Message.STREAMING, id=message_id
+    )
+
+
+class ReplyCheckpoint:
+    """
+    Accumulates a reply and decides when its placeholder is due for an UPDATE
+    """
+
+    def __init__(self, message, every_tokens=None, every_seconds=None):
+        default_tokens, default_seconds = _checkpoint_settings()
+        self.message = message
+        self.every_tokens = default_tokens if every_tokens is None else every_tokens
+        self.every_seconds = default_seconds if every_seconds is None else every_seconds
+        self.parts = []
+        self.chars = 0
+        self.saved_chars = 0
+        self.saved_at = time.monotonic()
+        self.checkpoints = 0
+
+    @property
+    def content(self):
+        return ''.join(self.parts)
+
+    def add(self, text):
+        self.parts.append(text)
+        self.chars += len(text)
+
+    def due(self, now=None):
+        unsaved = self.chars - self.saved_chars
+        if not unsaved:
+            return False
+        now = time.monotonic() if now is None else now
+        # About 4 characters per token; exact counts are only needed once, at the end
+        return unsaved // 4 >= self.every_tokens or now - self.saved_at >= self.every_seconds
+
+    def mark(self, now=None):
+        """Record a checkpoint and return the content to write"""
+        self.saved_chars = self.chars
+        self.saved_at = time.monotonic() if now is None else now
+        self.checkpoints += 1
+        return self.content
+
+    def save(self):
+        """Write a checkpoint if one is due"""
+        if self.due():
+            Message.objects.checkpoint(self.message.pk, self.mark())
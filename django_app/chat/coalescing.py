@@ -0,0 +1,116 @@
+"""
+Coalescing of streamed completion deltas into fewer, larger frames.
+
+Upstream providers send one chunk per token or two, and forwarding each as
+its own SSE/WebSocket frame costs a json.dumps, a write and a stream log
+entry per token. DeltaCoalescer collects deltas and releases them as one
+frame once STREAM_COALESCE_WINDOW_MS has passed since the oldest pending
+delta or STREAM_COALESCE_BYTES have piled up. The first delta of a reply is
+released immediately so time to first token does not change, and finish()
+releases whatever is left on completion.
+
+The coalescer only decides; the caller arms a timer for the window (see
+streaming.generate_reply) or, in sync code, checks again on the next delta.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_stats = {
+    'messages': 0,
+    'deltas': 0,
+    'frames': 0,
+    'bytes': 0,
+}
+
+
+def _coalesce_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('STREAM_COALESCE_WINDOW_MS', 30) / 1000,
+        chat_settings.get('STREAM_COALESCE_BYTES', 512),
+    )
+
+
+class DeltaCoalescer:
+    """
+    Batches text deltas by time window and size
+    """
+
+    def __init__(self, window=None, max_bytes=None):
+        default_window, default_bytes = _coalesce_settings()
+        self.window = default_window if window is None else window
+        self.max_bytes = default_bytes if max_bytes is None else max_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.deltas = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def add(self, text, now=None):
+        """Queue a delta; returns the text of a frame to send now, or None"""
+        if not text:
+            return None
+        now = time.monotonic() if now is None else now
+        size = len(text.encode('utf-8'))
+        self.deltas += 1
+        if self.pending_since is None:
+            self.pending_since = now
+        self.pending.append(text)
+        self.pending_bytes += size
+        if self.frames == 0 or self.pending_bytes >= self.max_bytes or now - self.pending_since >= self.window:
+            return self.flush()
+        return None
+
+    def remaining(self, now=None):
+        """Seconds until the pending frame is due, or None if nothing is pending"""
+        if self.pending_since is None:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.pending_since + self.window - now)
+
+    def due(self, now=None):
+        remaining = self.remaining(now)
+        return remaining is not None and remaining <= 0
+
+    def flush(self):
+        """Release everything pending as one frame"""
+        if not self.pending:
+            return None
+        text = ''.join(self.pending)
+        self.frames += 1
+        self.bytes += self.pending_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        return text
+
+    def finish(self):
+        """Release the tail of the reply and record this reply's metrics"""
+        text = self.flush()
+        with _lock:
+            _stats['messages'] += 1
+            _stats['deltas'] += self.deltas
+            _stats['frames'] += self.frames
+            _stats['bytes'] += self.bytes
+        return text
+
+
+def get_coalescing_stats():
+    """Frames per message, bytes per frame and deltas per frame so far"""
+    with _lock:
+        stats = dict(_stats)
+    stats['frames_per_message'] = stats['frames'] / stats['messages'] if stats['messages'] else 0.0
+    stats['bytes_per_frame'] = stats['bytes'] / stats['frames'] if stats['frames'] else 0.0
+    stats['deltas_per_frame'] = stats['deltas'] / stats['frames'] if stats['frames'] else 0.0
+    return stats
+
+
+def reset_coalescing_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
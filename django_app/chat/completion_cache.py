@@ -0,0 +1,247 @@
+"""
+Exact-match cache of completions.
+
+With COMPLETION_CACHE_ENABLED, a finished reply is stored under a canonical
+hash of (model, messages, temperature, max_tokens), and an identical
+request is answered from the cache and replayed through the normal stream
+path, so clients receive the same frames as for a live reply. Sampled
+requests (temperature > 0) may rightly get a different reply every time and
+are only cached when the caller opts in with "cache": true; "cache": false
+skips the cache for any request.
+
+Entries live in the Django cache for COMPLETION_CACHE_TTL seconds. An index
+ordered by last use bounds them to COMPLETION_CACHE_MAX_ENTRIES: a Redis
+sorted set when the cache is Redis, shared by all workers, or an in-process
+LRU next to the local-memory cache.
+"""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .context import DEFAULT_MAX_TOKENS
+from .counters import get_redis
+
+logger = logging.getLogger('chat')
+
+DEFAULT_TEMPERATURE = 0.7
+
+INDEX_KEY = 'chat:completions:index'
+
+# Words with their trailing whitespace, the size of typical upstream deltas
+PIECE_RE = re.compile(r'\s*\S+\s*|\s+')
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _cache_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('COMPLETION_CACHE_ENABLED', False),
+        chat_settings.get('COMPLETION_CACHE_TTL', 3600),
+        chat_settings.get('COMPLETION_CACHE_MAX_ENTRIES', 10000),
+    )
+
+
+def _count(model, stat, value=1):
+    with _lock:
+        counts = _stats.setdefault(model, {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0})
+        counts[stat] += value
+
+
+def completion_options(data):
+    """
+    temperature, max_tokens and the cache opt-in of a chat request body;
+    raises ValueError when one is invalid
+    """
+    try:
+        temperature = float(data.get('temperature', DEFAULT_TEMPERATURE))
+        max_tokens = int(data.get('max_tokens', DEFAULT_MAX_TOKENS))
+    except (TypeError, ValueError):
+        raise ValueError('temperature must be a number and max_tokens an integer')
+    if not 0 <= temperature <= 2:
+        raise ValueError('temperature must be between 0 and 2')
+    if not 1 <= max_tokens <= DEFAULT_MAX_TOKENS:
+        raise ValueError(f'max_tokens must be between 1 and {DEFAULT_MAX_TOKENS}')
+
+    opt_in = data.get('cache')
+    if isinstance(opt_in, str) and opt_in.lower() in ('true', 'false'):
+        opt_in = opt_in.lower() == 'true'
+    if opt_in is not None and not isinstance(opt_in, bool):
+        raise ValueError('cache must be true or false')
+    return {'temperature': temperature, 'max_tokens': max_tokens, 'cache': opt_in}
+
+
+def default_options():
+    return {'temperature': DEFAULT_TEMPERATURE, 'max_tokens': DEFAULT_MAX_TOKENS, 'cache': None}
+
+
+def should_cache(options):
+    """Deterministic requests are cached; sampled ones only when the caller opts in"""
+    enabled, _, _ = _cache_settings()
+    if not enabled or options['cache'] is False:
+        return False
+    return options['temperature'] <= 0 or options['cache'] is True
+
+
+def completion_key(model, messages, options):
+    """Canonical hash of everything that determines the reply"""
+    canonical = json.dumps(
+        {
+            'model': model,
+            'messages': [
+                {'role': message['role'], 'content': message.get('content') or ''}
+                for message in messages
+            ],
+            'temperature': float(options['temperature']),
+            'max_tokens': int(options['max_tokens']),
+        },
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def request_key(model, messages, options):
+    """Cache key for a request, or None when it is not cached"""
+    return completion_key(model, messages, options) if should_cache(options) else None
+
+
+class _LocalIndex:
+    """
+    Last-use order of the entries in this process's local-memory cache
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def touch(self, key, now):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = now
+                self.entries.move_to_end(key)
+
+    def add(self, key, now, ttl, max_entries):
+        """Index a new entry; returns the keys evicted to make room"""
+        evicted = []
+        with self.lock:
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            while self.entries:
+                oldest_key, used_at = next(iter(self.entries.items()))
+                if len(self.entries) <= max_entries and used_at >= now - ttl:
+                    break
+                self.entries.popitem(last=False)
+                if used_at >= now - ttl:
+                    evicted.append(oldest_key)
+        return evicted
+
+
+class _RedisIndex:
+    """
+    Last-use order of the entries, as a sorted set shared by all workers
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def touch(self, key, now):
+        self.client.zadd(INDEX_KEY, {key: now}, xx=True)
+
+    def add(self, key, now, ttl, max_entries):
+        pipe = self.client.pipeline()
+        pipe.zadd(INDEX_KEY, {key: now})
+        # Entries not used within the TTL have expired from the cache already
+        pipe.zremrangebyscore(INDEX_KEY, '-inf', now - ttl)
+        pipe.zcard(INDEX_KEY)
+        _, _, size = pipe.execute()
+        if size <= max_entries:
+            return []
+        popped = self.client.zpopmin(INDEX_KEY, size - max_entries)
+        return [member.decode() if isinstance(member, bytes) else member for member, _ in popped]
+
+
+_local_index = _LocalIndex()
+
+
+def _index():
+    client = get_redis()
+    return _RedisIndex(client) if client is not None else _local_index
+
+
+def _entry_key(key):
+    return f"completion:{key}"
+
+
+def lookup(model, key):
+    """Cached {'content', 'tokens'} for a request key, or None"""
+    try:
+        entry = cache.get(_entry_key(key))
+    except Exception as e:
+        logger.warning(f"Completion cache lookup failed: {str(e)}")
+        return None
+    if entry is None:
+        _count(model, 'misses')
+        return None
+    _count(model, 'hits')
+    try:
+        _index().touch(key, time.time())
+    except Exception as e:
+        logger.warning(f"Completion cache index update failed: {str(e)}")
+    return entry
+
+
+def store(model, key, content, tokens=0):
+    """Cache a finished reply and evict the least recently used entries past the limit"""
+    if not content:
+        return False
+    _, ttl, max_entries = _cache_settings()
+    try:
+        cache.set(_entry_key(key), {'content': content, 'tokens': tokens}, ttl)
+        evicted = _index().add(key, time.time(), ttl, max_entries)
+        if evicted:
+            cache.delete_many([_entry_key(old) for old in evicted])
+    except Exception as e:
+        logger.warning(f"Completion cache store failed: {str(e)}")
+        return False
+    _count(model, 'stores')
+    if evicted:
+        _count(model, 'evictions', len(evicted))
+    return True
+
+
+def replay_pieces(content):
+    """A cached reply cut into deltas, to be sent like a live stream"""
+    return PIECE_RE.findall(content)
+
+
+def get_completion_cache_stats():
+    """Hit rates overall and per model, in this process"""
+    with _lock:
+        models = {model: dict(counts) for model, counts in _stats.items()}
+    totals = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+    for counts in models.values():
+        lookups = counts['hits'] + counts['misses']
+        counts['hit_rate'] = counts['hits'] / lookups if lookups else 0.0
+        for name in totals:
+            totals[name] += counts[name]
+    lookups = totals['hits'] + totals['misses']
+    totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+    totals['enabled'] = _cache_settings()[0]
+    totals['models'] = models
+    return totals
+
+
+def reset_completion_cache_stats():
+    with _lock:
+        _stats.clear()
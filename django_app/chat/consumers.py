@@ -1,18 +1,49 @@
 import json
 import logging
 import asyncio
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.core.cache import cache
 from django.utils import timezone
 from datetime import timedelta
 
+from . import access, presence, wire
+from .broadcast import conversation_group, notification_group
 from .models import Conversation, Message
+from .single_flight import AsyncFlight, flight_key
+from .stream_log import get_owner, is_valid_event_id, read_events
 from .tasks import process_ai_chat_request
+from .typing_indicators import set_typing
 
 logger = logging.getLogger('chat')
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class WireCodecMixin:
+    """
+    Subprotocol negotiation and frame encoding shared by the consumers
+    """
+    
+    codec = wire.JSON
+    
+    async def accept_negotiated(self):
+        """Accept with the best subprotocol the client offered; JSON without one"""
+        subprotocol, self.codec = wire.negotiate(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=subprotocol)
+    
+    async def send_payload(self, payload):
+        """Encode a payload in this socket's encoding and send it"""
+        await self.send(**wire.frame_kwargs(wire.encode(payload, self.codec), self.codec))
+    
+    async def send_frames(self, event):
+        """Send the frame a group event carries already encoded for this socket"""
+        frame = event['frames'].get(self.codec)
+        if frame is None:
+            # Published where this encoding was unavailable
+            await self.send_payload(json.loads(event['frames'][wire.JSON]))
+            return
+        await self.send(**wire.frame_kwargs(frame, self.codec, shared=True))
+
+
+class ChatConsumer(WireCodecMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer for real-time chat functionality
     """
@@ -20,11 +51,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         """Handle WebSocket connection"""
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-        self.room_group_name = f'chat_{self.conversation_id}'
+        self.room_group_name = conversation_group(self.conversation_id)
         self.user_id = self.get_user_id()
+        self.resume_tasks = {}
+        self.presence_task = None
+        self.is_typing = False
         
-        # Validate conversation access
-        if not await self.can_access_conversation():
+        # Validate conversation access; the row, if it had to be loaded, is
+        # kept for the connection
+        decision, self.conversation = await access.authorize(self.user_id, self.conversation_id)
+        self.is_owner = decision['owner']
+        if not decision['allowed']:
             await self.close(code=4003)
             return
         
@@ -35,37 +72,47 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         
         # Accept connection
-        await self.accept()
+        await self.accept_negotiated()
         
         # Track active connection
-        await self.track_connection()
+        await presence.join(self.conversation_id, self.user_id, self.channel_name)
+        self.presence_task = asyncio.ensure_future(self.keep_present())
         
         # Send connection confirmation
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'type': 'connection_established',
             'conversation_id': self.conversation_id,
             'timestamp': timezone.now().isoformat()
-        }))
+        })
         
         logger.info(f"WebSocket connected: user {self.user_id}, conversation {self.conversation_id}")
     
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
+        for task in list(self.resume_tasks.values()):
+            task.cancel()
+        
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
         
+        # Others stop seeing this user type
+        if self.is_typing:
+            await self.handle_typing_stop({})
+        
         # Remove connection tracking
-        await self.untrack_connection()
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+            await presence.leave(self.conversation_id, self.user_id, self.channel_name)
         
         logger.info(f"WebSocket disconnected: user {self.user_id}, conversation {self.conversation_id}, code {close_code}")
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming WebSocket messages"""
         try:
-            data = json.loads(text_data)
+            data = wire.decode(text_data, bytes_data)
             message_type = data.get('type')
             
             if message_type == 'chat_message':
@@ -78,11 +125,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.handle_ping(data)
             elif message_type == 'message_reaction':
                 await self.handle_message_reaction(data)
+            elif message_type == 'get_conversation_history':
+                await self.handle_get_history(data)
+            elif message_type == 'resume':
+                await self.handle_resume(data)
+            elif message_type == 'get_presence':
+                await self.handle_get_presence(data)
             else:
                 await self.send_error(f"Unknown message type: {message_type}")
                 
-        except json.JSONDecodeError:
-            await self.send_error("Invalid JSON format")
+        except ValueError:
+            await self.send_error("Invalid message format")
         except Exception as e:
             logger.error(f"WebSocket receive error: {str(e)}")
             await self.send_error("Internal server error")
@@ -102,69 +155,88 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.send_error("API key is required")
                 return
             
+            # Shared conversations are read-only for everyone but the owner
+            if not self.is_owner:
+                await self.send_error("Only the owner can post to this conversation")
+                return
+            
+            # A duplicate of a request in flight follows its reply instead
+            reply_id = str(uuid.uuid4())
+            idempotency_key = data.get('idempotency_key')
+            flight = await AsyncFlight.claim(
+                flight_key(self.user_id, self.conversation_id, content, idempotency_key),
+                reply_id,
+                self.user_id,
+                client_key=bool(idempotency_key)
+            )
+            if not flight.leader:
+                await self.send_payload({
+                    'type': 'processing_started',
+                    'reply_id': flight.message_id,
+                    'duplicate': True
+                })
+                self.follow_stream(flight.message_id, None, while_held=flight.held)
+                return
+            
             # Create user message immediately
             message = await self.create_user_message(content, model)
             
-            # Broadcast user message to room
+            # Broadcast user message to room, encoded once for every member
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    'type': 'chat_message_broadcast',
-                    'message': await self.serialize_message(message),
-                    'sender_id': self.user_id
-                }
+                wire.group_event(
+                    'chat_message_broadcast',
+                    {'type': 'message', 'message': await self.serialize_message(message)},
+                    sender_id=self.user_id
+                )
             )
             
-            # Process AI response asynchronously
-            task_result = process_ai_chat_request.delay(
-                conversation_id=self.conversation_id,
-                user_message=content,
-                model=model,
-                api_key=api_key,
-                user_id=self.user_id
-            )
+            # Process AI response asynchronously; the worker streams the
+            # reply to this conversation's group (reply_event). The reply id
+            # is fixed up front so the client can resume its stream log
+            try:
+                task_result = process_ai_chat_request.delay(
+                    conversation_id=self.conversation_id,
+                    user_message=content,
+                    model=model,
+                    api_key=api_key,
+                    user_id=self.user_id,
+                    message_id=reply_id,
+                    flight=flight.to_task(),
+                    user_message_id=str(message.id)
+                )
+            except Exception:
+                await flight.land(ok=False)
+                raise
             
             # Send task ID for tracking
-            await self.send(text_data=json.dumps({
+            await self.send_payload({
                 'type': 'processing_started',
                 'task_id': task_result.id,
-                'message_id': str(message.id)
-            }))
+                'message_id': str(message.id),
+                'reply_id': reply_id
+            })
             
         except Exception as e:
             logger.error(f"Chat message handling error: {str(e)}")
             await self.send_error("Failed to process message")
     
     async def handle_typing_start(self, data):
-        """Handle typing start indicator"""
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'typing_indicator',
-                'user_id': self.user_id,
-                'is_typing': True,
-                'timestamp': timezone.now().isoformat()
-            }
-        )
+        """Handle typing start indicator; debounced and batched per conversation"""
+        self.is_typing = True
+        set_typing(self.room_group_name, self.channel_layer, self.user_id, True)
     
     async def handle_typing_stop(self, data):
         """Handle typing stop indicator"""
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'typing_indicator',
-                'user_id': self.user_id,
-                'is_typing': False,
-                'timestamp': timezone.now().isoformat()
-            }
-        )
+        self.is_typing = False
+        set_typing(self.room_group_name, self.channel_layer, self.user_id, False)
     
     async def handle_ping(self, data):
         """Handle ping for connection keepalive"""
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'type': 'pong',
             'timestamp': timezone.now().isoformat()
-        }))
+        })
     
     async def handle_message_reaction(self, data):
         """Handle message reactions"""
@@ -184,13 +256,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 # Broadcast reaction update
                 await self.channel_layer.group_send(
                     self.room_group_name,
-                    {
-                        'type': 'reaction_update',
+                    wire.group_event('reaction_update', {
+                        'type': 'reaction',
                         'message_id': message_id,
                         'reaction_type': reaction_type,
                         'action': action,
                         'user_id': self.user_id
-                    }
+                    })
                 )
             else:
                 await self.send_error("Failed to update reaction")
@@ -199,44 +271,107 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(f"Reaction handling error: {str(e)}")
             await self.send_error("Failed to process reaction")
     
+    async def handle_get_history(self, data):
+        """Send recent conversation history"""
+        try:
+            limit = min(int(data.get('limit', 100)), 500)
+        except (TypeError, ValueError):
+            await self.send_error("Invalid history limit")
+            return
+        
+        # Loading and bulk decryption both run in the sync thread pool,
+        # never on the event loop
+        messages = await self.load_history(limit)
+        
+        await self.send_payload({
+            'type': 'conversation_history',
+            'conversation_id': self.conversation_id,
+            'messages': messages
+        })
+    
+    async def handle_get_presence(self, data):
+        """Send the users connected to this conversation"""
+        await self.send_payload({
+            'type': 'presence',
+            'conversation_id': self.conversation_id,
+            'users': await presence.online_users(self.conversation_id)
+        })
+    
     # WebSocket event handlers
+    async def handle_resume(self, data):
+        """Replay a reply's stream log after last_event_id and follow it"""
+        message_id = data.get('message_id')
+        last_event_id = data.get('last_event_id')
+        if last_event_id and not is_valid_event_id(last_event_id):
+            await self.send_error("Invalid event id")
+            return
+        try:
+            owner = await get_owner(message_id)
+        except Exception as e:
+            logger.warning(f"Stream log unavailable: {str(e)}")
+            owner = None
+        if owner != self.user_id:
+            await self.send_error("Stream not found")
+            return
+        
+        self.follow_stream(message_id, last_event_id)
+    
+    def follow_stream(self, message_id, last_event_id, while_held=None):
+        """Tail a reply's stream log in the background so this socket keeps handling messages"""
+        previous = self.resume_tasks.pop(message_id, None)
+        if previous:
+            previous.cancel()
+        task = asyncio.ensure_future(self.relay_stream(message_id, last_event_id, while_held))
+        self.resume_tasks[message_id] = task
+        
+        def forget(finished):
+            if self.resume_tasks.get(message_id) is finished:
+                del self.resume_tasks[message_id]
+        task.add_done_callback(forget)
+    
+    async def relay_stream(self, message_id, last_event_id, while_held=None):
+        """Forward logged stream events to this socket"""
+        try:
+            async for event_id, payload in read_events(message_id, after=last_event_id, while_held=while_held):
+                await self.send_payload({
+                    'type': 'stream_event',
+                    'message_id': message_id,
+                    'event_id': event_id,
+                    'event': payload
+                })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Stream resume failed for {message_id}: {str(e)}")
+            await self.send_error("Failed to resume stream")
+    
     async def chat_message_broadcast(self, event):
         """Broadcast chat message to WebSocket"""
         # Don't send back to sender
         if event.get('sender_id') != self.user_id:
-            await self.send(text_data=json.dumps({
-                'type': 'message',
-                'message': event['message']
-            }))
+            await self.send_frames(event)
     
-    async def typing_indicator(self, event):
-        """Send typing indicator to WebSocket"""
+    async def typing_batch(self, event):
+        """Send the typing state changes of other users to WebSocket"""
+        if self.user_id not in event['users']:
+            await self.send_frames(event)
+            return
         # Don't send back to sender
-        if event.get('user_id') != self.user_id:
-            await self.send(text_data=json.dumps({
-                'type': 'typing',
-                'user_id': event['user_id'],
-                'is_typing': event['is_typing'],
+        users = {user_id: is_typing for user_id, is_typing in event['users'].items() if user_id != self.user_id}
+        if users:
+            await self.send_payload({
+                'type': 'typing_batch',
+                'users': users,
                 'timestamp': event['timestamp']
-            }))
+            })
     
     async def reaction_update(self, event):
         """Send reaction update to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'reaction',
-            'message_id': event['message_id'],
-            'reaction_type': event['reaction_type'],
-            'action': event['action'],
-            'user_id': event['user_id']
-        }))
-    
-    async def ai_response_ready(self, event):
-        """Send AI response when ready"""
-        await self.send(text_data=json.dumps({
-            'type': 'ai_response',
-            'message': event['message'],
-            'task_id': event.get('task_id')
-        }))
+        await self.send_frames(event)
+    
+    async def reply_event(self, event):
+        """Forward message_start/message_chunk/message_complete of a reply a worker streams"""
+        await self.send_frames(event)
     
     # Helper methods
     def get_user_id(self):
@@ -249,23 +384,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
         else:
             return 'anonymous'
     
-    @database_sync_to_async
-    def can_access_conversation(self):
-        """Check if user can access the conversation"""
-        try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            # For now, allow access if conversation exists
-            # In production, implement proper access control
-            return True
-        except Conversation.DoesNotExist:
-            return False
-    
     @database_sync_to_async
     def create_user_message(self, content, model):
         """Create user message in database"""
-        conversation = Conversation.objects.get(id=self.conversation_id)
+        # One row load per connection at most
+        if self.conversation is None:
+            self.conversation = Conversation.objects.get(id=self.conversation_id)
         return Message.objects.create_message(
-            conversation=conversation,
+            conversation=self.conversation,
             role='user',
             content=content,
             model=model
@@ -283,6 +409,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'metadata': message.metadata
         }
     
+    @database_sync_to_async
+    def load_history(self, limit):
+        """Load and batch-decrypt the latest messages, oldest first"""
+        messages = (
+            Message.objects.visible().filter(conversation_id=self.conversation_id)
+            .order_by('-created_at')[:limit]
+            .decrypted()
+        )
+        return [
+            {
+                'id': str(message.id),
+                'role': message.role,
+                'content': message.content,
+                'model': message.model,
+                'timestamp': message.created_at.isoformat(),
+                'metadata': message.metadata
+            }
+            for message in reversed(messages)
+        ]
+    
     @database_sync_to_async
     def update_message_reaction(self, message_id, reaction_type, action):
         """Update message reaction in database"""
@@ -299,33 +445,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(f"Reaction update error: {str(e)}")
             return False
     
-    async def track_connection(self):
-        """Track active WebSocket connection"""
-        cache_key = f"ws_connections:{self.conversation_id}"
-        connections = cache.get(cache_key, set())
-        connections.add(self.user_id)
-        cache.set(cache_key, connections, 3600)  # 1 hour expiry
-    
-    async def untrack_connection(self):
-        """Remove connection tracking"""
-        cache_key = f"ws_connections:{self.conversation_id}"
-        connections = cache.get(cache_key, set())
-        connections.discard(self.user_id)
-        if connections:
-            cache.set(cache_key, connections, 3600)
-        else:
-            cache.delete(cache_key)
+    async def keep_present(self):
+        """Renew this socket's presence until it disconnects"""
+        while True:
+            await asyncio.sleep(presence.heartbeat_interval())
+            await presence.join(self.conversation_id, self.user_id, self.channel_name)
     
     async def send_error(self, message):
         """Send error message to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'type': 'error',
             'message': message,
             'timestamp': timezone.now().isoformat()
-        }))
+        })
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(WireCodecMixin, AsyncWebsocketConsumer):
     """
     WebSocket consumer for system notifications and updates
     """
@@ -333,7 +468,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         """Handle notification WebSocket connection"""
         self.user_id = self.get_user_id()
-        self.room_group_name = f'notifications_{self.user_id}'
+        self.room_group_name = notification_group(self.user_id)
         
         # Join notification group
         await self.channel_layer.group_add(
@@ -341,14 +476,14 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept_negotiated()
         
         # Send connection confirmation
-        await self.send(text_data=json.dumps({
+        await self.send_payload({
             'type': 'notification_connected',
             'user_id': self.user_id,
             'timestamp': timezone.now().isoformat()
-        }))
+        })
         
         logger.info(f"Notification WebSocket connected: user {self.user_id}")
     
@@ -361,41 +496,29 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         
         logger.info(f"Notification WebSocket disconnected: user {self.user_id}")
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming notification messages"""
         try:
-            data = json.loads(text_data)
+            data = wire.decode(text_data, bytes_data)
             message_type = data.get('type')
             
             if message_type == 'ping':
-                await self.send(text_data=json.dumps({
+                await self.send_payload({
                     'type': 'pong',
                     'timestamp': timezone.now().isoformat()
-                }))
+                })
             
-        except json.JSONDecodeError:
-            pass  # Ignore invalid JSON
+        except ValueError:
+            pass  # Ignore malformed frames
     
-    # Notification event handlers
+    # Notification event handlers; events come pre-encoded from chat.broadcast
     async def system_notification(self, event):
         """Send system notification"""
-        await self.send(text_data=json.dumps({
-            'type': 'system_notification',
-            'title': event['title'],
-            'message': event['message'],
-            'level': event.get('level', 'info'),
-            'timestamp': timezone.now().isoformat()
-        }))
+        await self.send_frames(event)
     
     async def task_completed(self, event):
         """Send task completion notification"""
-        await self.send(text_data=json.dumps({
-            'type': 'task_completed',
-            'task_id': event['task_id'],
-            'task_type': event['task_type'],
-            'result': event['result'],
-            'timestamp': timezone.now().isoformat()
-        }))
+        await self.send_frames(event)
     
     def get_user_id(self):
         """Get user ID from WebSocket scope"""
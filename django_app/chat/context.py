@@ -0,0 +1,190 @@
+"""
+Model context assembly within a token budget.
+
+build_context() returns the longest run of recent turns, in chronological
+order, that fits the model's context window after reserving room for the
+reply (max_tokens). It walks back from the newest message using the stored
+Message.token_count, so only the selected messages are decrypted.
+
+The selected turns are cached per conversation and budget as (id, token
+count, created_at) only, never their text, which is decrypted in one batch
+on every build. The cache is not retired by appends: the next turn
+fetches only the rows written after the cached ones and trims the oldest
+turns to fit. Editing or deleting a message bumps the conversation's
+context generation instead (see chat.cache_keys.invalidate_context).
+Replies still streaming are left out, and the cache never advances past
+one, so it is picked up once it finishes.
+
+When the conversation has a rolling summary (chat.summaries), it is sent
+first and only the turns after the last message it covers follow it.
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache_keys import context_key
+from .models import Message, decrypt_all
+from .summaries import after, covered_through, latest_summary
+from .tokenizer import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+logger = logging.getLogger('chat')
+
+DEFAULT_MAX_TOKENS = 4000
+
+# Context window in tokens by model name prefix (without the OpenRouter
+# "provider/" part); the longest matching prefix wins
+CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4.1': 1047576,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'o1': 200000,
+    'o3': 200000,
+    'o4': 200000,
+    'claude': 200000,
+    'gemini': 1048576,
+    'llama-3': 131072,
+    'mistral': 32768,
+    'deepseek': 65536,
+}
+
+WALK_CHUNK = 200
+
+
+def context_window(model):
+    """Context size of `model` in tokens"""
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    windows = dict(CONTEXT_WINDOWS, **chat_settings.get('CONTEXT_WINDOWS', {}))
+    name = (model or '').rsplit('/', 1)[-1].lower()
+    best = None
+    for prefix in windows:
+        if name.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return windows[best] if best else chat_settings.get('CONTEXT_DEFAULT_WINDOW', 8192)
+
+
+def _history(conversation, marker=None):
+    return after(Message.objects.visible().filter(conversation=conversation), marker)
+
+
+def _cost(turn):
+    return turn['tokens'] + TOKENS_PER_MESSAGE
+
+
+def _trim(turns, budget):
+    """Drop the oldest turns until the rest fit; the newest turn always stays"""
+    total = sum(_cost(turn) for turn in turns)
+    start = 0
+    while total > budget and start < len(turns) - 1:
+        total -= _cost(turns[start])
+        start += 1
+    return turns[start:], total
+
+
+def _to_turns(rows):
+    """Cacheable turns for (id, token_count, created_at) rows; they hold no text"""
+    return [
+        {'id': str(pk), 'tokens': tokens, 'created_at': created_at.isoformat()}
+        for pk, tokens, created_at in rows
+    ]
+
+
+def _summary_turn(conversation):
+    """The rolling summary as a turn that knows where it ends, or None"""
+    summary = latest_summary(conversation)
+    if summary is None:
+        return None
+    return {
+        'id': str(summary.id),
+        'tokens': summary.token_count,
+        'through': covered_through(summary),
+    }
+
+
+def _with_content(turns):
+    """Chat completion messages for turns, decrypting all of them as one batch"""
+    messages = Message.objects.filter(pk__in=[turn['id'] for turn in turns]).order_by().only(
+        'id', 'role', 'content', 'content_legacy'
+    )
+    by_id = {str(message.id): message for message in decrypt_all(messages)}
+    return [
+        {'role': by_id[turn['id']].role, 'content': by_id[turn['id']].content or ''}
+        for turn in turns if turn['id'] in by_id
+    ]
+
+
+def _walk_back(conversation, budget, marker):
+    """Ids of the newest finished messages after `marker` whose stored counts fit the budget"""
+    selected = []
+    spent = 0
+    rows = _history(conversation, marker).exclude(status=Message.STREAMING).order_by('-created_at', '-id')
+    offset = 0
+    while True:
+        chunk = list(rows.values_list('id', 'token_count')[offset:offset + WALK_CHUNK])
+        for pk, tokens in chunk:
+            cost = tokens + TOKENS_PER_MESSAGE
+            if selected and spent + cost > budget:
+                return selected
+            selected.append(pk)
+            spent += cost
+        if len(chunk) < WALK_CHUNK:
+            return selected
+        offset += WALK_CHUNK
+
+
+def build_context(conversation, model, max_tokens=DEFAULT_MAX_TOKENS):
+    """
+    Chat completion messages for the next reply in `conversation`, oldest
+    first, fitting the context window of `model` with room for max_tokens
+    """
+    budget = context_window(model) - max_tokens - TOKENS_PER_REPLY
+    key = context_key(conversation.id, budget)
+    cached = cache.get(key)
+
+    if cached is not None:
+        summary = cached['summary']
+        room = budget - (_cost(summary) if summary else 0)
+        anchor = cached['turns'][-1] if cached['turns'] else (summary and summary['through'])
+        newer = list(
+            _history(conversation, anchor).order_by('created_at', 'id')
+            .values_list('id', 'token_count', 'created_at', 'status')
+        )
+        # Cache up to the first reply that is still streaming, use what is finished
+        streaming_at = next(
+            (index for index, row in enumerate(newer) if row[3] == Message.STREAMING),
+            len(newer)
+        )
+        settled = _to_turns(row[:3] for row in newer[:streaming_at])
+        later = _to_turns(row[:3] for row in newer[streaming_at:] if row[3] != Message.STREAMING)
+        cacheable, _ = _trim(cached['turns'] + settled, room)
+        turns, total = _trim(cacheable + later, room)
+    else:
+        summary = _summary_turn(conversation)
+        room = budget - (_cost(summary) if summary else 0)
+        marker = summary and summary['through']
+        ids = _walk_back(conversation, room, marker)
+        turns = _to_turns(
+            Message.objects.filter(pk__in=ids).order_by('created_at', 'id')
+            .values_list('id', 'token_count', 'created_at')
+        )
+        turns, total = _trim(turns, room)
+        first_streaming = (
+            _history(conversation, marker).filter(status=Message.STREAMING)
+            .order_by('created_at').values_list('created_at', flat=True).first()
+        )
+        cacheable = turns
+        if first_streaming is not None:
+            cutoff = first_streaming.isoformat()
+            cacheable = [turn for turn in turns if turn['created_at'] < cutoff]
+
+    timeout = getattr(settings, 'CHAT_SETTINGS', {}).get('CONTEXT_CACHE_TTL', 3600)
+    cache.set(key, {'summary': summary, 'turns': cacheable}, timeout)
+
+    if summary:
+        turns = [summary] + turns
+        total += _cost(summary)
+    logger.debug(f"Context for conversation {conversation.id}: {len(turns)} turns, {total} of {budget} tokens")
+    return _with_content(turns)
@@ -0,0 +1,231 @@
+"""
+Write-behind buffer for conversation counters.
+
+With CHAT_SETTINGS['COUNTER_WRITE_BEHIND'] enabled, appending a message
+does not touch the conversation row for message_count, total_tokens and
+last_activity. The deltas are accumulated in a Redis hash per conversation
+(HINCRBY is atomic, so concurrent writers never lose an increment) and the
+conversation id is added to a dirty set. The flush_conversation_counters
+Celery task applies the deltas to the database in batches.
+
+Readers call apply_pending() on the conversations they are about to
+serialize, so API responses include deltas that are not flushed yet.
+"""
+
+import asyncio
+import copy
+import logging
+import weakref
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.functions import Greatest
+
+logger = logging.getLogger('chat')
+
+KEY_PREFIX = 'chat:counters:'
+DIRTY_KEY = 'chat:counters:dirty'
+
+_async_clients = weakref.WeakKeyDictionary()
+
+# Subtracts exactly what a flush applied, so increments that arrived while the
+# flush was running stay buffered. The hash and its dirty-set entry are removed
+# only once nothing is left to flush.
+SETTLE_SCRIPT = """
+local messages = redis.call('HINCRBY', KEYS[1], 'message_count', -tonumber(ARGV[1]))
+local tokens = redis.call('HINCRBY', KEYS[1], 'total_tokens', -tonumber(ARGV[2]))
+if redis.call('HGET', KEYS[1], 'last_activity') == ARGV[3] then
+    redis.call('HDEL', KEYS[1], 'last_activity')
+end
+if messages == 0 and tokens == 0 and redis.call('HEXISTS', KEYS[1], 'last_activity') == 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[2], ARGV[4])
+    return 0
+end
+return 1
+"""
+
+
+def is_enabled():
+    """True when counters should be buffered in Redis"""
+    return bool(getattr(settings, 'CHAT_SETTINGS', {}).get('COUNTER_WRITE_BEHIND', False))
+
+
+def get_redis():
+    """Raw Redis client behind the default cache, or None if there is none"""
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+    except (ImportError, NotImplementedError):
+        return None
+    except Exception as e:
+        logger.warning(f"Counter buffer unavailable: {str(e)}")
+        return None
+
+
+def get_async_redis():
+    """
+    redis.asyncio client for the running loop, or None without Redis.
+
+    Async connections belong to the loop that opened them, so there is one
+    client per loop; it goes away with the loop.
+    """
+    if get_redis() is None:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        import redis.asyncio
+        client = redis.asyncio.from_url(settings.REDIS_URL)
+        _async_clients[loop] = client
+    return client
+
+
+def _key(conversation_id):
+    return f"{KEY_PREFIX}{conversation_id}"
+
+
+def _to_datetime(timestamp):
+    return datetime.fromtimestamp(float(timestamp), tz=dt_timezone.utc)
+
+
+def record(conversation_id, tokens, at, messages=1):
+    """
+    Buffer one message worth of counter deltas (`messages` is 0 when only
+    tokens are added to a message that was already counted).
+
+    Returns False when Redis is unreachable; the caller should then write
+    the counters to the database itself.
+    """
+    client = get_redis()
+    if client is None:
+        return False
+    key = _key(conversation_id)
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.hincrby(key, 'message_count', messages)
+        pipe.hincrby(key, 'total_tokens', tokens)
+        pipe.hset(key, 'last_activity', repr(at.timestamp()))
+        pipe.sadd(DIRTY_KEY, str(conversation_id))
+        pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"Counter buffering failed for conversation {conversation_id}: {str(e)}")
+        return False
+
+
+def _parse(raw):
+    values = {key.decode() if isinstance(key, bytes) else key: value for key, value in raw.items()}
+    delta = {
+        'message_count': int(values.get('message_count', 0)),
+        'total_tokens': int(values.get('total_tokens', 0)),
+        'last_activity': None,
+        'raw_last_activity': values.get('last_activity'),
+    }
+    if delta['raw_last_activity'] is not None:
+        delta['last_activity'] = _to_datetime(delta['raw_last_activity'])
+    return delta
+
+
+def pending(conversation_ids):
+    """Unflushed deltas keyed by conversation id, one round trip for the lot"""
+    conversation_ids = [str(conversation_id) for conversation_id in conversation_ids]
+    client = get_redis() if conversation_ids else None
+    if client is None:
+        return {}
+    try:
+        pipe = client.pipeline(transaction=False)
+        for conversation_id in conversation_ids:
+            pipe.hgetall(_key(conversation_id))
+        results = pipe.execute()
+    except Exception as e:
+        logger.warning(f"Reading buffered counters failed: {str(e)}")
+        return {}
+    return {
+        conversation_id: _parse(raw)
+        for conversation_id, raw in zip(conversation_ids, results)
+        if raw
+    }
+
+
+def apply_pending(conversations):
+    """
+    Return the conversations with unflushed deltas merged in.
+
+    Conversations that have pending deltas are replaced by copies, so a
+    later save() of the original instance can never write a merged value
+    back and count it twice.
+    """
+    conversations = list(conversations)
+    todo = [c for c in conversations if not getattr(c, '_pending_applied', False)]
+    if not todo or not is_enabled():
+        return conversations
+    deltas = pending(conversation.id for conversation in todo)
+    merged = []
+    for conversation in conversations:
+        delta = deltas.get(str(conversation.id))
+        if delta and not getattr(conversation, '_pending_applied', False):
+            conversation = copy.copy(conversation)
+            conversation._pending_applied = True
+            conversation.message_count += delta['message_count']
+            conversation.total_tokens += delta['total_tokens']
+            if delta['last_activity'] and delta['last_activity'] > conversation.last_activity:
+                conversation.last_activity = delta['last_activity']
+                conversation.updated_at = max(conversation.updated_at, delta['last_activity'])
+        merged.append(conversation)
+    return merged
+
+
+def flush(batch_size=500):
+    """
+    Apply buffered deltas to the database in batches.
+
+    Each batch is written in one transaction; the Redis side is settled only
+    after it commits. Returns the number of conversations flushed.
+    """
+    from .models import Conversation
+
+    client = get_redis()
+    if client is None:
+        return 0
+
+    flushed = 0
+    cursor = 0
+    while True:
+        cursor, members = client.sscan(DIRTY_KEY, cursor=cursor, count=batch_size)
+        conversation_ids = [m.decode() if isinstance(m, bytes) else m for m in members]
+        if conversation_ids:
+            deltas = pending(conversation_ids)
+            with transaction.atomic():
+                for conversation_id, delta in deltas.items():
+                    updates = {
+                        'message_count': models.F('message_count') + delta['message_count'],
+                        'total_tokens': models.F('total_tokens') + delta['total_tokens'],
+                    }
+                    if delta['last_activity']:
+                        # Greatest keeps a newer timestamp written by a synchronous path
+                        updates['last_activity'] = Greatest('last_activity', models.Value(delta['last_activity']))
+                        updates['updated_at'] = Greatest('updated_at', models.Value(delta['last_activity']))
+                    Conversation.objects.filter(pk=conversation_id).update(**updates)
+
+            settle = client.register_script(SETTLE_SCRIPT)
+            pipe = client.pipeline(transaction=False)
+            for conversation_id in conversation_ids:
+                # A dirty entry without a hash settles with zero deltas and is dropped
+                delta = deltas.get(conversation_id) or _parse({})
+                settle(
+                    keys=[_key(conversation_id), DIRTY_KEY],
+                    args=[
+                        delta['message_count'],
+                        delta['total_tokens'],
+                        delta['raw_last_activity'] or '',
+                        conversation_id,
+                    ],
+                    client=pipe,
+                )
+            pipe.execute()
+            flushed += len(deltas)
+        if cursor == 0:
+            break
+    return flushed
@@ -0,0 +1,432 @@
+"""
+Process-wide key ring for encrypted message storage
+"""
+
+import base64
+import hashlib
+import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+logger = logging.getLogger('chat')
+
+# Stored values written by the key ring look like "fk1$<key id>$<fernet token>"
+VALUE_PREFIX = 'fk1$'
+
+# Values written before the key ring existed are base64 of a Fernet token,
+# and every Fernet token starts with the version byte 0x80 ("gAAAAA...").
+LEGACY_PREFIX = 'Z0FBQUFB'
+
+
+# Binary envelope: magic, format version, flags, 4-byte key id, then the raw
+# (not base64) Fernet token. The plaintext inside the token may be compressed.
+ENVELOPE_MAGIC = 0xE7
+ENVELOPE_VERSION = 1
+ENVELOPE_HEADER = struct.Struct('>BBB4s')
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+
+
+class UnreadableValue(ValueError):
+    """Stored ciphertext that no key in the ring can decrypt"""
+
+
+def key_id_for(key):
+    """Short, stable fingerprint used to tag values with the key that wrote them"""
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).hexdigest()[:8]
+
+
+class KeyRing:
+    """
+    Cached Fernet ciphers for the primary key and any retired keys.
+
+    New values are always written with the primary key. Values written with a
+    retired key stay readable until they are rotated.
+    """
+
+    def __init__(self, primary_key, retired_keys=()):
+        keys = [primary_key] + [key for key in retired_keys if key and key != primary_key]
+        self.keys = [key.encode('utf-8') if isinstance(key, str) else key for key in keys]
+        self.ciphers = {key_id_for(key): Fernet(key) for key in self.keys}
+        self.primary_id = key_id_for(self.keys[0])
+        self.primary = self.ciphers[self.primary_id]
+        self.multi = MultiFernet([self.ciphers[key_id_for(key)] for key in self.keys])
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset encrypt/decrypt counters and timings"""
+        with self._lock:
+            self._stats = {
+                'encrypt_count': 0,
+                'encrypt_seconds': 0.0,
+                'decrypt_count': 0,
+                'decrypt_seconds': 0.0,
+                'decrypt_failures': 0,
+                'legacy_reads': 0,
+                'plaintext_reads': 0,
+                'reads_by_key': {},
+                'bulk_batches': 0,
+                'bulk_seconds': 0.0,
+            }
+
+    def get_stats(self):
+        """Snapshot of encrypt/decrypt counters and timings"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['reads_by_key'] = dict(self._stats['reads_by_key'])
+        stats['primary_key_id'] = self.primary_id
+        stats['key_ids'] = list(self.ciphers)
+        return stats
+
+    def _record(self, name, elapsed, key_id=None):
+        with self._lock:
+            self._stats[f'{name}_count'] += 1
+            self._stats[f'{name}_seconds'] += elapsed
+            if key_id:
+                reads = self._stats['reads_by_key']
+                reads[key_id] = reads.get(key_id, 0) + 1
+
+    def _bump(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def encrypt(self, plaintext):
+        """Encrypt text with the primary key and tag it with the key id"""
+        start = time.perf_counter()
+        token = self.primary.encrypt(plaintext.encode('utf-8'))
+        value = f"{VALUE_PREFIX}{self.primary_id}${token.decode('ascii')}"
+        self._record('encrypt', time.perf_counter() - start)
+        return value
+
+    def seal(self, plaintext):
+        """Encrypt text into a binary envelope, compressing large bodies first"""
+        start = time.perf_counter()
+        data = plaintext.encode('utf-8')
+        flags = 0
+        chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+        method = chat_settings.get('CONTENT_COMPRESSION', 'zlib')
+        if method != 'off' and len(data) >= chat_settings.get('CONTENT_COMPRESSION_THRESHOLD', 1024):
+            if method == 'zstd' and zstandard is not None:
+                compressed, flag = zstandard.ZstdCompressor(level=3).compress(data), FLAG_ZSTD
+            else:
+                compressed, flag = zlib.compress(data, 6), FLAG_ZLIB
+            # Incompressible text (already-compressed pastes) is stored as-is
+            if len(compressed) < len(data):
+                data, flags = compressed, flag
+        token = base64.urlsafe_b64decode(self.primary.encrypt(data))
+        header = ENVELOPE_HEADER.pack(
+            ENVELOPE_MAGIC, ENVELOPE_VERSION, flags, bytes.fromhex(self.primary_id)
+        )
+        self._record('encrypt', time.perf_counter() - start)
+        return header + token
+
+    def open(self, envelope):
+        """
+        Decrypt a binary envelope written by seal().
+
+        Raises UnreadableValue when the envelope is malformed, was written
+        with a key that is not in the ring, or needs zstandard to inflate.
+        """
+        envelope = bytes(envelope)
+        if len(envelope) < ENVELOPE_HEADER.size:
+            self._bump('decrypt_failures')
+            raise UnreadableValue(f"Message envelope too short ({len(envelope)} bytes)")
+        magic, version, flags, raw_key_id = ENVELOPE_HEADER.unpack_from(envelope)
+        key_id = raw_key_id.hex()
+        cipher = self.ciphers.get(key_id)
+        if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION or cipher is None:
+            self._bump('decrypt_failures')
+            logger.warning(f"Unreadable message envelope (version {version}, key id {key_id})")
+            raise UnreadableValue(f"Unreadable message envelope (version {version}, key id {key_id})")
+        if flags & FLAG_ZSTD and zstandard is None:
+            self._bump('decrypt_failures')
+            raise UnreadableValue("Message envelope is zstd-compressed but zstandard is not installed")
+        start = time.perf_counter()
+        try:
+            data = cipher.decrypt(base64.urlsafe_b64encode(envelope[ENVELOPE_HEADER.size:]))
+        except InvalidToken:
+            self._bump('decrypt_failures')
+            raise UnreadableValue(f"Message envelope does not match key id {key_id}")
+        if flags & FLAG_ZLIB:
+            data = zlib.decompress(data)
+        elif flags & FLAG_ZSTD:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        self._record('decrypt', time.perf_counter() - start, key_id)
+        return data.decode('utf-8')
+
+    def decrypt(self, value):
+        """
+        Decrypt a stored value: a binary envelope, a tagged text token, or a
+        legacy base64 token.
+
+        Text that is not ciphertext (rows written while encryption was
+        disabled) is returned unchanged. Ciphertext that no key in the ring
+        can read raises UnreadableValue, so it is never mistaken for plaintext.
+        """
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.open(value)
+
+        if value.startswith(VALUE_PREFIX):
+            key_id, _, token = value[len(VALUE_PREFIX):].partition('$')
+            cipher = self.ciphers.get(key_id)
+            if cipher is None:
+                self._bump('decrypt_failures')
+                logger.warning(f"No encryption key with id {key_id} in key ring")
+                raise UnreadableValue(f"No encryption key with id {key_id} in key ring")
+            start = time.perf_counter()
+            try:
+                plaintext = cipher.decrypt(token.encode('ascii'))
+            except InvalidToken:
+                self._bump('decrypt_failures')
+                raise UnreadableValue(f"Value does not match key id {key_id}")
+            self._record('decrypt', time.perf_counter() - start, key_id)
+            return plaintext.decode('utf-8')
+
+        if value.startswith(LEGACY_PREFIX):
+            start = time.perf_counter()
+            try:
+                plaintext = self.multi.decrypt(base64.b64decode(value))
+            except (InvalidToken, ValueError):
+                self._bump('decrypt_failures')
+                raise UnreadableValue("No key in the ring can read legacy value")
+            self._record('decrypt', time.perf_counter() - start)
+            self._bump('legacy_reads')
+            return plaintext.decode('utf-8')
+
+        self._bump('plaintext_reads')
+        return value
+
+    def decrypt_or_none(self, value):
+        """Decrypt a stored value, or None when it is unreadable"""
+        try:
+            return self.decrypt(value)
+        except UnreadableValue:
+            return None
+
+    def decrypt_many(self, values):
+        """
+        Decrypt a page of stored values, returning plaintexts in order.
+        Values that cannot be decrypted come back as None.
+
+        Large pages are split into chunks and handed to the shared decrypt
+        pool; small ones are decrypted inline since the hand-off would cost
+        more than it saves.
+        """
+        return self._map_pooled(values, self.decrypt_or_none, _decrypt_chunk_in_worker, 'decrypt_count')
+
+    def seal_many(self, plaintexts):
+        """Seal a batch of plaintexts into envelopes, in order, using the same pool"""
+        return self._map_pooled(plaintexts, self.seal, _seal_chunk_in_worker, 'encrypt_count')
+
+    def _map_pooled(self, values, func, worker_func, count_stat):
+        values = list(values)
+        min_batch = getattr(settings, 'CHAT_SETTINGS', {}).get('BULK_DECRYPT_MIN_BATCH', 64)
+        start = time.perf_counter()
+        pool = get_decrypt_pool() if len(values) >= min_batch else None
+        if pool is None:
+            results = [func(value) for value in values]
+        else:
+            executor, workers = pool
+            chunk_size = max(1, -(-len(values) // (workers * 2)))
+            chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+            if isinstance(executor, ProcessPoolExecutor):
+                # Worker processes keep their own counters, so count here
+                chunked = executor.map(worker_func, chunks)
+                with self._lock:
+                    self._stats[count_stat] += len(values)
+            else:
+                chunked = executor.map(lambda chunk: [func(value) for value in chunk], chunks)
+            results = [result for chunk in chunked for result in chunk]
+        with self._lock:
+            self._stats['bulk_batches'] += 1
+            self._stats['bulk_seconds'] += time.perf_counter() - start
+        return results
+
+    def key_id_of(self, value):
+        """Key id a stored value was written with, or None if it is untagged"""
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+            if len(value) >= ENVELOPE_HEADER.size:
+                return ENVELOPE_HEADER.unpack_from(value)[3].hex()
+            return None
+        if value and value.startswith(VALUE_PREFIX):
+            return value[len(VALUE_PREFIX):].partition('$')[0]
+        return None
+
+    def needs_rotation(self, value):
+        """True if the value is not tagged with the primary key"""
+        return bool(value) and self.key_id_of(value) != self.primary_id
+
+    def rotate(self, value):
+        """
+        Re-encrypt a stored value with the primary key as a binary envelope.
+
+        Raises UnreadableValue rather than sealing ciphertext it cannot read.
+        """
+        if not self.needs_rotation(value):
+            return value
+        return self.seal(self.decrypt(value))
+
+
+class Ciphertext:
+    """
+    Stored value loaded from the database but not decrypted yet.
+
+    Encrypted fields hand these out from from_db_value; the field descriptor
+    decrypts on first attribute access and caches the plaintext on the model
+    instance. Saving an instance whose value was never read, or could not be
+    decrypted, writes the stored value back unchanged.
+    """
+
+    __slots__ = ('stored',)
+
+    def __init__(self, stored):
+        self.stored = stored
+
+    def decrypt(self):
+        """Plaintext of the stored value; raises UnreadableValue"""
+        return get_key_ring().decrypt(self.stored)
+
+    def __str__(self):
+        try:
+            return self.decrypt()
+        except UnreadableValue:
+            return ''
+
+    def __repr__(self):
+        return f"<Ciphertext length={len(self.stored)}>"
+
+    def __eq__(self, other):
+        if isinstance(other, Ciphertext):
+            return self.stored == other.stored
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.stored)
+
+
+_key_ring = None
+_key_ring_lock = threading.Lock()
+
+
+def derive_fallback_key():
+    """Stable Fernet key derived from SECRET_KEY, used when ENCRYPTION_KEY is unset"""
+    digest = hashlib.sha256(f"chat.encryption:{settings.SECRET_KEY}".encode('utf-8')).digest()
+    return base64.urlsafe_b64encode(digest)
+
+
+def get_key_ring():
+    """Return the process-wide key ring, building it on first use"""
+    global _key_ring
+    if _key_ring is None:
+        with _key_ring_lock:
+            if _key_ring is None:
+                primary = getattr(settings, 'ENCRYPTION_KEY', None)
+                if not primary:
+                    logger.warning("ENCRYPTION_KEY is not set; deriving a message key from SECRET_KEY")
+                    primary = derive_fallback_key()
+                retired = getattr(settings, 'ENCRYPTION_RETIRED_KEYS', None) or []
+                _key_ring = KeyRing(primary, retired)
+    return _key_ring
+
+
+_decrypt_pool = None
+_decrypt_pool_lock = threading.Lock()
+_worker_key_ring = None
+
+
+def _init_decrypt_worker(keys):
+    """Build the key ring once per pool process"""
+    global _worker_key_ring
+    _worker_key_ring = KeyRing(keys[0], keys[1:])
+
+
+def _decrypt_chunk_in_worker(values):
+    return [_worker_key_ring.decrypt_or_none(value) for value in values]
+
+
+def _seal_chunk_in_worker(plaintexts):
+    return [_worker_key_ring.seal(plaintext) for plaintext in plaintexts]
+
+
+def get_decrypt_pool():
+    """
+    Return the process-wide (executor, workers) pair used by
+    KeyRing.decrypt_many, or None when pooling is disabled.
+
+    BULK_DECRYPT_POOL selects 'thread' (the default), 'process' or 'off'.
+    Processes are opt-in: each one is a spawned interpreter holding a copy
+    of the keys, which only pays off for very large pages on spare cores.
+    Daemonic processes such as Celery prefork workers cannot start
+    children, so they fall back to threads.
+    """
+    global _decrypt_pool
+    if _decrypt_pool is None:
+        with _decrypt_pool_lock:
+            if _decrypt_pool is None:
+                chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+                kind = chat_settings.get('BULK_DECRYPT_POOL', 'thread')
+                workers = chat_settings.get('BULK_DECRYPT_WORKERS') or os.cpu_count() or 1
+                if kind == 'off' or workers < 2:
+                    return None
+                if kind == 'process' and multiprocessing.current_process().daemon:
+                    kind = 'thread'
+                if kind == 'process':
+                    executor = ProcessPoolExecutor(
+                        max_workers=workers,
+                        mp_context=multiprocessing.get_context('spawn'),
+                        initializer=_init_decrypt_worker,
+                        initargs=(get_key_ring().keys,),
+                    )
+                else:
+                    executor = ThreadPoolExecutor(
+                        max_workers=workers, thread_name_prefix='decrypt'
+                    )
+                _decrypt_pool = (executor, workers)
+                logger.info(f"Started {kind} decrypt pool with {workers} workers")
+    return _decrypt_pool
+
+
+def shutdown_decrypt_pool():
+    """Stop the decrypt pool; the next bulk decrypt starts a fresh one"""
+    global _decrypt_pool
+    with _decrypt_pool_lock:
+        if _decrypt_pool is not None:
+            _decrypt_pool[0].shutdown(wait=False, cancel_futures=True)
+            _decrypt_pool = None
+
+
+def reset_key_ring():
+    """Drop the cached key ring (after changing key settings)"""
+    global _key_ring
+    with _key_ring_lock:
+        _key_ring = None
+    # Process workers hold a copy of the old keys
+    shutdown_decrypt_pool()
+
+
+@receiver(setting_changed)
+def reset_key_ring_on_setting_change(setting, **kwargs):
+    """Rebuild the key ring when key settings are overridden (tests)"""
+    if setting in ('ENCRYPTION_KEY', 'ENCRYPTION_RETIRED_KEYS', 'SECRET_KEY'):
+        reset_key_ring()
+    elif setting == 'CHAT_SETTINGS':
+        shutdown_decrypt_pool()
@@ -0,0 +1,202 @@
+"""
+NDJSON export and import of conversations.
+
+An export is one JSON object per line: a header, then every conversation,
+then every message (decrypted, in conversation and creation order), then
+file metadata. Rows are read with server-side iterators and decrypted in
+batches, so memory stays flat however large the export is. The importer
+reads the same format and writes it back with bulk_create, sealing each
+batch of message bodies in one call.
+"""
+
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .cache_keys import invalidate_user
+from .encryption import Ciphertext, get_key_ring
+from .models import Conversation, FileUpload, Message, decrypt_all
+
+FORMAT_VERSION = 1
+
+CONVERSATION_FIELDS = [
+    'id', 'user_id', 'title', 'metadata', 'message_count', 'total_tokens',
+    'last_activity', 'model_config', 'is_archived', 'is_shared',
+    'created_at', 'updated_at',
+]
+MESSAGE_FIELDS = [
+    'id', 'conversation_id', 'role', 'content', 'model', 'token_count',
+    'response_time', 'metadata', 'status', 'is_edited', 'is_deleted', 'error_message',
+    'created_at', 'updated_at',
+]
+FILE_FIELDS = [
+    'id', 'conversation_id', 'message_id', 'original_filename', 'file_path',
+    'file_size', 'content_type', 'file_hash', 'is_processed',
+    'processing_error', 'extracted_content', 'metadata', 'created_at', 'updated_at',
+]
+
+# Import order: every record only references kinds that come before it
+KINDS = [
+    ('conversation', Conversation, CONVERSATION_FIELDS),
+    ('message', Message, MESSAGE_FIELDS),
+    ('file', FileUpload, FILE_FIELDS),
+]
+
+
+class InvalidExport(ValueError):
+    """Raised when an NDJSON export cannot be read"""
+
+
+class ExportEncoder(DjangoJSONEncoder):
+    """Keeps full microsecond timestamps so keyset ordering survives a round trip"""
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def _dumps(record):
+    return json.dumps(record, cls=ExportEncoder, separators=(',', ':')) + '\n'
+
+
+def _line(kind, instance, fields):
+    record = {'type': kind}
+    for name in fields:
+        record[name] = getattr(instance, name)
+    return _dumps(record)
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_export(conversations, batch_size=1000):
+    """
+    Yield NDJSON lines for a Conversation queryset and everything in it
+    """
+    yield _dumps({
+        'type': 'header',
+        'version': FORMAT_VERSION,
+        'exported_at': timezone.now(),
+    })
+
+    conversation_ids = conversations.values('pk')
+    for conversation in conversations.order_by('created_at', 'id').iterator(chunk_size=batch_size):
+        yield _line('conversation', conversation, CONVERSATION_FIELDS)
+
+    messages = (
+        Message.objects.filter(conversation__in=conversation_ids)
+        .order_by('conversation_id', 'created_at', 'id')
+        .iterator(chunk_size=batch_size)
+    )
+    for batch in _batched(messages, batch_size):
+        for message in decrypt_all(batch):
+            yield _line('message', message, MESSAGE_FIELDS)
+
+    files = FileUpload.objects.filter(conversation__in=conversation_ids).order_by('created_at', 'id')
+    for upload in files.iterator(chunk_size=batch_size):
+        yield _line('file', upload, FILE_FIELDS)
+
+
+def _stamped_fields(model):
+    """Timestamp fields that bulk_create fills in with now()"""
+    return [
+        field.attname for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+
+
+def _restore_timestamps(model, objects, records, batch_size):
+    """
+    Write the exported created_at/updated_at/last_activity back over the
+    now() stamped by bulk_create, without touching the shared field options
+    """
+    fields = [name for name in _stamped_fields(model) if any(name in record for record in records)]
+    if not fields:
+        return
+    for instance, record in zip(objects, records):
+        for name in fields:
+            if name in record:
+                setattr(instance, name, model._meta.get_field(name).to_python(record[name]))
+    model.objects.bulk_update(objects, fields, batch_size=batch_size)
+
+
+def import_records(lines, batch_size=1000, user_id=None, skip_existing=False):
+    """
+    Import NDJSON lines produced by iter_export.
+
+    `user_id` reassigns every conversation to that user. With
+    `skip_existing`, rows whose primary key already exists are left alone.
+    Returns a dict of records written per type.
+    """
+    key_ring = get_key_ring()
+    pending = {kind: [] for kind, _, _ in KINDS}
+    counts = {kind: 0 for kind, _, _ in KINDS}
+    users = set()
+
+    def flush(upto):
+        # Flush earlier kinds first so foreign keys always point at written rows
+        for kind, model, fields in KINDS:
+            records = pending[kind]
+            if records and skip_existing:
+                existing = {
+                    str(pk) for pk in
+                    model.objects.filter(pk__in=[record['id'] for record in records]).values_list('pk', flat=True)
+                }
+                records = [record for record in records if str(record['id']) not in existing]
+            if records:
+                if kind == 'message':
+                    envelopes = key_ring.seal_many(record.pop('content') or '' for record in records)
+                    for record, envelope in zip(records, envelopes):
+                        record['content'] = Ciphertext(envelope)
+                objects = [model(**record) for record in records]
+                model.objects.bulk_create(objects, batch_size=batch_size)
+                _restore_timestamps(model, objects, records, batch_size)
+                counts[kind] += len(records)
+            pending[kind] = []
+            if kind == upto:
+                break
+
+    fields_by_kind = {kind: set(fields) for kind, _, fields in KINDS}
+    with transaction.atomic():
+        for number, line in enumerate(lines, start=1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record.pop('type')
+            except (ValueError, KeyError):
+                raise InvalidExport(f"Line {number} is not an export record")
+            if kind == 'header':
+                if record.get('version') != FORMAT_VERSION:
+                    raise InvalidExport(f"Unsupported export version {record.get('version')}")
+                continue
+            if kind not in pending:
+                raise InvalidExport(f"Line {number} has unknown record type '{kind}'")
+
+            record = {name: value for name, value in record.items() if name in fields_by_kind[kind]}
+            if kind == 'conversation':
+                if user_id:
+                    record['user_id'] = user_id
+                users.add(record['user_id'])
+            pending[kind].append(record)
+            if len(pending[kind]) >= batch_size:
+                flush(kind)
+        flush(KINDS[-1][0])
+
+    for owner in users:
+        invalidate_user(owner)
+    return counts
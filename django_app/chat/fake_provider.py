@@ -0,0 +1,125 @@
+"""
+Local stand-in for the OpenRouter chat completions API.
+
+Used by benchmarks and tests: it answers POST /chat/completions with a
+canned reply, streamed as OpenAI-style SSE chunks with a fixed delay
+between them, and records how many streams it served concurrently.
+Point OPENROUTER_BASE_URL at ``provider.base_url`` to use it.
+"""
+
+import asyncio
+import json
+import threading
+import time
+
+from aiohttp import web
+
+
+class FakeProvider:
+    """
+    OpenAI-compatible chat completions server running on a background loop
+    """
+
+    def __init__(self, chunks=20, delay=0.05, text='lorem ipsum '):
+        self.chunks = chunks
+        self.delay = delay
+        self.text = text
+        self.requests = 0
+        self.active = 0
+        self.peak = 0
+        self.base_url = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def reply(self, request_body):
+        """Text the provider answers with; override for canned replies"""
+        return [self.text] * self.chunks
+
+    async def handle_completion(self, request):
+        body = await request.json()
+        self.requests += 1
+        parts = self.reply(body)
+        model = body.get('model', 'fake/model')
+        created = int(time.time())
+        usage = {
+            'prompt_tokens': sum(len(m.get('content') or '') for m in body.get('messages', [])) // 4,
+            'completion_tokens': len(parts),
+        }
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+
+        if not body.get('stream'):
+            await asyncio.sleep(self.delay * len(parts))
+            return web.json_response({
+                'id': f'fake-{self.requests}',
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(parts)},
+                    'finish_reason': 'stop',
+                }],
+                'usage': usage,
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            for index, part in enumerate(parts):
+                await asyncio.sleep(self.delay)
+                chunk = {
+                    'id': f'fake-{self.requests}',
+                    'object': 'chat.completion.chunk',
+                    'created': created,
+                    'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': part}, 'finish_reason': None}],
+                }
+                if index == len(parts) - 1:
+                    chunk['choices'][0]['finish_reason'] = 'stop'
+                    chunk['usage'] = usage
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await response.write(b"data: [DONE]\n\n")
+        finally:
+            self.active -= 1
+        return response
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve on a background thread and return self once listening"""
+        ready = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            app = web.Application()
+            app.router.add_post('/chat/completions', self.handle_completion)
+            self._runner = web.AppRunner(app)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, host, port, backlog=2048)
+            self._loop.run_until_complete(site.start())
+            bound_port = site._server.sockets[0].getsockname()[1]
+            self.base_url = f"http://{host}:{bound_port}"
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name='fake-provider', daemon=True)
+        self._thread.start()
+        ready.wait(10)
+        return self
+
+    def stop(self):
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result(10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(10)
+        self._loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,235 @@
+"""
+Pooled, long-lived OpenAI-compatible clients for the upstream LLM API.
+
+Building an ``openai`` client creates an httpx client, loads the system CA
+bundle and starts with an empty connection pool, so every request that
+builds its own client pays for certificate loading plus a fresh TCP+TLS
+handshake. This module keeps one keep-alive client per
+(API key, base URL, kind), keyed by a hash of the key so raw keys are never
+held as dict keys or logged. Clients share one SSL context, are capped per
+host by httpx limits, are dropped after sitting idle, and the number of
+distinct keys is bounded with LRU eviction. Eviction only drops the pool's
+reference: a stream still reading from an evicted client keeps it open,
+and its connections are closed once the last reference goes away.
+
+Async clients are tied to the event loop they were created on; a client is
+only reused on that loop (one per process under ASGI). Celery and other sync
+callers use sync clients.
+"""
+
+import asyncio
+import hashlib
+import logging
+import ssl
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+import openai
+from django.conf import settings
+
+logger = logging.getLogger('chat')
+
+ASYNC = 'async'
+SYNC = 'sync'
+
+_lock = threading.Lock()
+_clients = OrderedDict()
+_ssl_context = None
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evicted_idle': 0,
+    'evicted_lru': 0,
+    'requests': 0,
+    'new_connections': 0,
+}
+
+
+class PooledClient:
+    """
+    One cached client and the loop it belongs to
+    """
+    __slots__ = ('client', 'loop', 'last_used')
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.last_used = time.monotonic()
+
+
+def _pool_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return {
+        'max_keys': chat_settings.get('LLM_POOL_MAX_KEYS', 256),
+        'idle_seconds': chat_settings.get('LLM_POOL_IDLE_SECONDS', 300),
+        'max_connections': chat_settings.get('LLM_MAX_CONNECTIONS', 500),
+        'max_keepalive': chat_settings.get('LLM_MAX_KEEPALIVE', 50),
+        'keepalive_expiry': chat_settings.get('LLM_KEEPALIVE_EXPIRY', 60),
+        'timeout': chat_settings.get('LLM_TIMEOUT', 120),
+    }
+
+
+def key_fingerprint(api_key):
+    """Stable, non-reversible identifier for an API key"""
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+def _get_ssl_context():
+    # Loading the CA bundle is the expensive part of building a client; do it once
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+def _count(name, amount=1):
+    with _lock:
+        _stats[name] += amount
+
+
+def _trace_sync(event_name, info):
+    if event_name == 'connection.connect_tcp.complete':
+        _count('new_connections')
+
+
+async def _trace_async(event_name, info):
+    _trace_sync(event_name, info)
+
+
+def _on_request_sync(request):
+    _count('requests')
+    request.extensions['trace'] = _trace_sync
+
+
+async def _on_request_async(request):
+    _count('requests')
+    request.extensions['trace'] = _trace_async
+
+
+def _close_http_client(http_client, loop):
+    try:
+        if isinstance(http_client, httpx.AsyncClient):
+            if loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(lambda: loop.create_task(http_client.aclose()))
+        else:
+            http_client.close()
+    except Exception as e:
+        logger.debug(f"Closing pooled LLM client failed: {str(e)}")
+
+
+def _build(kind, api_key, base_url, options, loop=None):
+    limits = httpx.Limits(
+        max_connections=options['max_connections'],
+        max_keepalive_connections=options['max_keepalive'],
+        keepalive_expiry=options['keepalive_expiry'],
+    )
+    timeout = httpx.Timeout(options['timeout'], connect=10.0)
+    if kind == ASYNC:
+        http_client = httpx.AsyncClient(
+            limits=limits, timeout=timeout, verify=_get_ssl_context(),
+            event_hooks={'request': [_on_request_async]},
+        )
+        client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    else:
+        http_client = httpx.Client(
+            limits=limits, timeout=timeout, verify=_get_ssl_context(),
+            event_hooks={'request': [_on_request_sync]},
+        )
+        client = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    # Closed when nothing uses the client any more, not when the pool drops it
+    weakref.finalize(client, _close_http_client, http_client, loop)
+    return client
+
+
+def _close(entry):
+    """Close a client right away, without blocking the caller (shutdown only)"""
+    _close_http_client(entry.client._client, entry.loop)
+
+
+def _evict(now, options):
+    """
+    Drop idle clients and clients whose loop has gone; caller holds the lock.
+
+    Evicted clients are not closed here, since a request or stream may still
+    be using one; see _build.
+    """
+    for cache_key, entry in list(_clients.items()):
+        loop_gone = entry.loop is not None and entry.loop.is_closed()
+        if loop_gone or now - entry.last_used > options['idle_seconds']:
+            del _clients[cache_key]
+            _stats['evicted_idle'] += 1
+    while len(_clients) > options['max_keys']:
+        _clients.popitem(last=False)
+        _stats['evicted_lru'] += 1
+
+
+def _get(kind, api_key, base_url):
+    base_url = base_url or settings.OPENROUTER_BASE_URL
+    loop = None
+    if kind == ASYNC:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+    cache_key = (kind, key_fingerprint(api_key), base_url, id(loop) if loop else None)
+    options = _pool_settings()
+    now = time.monotonic()
+
+    with _lock:
+        entry = _clients.get(cache_key)
+        if entry is not None and entry.loop is loop and not (loop and loop.is_closed()):
+            _clients.move_to_end(cache_key)
+            entry.last_used = now
+            _stats['hits'] += 1
+            return entry.client
+        _stats['misses'] += 1
+
+    # Build outside the lock; a racing builder for the same key just loses
+    client = _build(kind, api_key, base_url, options, loop)
+    with _lock:
+        _clients[cache_key] = PooledClient(client, loop)
+        _clients.move_to_end(cache_key)
+        _evict(now, options)
+    return client
+
+
+def get_async_client(api_key, base_url=None):
+    """Shared AsyncOpenAI client for this key on the running event loop"""
+    return _get(ASYNC, api_key, base_url)
+
+
+def get_sync_client(api_key, base_url=None):
+    """Shared OpenAI client for this key, for Celery tasks and sync views"""
+    return _get(SYNC, api_key, base_url)
+
+
+def get_pool_stats():
+    """Pool hit/miss counts, evictions and connection reuse"""
+    with _lock:
+        stats = dict(_stats)
+        stats['clients'] = len(_clients)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    requests = stats['requests']
+    stats['connection_reuse_rate'] = (
+        max(requests - stats['new_connections'], 0) / requests if requests else 0.0
+    )
+    return stats
+
+
+def reset_pool_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def close_all():
+    """Drop and close every pooled client (tests, shutdown); nothing may be using them"""
+    with _lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    for entry in entries:
+        _close(entry)
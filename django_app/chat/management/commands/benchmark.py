@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = 'Run a chat performance benchmark against a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenario',
+            nargs='?',
+            help='Scenario to run (omit to list the available scenarios)',
+        )
+        parser.add_argument(
+            '--messages',
+            type=int,
+            default=None,
+            help='Number of messages to seed (default: set by the scenario)',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs per measurement; the best run is reported (default: 5)',
+        )
+        parser.add_argument(
+            '--keepdb',
+            action='store_true',
+            help='Reuse the benchmark database between runs',
+        )
+
+    def handle(self, *args, **options):
+        name = options['scenario']
+        if not name:
+            self.stdout.write('📊 Available scenarios:')
+            for key, func in sorted(SCENARIOS.items()):
+                self.stdout.write(f'• {key}: {func.help_text}')
+            return
+
+        if name not in SCENARIOS:
+            raise CommandError(f'Unknown scenario "{name}"')
+
+        # Never benchmark against real data
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, keepdb=options['keepdb']
+        )
+        sizing = {'repeat': options['repeat']}
+        if options['messages'] is not None:
+            sizing['messages'] = options['messages']
+        try:
+            SCENARIOS[name](self.stdout, **sizing)
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options['keepdb']
+            )
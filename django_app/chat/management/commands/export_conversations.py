@@ -0,0 +1,54 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from chat.exports import iter_export
+from chat.models import Conversation
+
+
+class Command(BaseCommand):
+    help = 'Export conversations, messages and file metadata as NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            help='Only export conversations owned by this user id',
+        )
+        parser.add_argument(
+            '--conversation',
+            action='append',
+            default=[],
+            help='Only export this conversation id (may be repeated)',
+        )
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='File to write to (default: stdout)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows fetched and decrypted per batch (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        conversations = Conversation.objects.all()
+        if options['user']:
+            conversations = conversations.filter(user_id=options['user'])
+        if options['conversation']:
+            conversations = conversations.filter(pk__in=options['conversation'])
+
+        output = options['output']
+        stream = sys.stdout if output == '-' else open(output, 'w', encoding='utf-8')
+        lines = 0
+        try:
+            for line in iter_export(conversations, batch_size=options['batch_size']):
+                stream.write(line)
+                lines += 1
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        if output != '-':
+            self.stdout.write(self.style.SUCCESS(f'✅ Wrote {lines - 1} records to {output}'))
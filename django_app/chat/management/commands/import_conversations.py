@@ -0,0 +1,53 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.exports import InvalidExport, import_records
+
+
+class Command(BaseCommand):
+    help = 'Import conversations from an NDJSON export in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='NDJSON file written by export_conversations ("-" for stdin)',
+        )
+        parser.add_argument(
+            '--user',
+            help='Assign every imported conversation to this user id',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows encrypted and inserted per batch (default: 1000)',
+        )
+        parser.add_argument(
+            '--skip-existing',
+            action='store_true',
+            help='Leave rows that already exist untouched instead of failing',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        try:
+            counts = import_records(
+                stream,
+                batch_size=options['batch_size'],
+                user_id=options['user'],
+                skip_existing=options['skip_existing'],
+            )
+        except InvalidExport as e:
+            raise CommandError(str(e))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"✅ Imported {counts['conversation']} conversations, "
+                f"{counts['message']} messages and {counts['file']} files"
+            )
+        )
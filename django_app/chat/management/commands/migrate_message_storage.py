@@ -0,0 +1,101 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.encryption import Ciphertext, get_key_ring
+from chat.models import Message, decrypt_all
+
+
+class Command(BaseCommand):
+    help = 'Rewrite legacy text-encrypted messages into the binary envelope column, in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of messages rewritten per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.0,
+            help='Seconds to pause between batches to limit load (default: 0)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=0,
+            help='Stop after this many messages (default: no limit)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the messages that still use the legacy column',
+        )
+
+    def handle(self, *args, **options):
+        legacy_rows = Message.objects.filter(content__isnull=True, content_legacy__isnull=False)
+        remaining = legacy_rows.count()
+        self.stdout.write(f'📦 {remaining} messages still use the legacy text column')
+        if options['dry_run'] or not remaining:
+            return
+
+        key_ring = get_key_ring()
+        batch_size = options['batch_size']
+        limit = options['limit']
+        migrated = 0
+        unreadable = []
+        bytes_before = 0
+        bytes_after = 0
+        last_pk = None
+
+        while not limit or migrated < limit:
+            size = min(batch_size, limit - migrated) if limit else batch_size
+            with transaction.atomic():
+                # Walk by primary key so each batch is a short index range scan
+                batch = legacy_rows.order_by('pk').select_for_update()
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                messages = list(batch.only('pk', 'content', 'content_legacy')[:size])
+                if not messages:
+                    break
+                bytes_before += sum(len(m.__dict__['content_legacy'].stored) for m in messages)
+                decrypt_all(messages)
+                last_pk = messages[-1].pk
+                readable = []
+                for message in messages:
+                    if isinstance(message.__dict__['content_legacy'], Ciphertext):
+                        # No key in the ring can read it; leave the row as it is
+                        unreadable.append(message.pk)
+                        continue
+                    # Seal once and hand the field the finished envelope
+                    envelope = key_ring.seal(message.content)
+                    bytes_after += len(envelope)
+                    message.content = Ciphertext(envelope)
+                    message.content_legacy = None
+                    readable.append(message)
+                Message.objects.bulk_update(readable, ['content', 'content_legacy'])
+            migrated += len(readable)
+            self.stdout.write(f'   … {migrated}/{remaining}')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        # Rows whose content was rewritten by a normal save but still carry a copy
+        stale = Message.objects.filter(
+            content__isnull=False, content_legacy__isnull=False
+        ).update(content_legacy=None)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'✅ Migrated {migrated} messages '
+                f'({bytes_before} → {bytes_after} bytes of ciphertext), '
+                f'cleared {stale} stale legacy copies'
+            )
+        )
+        if unreadable:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️  Skipped {len(unreadable)} messages no key in the ring can decrypt: '
+                + ', '.join(str(pk) for pk in unreadable)
+            ))
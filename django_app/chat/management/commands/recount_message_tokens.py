@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
+
+from chat.models import Conversation, Message, decrypt_all
+from chat.tokenizer import backend, count_many
+
+
+class Command(BaseCommand):
+    help = 'Recount stored message token counts with the tokenizer and refresh conversation totals'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of messages counted and updated per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many counts would change',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        self.stdout.write(f'🔢 Tokenizer backend: {backend()}')
+
+        scanned = 0
+        changed = 0
+        last_pk = None
+        while True:
+            batch = Message.objects.order_by('pk').only('pk', 'content', 'content_legacy', 'model', 'token_count')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            messages = decrypt_all(list(batch[:batch_size]))
+            if not messages:
+                break
+            last_pk = messages[-1].pk
+            scanned += len(messages)
+            changed += self.recount_batch(messages, options['dry_run'])
+
+        if not options['dry_run'] and changed:
+            totals = (
+                Message.objects.filter(conversation=models.OuterRef('pk'))
+                # Rolling summaries are not part of the conversation's own usage
+                .exclude(pk__in=Message.objects.summaries().values('pk'))
+                .order_by()
+                .values('conversation')
+                .annotate(total=models.Sum('token_count'))
+                .values('total')
+            )
+            Conversation.objects.update(total_tokens=Coalesce(models.Subquery(totals), 0))
+
+        verb = 'would change' if options['dry_run'] else 'updated'
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ {changed} of {scanned} message token counts {verb}')
+        )
+
+    def recount_batch(self, messages, dry_run):
+        """Count one batch, one tokenizer call per model, and save the counts that differ"""
+        by_model = {}
+        for message in messages:
+            by_model.setdefault(message.model, []).append(message)
+
+        stale = []
+        for model, group in by_model.items():
+            for message, count in zip(group, count_many([message.content or '' for message in group], model)):
+                if message.token_count != count:
+                    message.token_count = count
+                    stale.append(message)
+
+        if stale and not dry_run:
+            with transaction.atomic():
+                Message.objects.bulk_update(stale, ['token_count'])
+        return len(stale)
@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from chat.encryption import Ciphertext, UnreadableValue, get_key_ring
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Re-encrypt message content that was written with a retired encryption key'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of messages rewritten per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the messages that need rotation',
+        )
+
+    def handle(self, *args, **options):
+        key_ring = get_key_ring()
+        batch_size = options['batch_size']
+        self.stdout.write(f'🔑 Primary key id: {key_ring.primary_id}')
+
+        scanned = 0
+        rotated = 0
+        unreadable = []
+        pending = []
+        for pk, stored, legacy in self.stored_values(batch_size):
+            scanned += 1
+            # Rows still on the legacy text column are moved to the envelope as well
+            if key_ring.needs_rotation(stored) if stored is not None else legacy is not None:
+                pending.append(pk)
+            if len(pending) >= batch_size:
+                rotated += self.rotate_batch(pending, options['dry_run'], unreadable)
+                pending = []
+        if pending:
+            rotated += self.rotate_batch(pending, options['dry_run'], unreadable)
+
+        verb = 'need rotation' if options['dry_run'] else 'rotated'
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ {rotated} of {scanned} messages {verb}')
+        )
+        if unreadable:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️  Skipped {len(unreadable)} messages no key in the ring can decrypt: '
+                + ', '.join(str(pk) for pk in unreadable)
+            ))
+
+    def stored_values(self, batch_size):
+        """Yield (pk, envelope, legacy value) without decrypting anything"""
+        quote = connection.ops.quote_name
+        table = quote(Message._meta.db_table)
+        column = quote(Message._meta.get_field('content').column)
+        legacy_column = quote(Message._meta.get_field('content_legacy').column)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id, {column}, {legacy_column} FROM {table}')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for pk, stored, legacy in rows:
+                    yield pk, bytes(stored) if stored is not None else None, legacy
+
+    def rotate_batch(self, pks, dry_run, unreadable):
+        """
+        Re-encrypt one batch with the primary key and return how many rows
+        were rewritten. Rows that do not decrypt are left untouched and their
+        ids added to `unreadable`.
+        """
+        if dry_run:
+            return len(pks)
+        key_ring = get_key_ring()
+        with transaction.atomic():
+            rows = (
+                Message.objects.select_for_update().filter(pk__in=pks)
+                .values_list('pk', 'content', 'content_legacy')
+            )
+            messages = []
+            for pk, stored, legacy in rows:
+                stored = stored if stored is not None else legacy
+                try:
+                    plaintext = key_ring.decrypt(stored.stored if isinstance(stored, Ciphertext) else stored or '')
+                except UnreadableValue:
+                    unreadable.append(pk)
+                    continue
+                # Seal once and hand the field the finished envelope
+                messages.append(Message(
+                    pk=pk, content=Ciphertext(key_ring.seal(plaintext)), content_legacy=None
+                ))
+            Message.objects.bulk_update(messages, ['content', 'content_legacy'])
+        return len(messages)
@@ -0,0 +1,276 @@
+# Generated by Django 4.2.7 on 2026-10-17 03:26
+
+import chat.models
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='APIUsage',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('user_id', models.CharField(db_index=True, max_length=100)),
+                ('endpoint', models.CharField(db_index=True, max_length=200)),
+                ('method', models.CharField(max_length=10)),
+                ('status_code', models.PositiveIntegerField(db_index=True)),
+                ('response_time', models.FloatField()),
+                ('tokens_used', models.PositiveIntegerField(default=0)),
+                ('user_agent', models.CharField(blank=True, max_length=500)),
+                ('ip_address', models.GenericIPAddressField()),
+            ],
+            options={
+                'db_table': 'chat_api_usage',
+            },
+        ),
+        migrations.CreateModel(
+            name='ConversationShare',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('share_token', models.CharField(db_index=True, max_length=64, unique=True)),
+                ('is_public', models.BooleanField(default=False)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('allowed_users', models.JSONField(blank=True, default=list)),
+                ('view_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'chat_conversation_share',
+            },
+        ),
+        migrations.CreateModel(
+            name='FileUpload',
+            fields=[
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True)),
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('original_filename', models.CharField(max_length=255)),
+                ('file_path', models.CharField(max_length=500)),
+                ('file_size', models.PositiveIntegerField()),
+                ('content_type', models.CharField(max_length=100)),
+                ('file_hash', models.CharField(max_length=64, unique=True)),
+                ('is_processed', models.BooleanField(default=False)),
+                ('processing_error', models.TextField(blank=True, null=True)),
+                ('extracted_content', models.TextField(blank=True, null=True)),
+                ('metadata', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'db_table': 'chat_file_upload',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='conversation',
+            options={'ordering': ['-last_activity']},
+        ),
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['created_at']},
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='timestamp',
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='is_archived',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='is_shared',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='metadata',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='model_config',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='total_tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_id',
+            field=models.CharField(db_index=True, default='', max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='error_message',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='is_deleted',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='is_edited',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='metadata',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='response_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='title',
+            field=models.CharField(default='New Chat', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=chat.models.EncryptedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='model',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='role',
+            field=models.CharField(choices=[('user', 'User'), ('assistant', 'Assistant'), ('system', 'System'), ('tool', 'Tool')], db_index=True, max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_id', '-last_activity'], name='chat_conver_user_id_42c80a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_id', 'is_archived'], name='chat_conver_user_id_d505c4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-created_at'], name='chat_conver_created_766071_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at'], name='chat_messag_convers_3154fc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'role'], name='chat_messag_convers_45d255_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['model', 'created_at'], name='chat_messag_model_4e4600_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['-created_at'], name='chat_messag_created_f18bb8_idx'),
+        ),
+        migrations.AlterModelTable(
+            name='conversation',
+            table='chat_conversation',
+        ),
+        migrations.AlterModelTable(
+            name='message',
+            table='chat_message',
+        ),
+        migrations.AddField(
+            model_name='fileupload',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='chat.conversation'),
+        ),
+        migrations.AddField(
+            model_name='fileupload',
+            name='message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='files', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='conversationshare',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shares', to='chat.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='apiusage',
+            index=models.Index(fields=['user_id', 'created_at'], name='chat_api_us_user_id_ee2c80_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apiusage',
+            index=models.Index(fields=['endpoint', 'created_at'], name='chat_api_us_endpoin_e17e53_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apiusage',
+            index=models.Index(fields=['status_code', 'created_at'], name='chat_api_us_status__7dbb03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(fields=['conversation', 'created_at'], name='chat_file_u_convers_d6e665_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(fields=['file_hash'], name='chat_file_u_file_ha_1bc7d9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(fields=['content_type'], name='chat_file_u_content_be0fa5_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Moves Message.content to a binary envelope column without rewriting rows.
+#
+# The existing text column keeps its name ("content") and becomes
+# Message.content_legacy; Message.content now maps to a new, nullable
+# "content_enc" column. Rows are rewritten online, in chunks, by
+# `manage.py migrate_message_storage`; until then reads fall back to the
+# legacy column.
+
+import chat.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_sync_models'),
+    ]
+
+    operations = [
+        # Pin the column name first so the rename below is state-only
+        migrations.AlterField(
+            model_name='message',
+            name='content',
+            field=chat.models.EncryptedTextField(db_column='content'),
+        ),
+        migrations.RenameField(
+            model_name='message',
+            old_name='content',
+            new_name='content_legacy',
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='content_legacy',
+            field=chat.models.EncryptedTextField(blank=True, db_column='content', editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='content',
+            field=chat.models.EncryptedBinaryField(blank=True, db_column='content_enc', legacy_field='content_legacy', null=True),
+        ),
+    ]
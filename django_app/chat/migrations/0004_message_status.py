@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 03:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_content_envelope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('streaming', 'Streaming'), ('complete', 'Complete'), ('aborted', 'Aborted')], default='complete', max_length=20),
+        ),
+    ]
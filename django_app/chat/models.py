@@ -1,13 +1,18 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from django import forms
+from django.db import models, transaction
+from django.db.models.query_utils import DeferredAttribute
 import uuid
 import json
 import hashlib
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.cache import cache
-from django.conf import settings
-from cryptography.fernet import Fernet
-import base64
+
+from . import counters
+from .cache_keys import invalidate_conversation, invalidate_user, user_key
+from .encryption import Ciphertext, UnreadableValue, get_key_ring
+from .tokenizer import count_tokens
 
 class TimestampedModel(models.Model):
     """
@@ -20,55 +25,120 @@ class TimestampedModel(models.Model):
         abstract = True
 
 
-class EncryptedTextField(models.TextField):
+class EncryptedAttribute(DeferredAttribute):
+    """
+    Descriptor that decrypts an encrypted field the first time it is read
+    """
+    
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, Ciphertext):
+            try:
+                value = value.decrypt()
+            except UnreadableValue:
+                # Shown empty; the stored value stays so a save keeps it
+                return ''
+            instance.__dict__[self.field.attname] = value
+        elif value is None and self.field.legacy_field:
+            # Row not rewritten into the current storage format yet
+            value = getattr(instance, self.field.legacy_field)
+            if value is not None and not isinstance(instance.__dict__.get(self.field.legacy_field), Ciphertext):
+                instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # Defining __set__ makes this a data descriptor, so __get__ runs even
+        # when the value is already in the instance __dict__
+        instance.__dict__[self.field.attname] = value
+
+
+class EncryptedFieldMixin:
+    """
+    Shared lazy-decryption behaviour for encrypted model fields
+    """
+    descriptor_class = EncryptedAttribute
+    legacy_field = None
+
+    def pre_save(self, model_instance, add):
+        # A value still wrapped (or still on the legacy field) was never read
+        # or cannot be decrypted, so it is written back as stored instead of
+        # going through the descriptor
+        value = model_instance.__dict__.get(self.attname)
+        if isinstance(value, Ciphertext) or (value is None and self.legacy_field):
+            return value
+        return super().pre_save(model_instance, add)
+
+    def decrypt_instances(self, instances):
+        """Decrypt this field on many loaded instances in one batch"""
+        attname = self.attname
+        if self.legacy_field:
+            legacy = self.model._meta.get_field(self.legacy_field)
+            unmigrated = [
+                instance for instance in instances
+                if attname in instance.__dict__ and instance.__dict__[attname] is None
+                and legacy.attname in instance.__dict__
+            ]
+            legacy.decrypt_instances(unmigrated)
+            for instance in unmigrated:
+                if not isinstance(instance.__dict__[legacy.attname], Ciphertext):
+                    instance.__dict__[attname] = instance.__dict__[legacy.attname]
+        pending = [
+            instance for instance in instances
+            if isinstance(instance.__dict__.get(attname), Ciphertext)
+        ]
+        if not pending:
+            return instances
+        plaintexts = get_key_ring().decrypt_many(
+            instance.__dict__[attname].stored for instance in pending
+        )
+        for instance, plaintext in zip(pending, plaintexts):
+            # Unreadable values stay wrapped, see EncryptedAttribute
+            if plaintext is not None:
+                instance.__dict__[attname] = plaintext
+        return instances
+
+
+class EncryptedTextField(EncryptedFieldMixin, models.TextField):
     """
     Custom field for encrypted text storage
+    
+    Values are decrypted lazily: loading a row keeps the ciphertext and only
+    reading the attribute pays for decryption.
     """
     
     def __init__(self, *args, **kwargs):
         self.encrypt = kwargs.pop('encrypt', True)
         super().__init__(*args, **kwargs)
     
-    def get_encryption_key(self):
-        """Get or create encryption key"""
-        key = getattr(settings, 'ENCRYPTION_KEY', None)
-        if not key:
-            # Generate a key for demo purposes
-            key = Fernet.generate_key()
-        return key
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if not self.encrypt:
+            kwargs['encrypt'] = False
+        return name, path, args, kwargs
     
     def encrypt_value(self, value):
-        """Encrypt the value"""
+        """Encrypt the value with the primary key of the shared key ring"""
+        if isinstance(value, Ciphertext):
+            return value.stored
         if not self.encrypt or not value:
             return value
-        
-        try:
-            key = self.get_encryption_key()
-            f = Fernet(key)
-            encrypted = f.encrypt(value.encode('utf-8'))
-            return base64.b64encode(encrypted).decode('utf-8')
-        except Exception:
-            # Fallback to unencrypted if encryption fails
-            return value
+        return get_key_ring().encrypt(value)
     
     def decrypt_value(self, value):
-        """Decrypt the value"""
+        """Decrypt the value with whichever key in the ring wrote it"""
+        if isinstance(value, Ciphertext):
+            return str(value)
         if not self.encrypt or not value:
             return value
-        
-        try:
-            key = self.get_encryption_key()
-            f = Fernet(key)
-            decoded = base64.b64decode(value.encode('utf-8'))
-            decrypted = f.decrypt(decoded)
-            return decrypted.decode('utf-8')
-        except Exception:
-            # Return as-is if decryption fails (might be unencrypted)
-            return value
+        return str(Ciphertext(value))
     
     def from_db_value(self, value, expression, connection):
-        """Decrypt when loading from database"""
-        return self.decrypt_value(value)
+        """Wrap stored ciphertext; decryption happens on first access"""
+        if not self.encrypt or not value:
+            return value
+        return Ciphertext(value)
     
     def to_python(self, value):
         """Convert to Python value"""
@@ -79,26 +149,199 @@ class EncryptedTextField(models.TextField):
         return self.encrypt_value(value)
 
 
+class EncryptedBinaryField(EncryptedFieldMixin, models.BinaryField):
+    """
+    Encrypted text stored as a compact binary envelope
+    
+    See KeyRing.seal for the layout. `legacy_field` names a text field that
+    still holds the value for rows written before the envelope existed;
+    reads fall back to it until migrate_message_storage rewrites the row.
+    """
+    
+    def __init__(self, *args, legacy_field=None, **kwargs):
+        self.legacy_field = legacy_field
+        kwargs.setdefault('editable', True)
+        super().__init__(*args, **kwargs)
+    
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.legacy_field:
+            kwargs['legacy_field'] = self.legacy_field
+        return name, path, args, kwargs
+    
+    def from_db_value(self, value, expression, connection):
+        """Wrap the stored envelope; decryption happens on first access"""
+        if value is None:
+            return value
+        return Ciphertext(bytes(value))
+    
+    def to_python(self, value):
+        """Plaintext stays as-is; envelopes are decrypted"""
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, Ciphertext):
+            return str(value)
+        return str(Ciphertext(bytes(value)))
+    
+    def get_prep_value(self, value):
+        """Seal plaintext into an envelope before saving"""
+        if isinstance(value, Ciphertext):
+            return value.stored
+        if value is None:
+            return value
+        return get_key_ring().seal(value)
+    
+    def value_to_string(self, obj):
+        """Serialize as plaintext so fixtures survive key rotation"""
+        return self.value_from_object(obj)
+    
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{'widget': forms.Textarea, **kwargs})
+
+
+def decrypt_all(instances):
+    """Batch-decrypt every encrypted field on a list of model instances"""
+    instances = list(instances)
+    if instances:
+        fields = [
+            field for field in instances[0]._meta.concrete_fields
+            if isinstance(field, EncryptedFieldMixin)
+        ]
+        # Legacy columns are read through the field that falls back to them
+        legacy = {field.legacy_field for field in fields if field.legacy_field}
+        for field in fields:
+            if field.name not in legacy:
+                field.decrypt_instances(instances)
+    return instances
+
+
+class SummaryRows:
+    """
+    Cached summary rows of a user's conversations, sliced page by page.
+
+    Paginators only call count() and take one slice, so a page costs one
+    cached count and one cached page of summaries.
+    """
+    
+    def __init__(self, manager, user_id, archived=False):
+        self.manager = manager
+        self.user_id = user_id
+        self.archived = archived
+    
+    def count(self):
+        return self.manager.count_user_conversations(self.user_id, archived=self.archived)
+    
+    def __len__(self):
+        return self.count()
+    
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        if stop <= start:
+            return []
+        return self.manager.get_user_conversations(
+            self.user_id, limit=stop - start, archived=self.archived, offset=start
+        )
+
+
 class ConversationManager(models.Manager):
     """
     Custom manager for Conversation model with caching and optimization
     """
     
-    def get_user_conversations(self, user_id, limit=50):
-        """Get user conversations with caching"""
-        cache_key = f"user_conversations:{user_id}:{limit}"
-        conversations = cache.get(cache_key)
+    def get_user_conversations(self, user_id, limit=50, archived=False, offset=0):
+        """
+        Sidebar summaries for a user's conversations, most recent first.
+
+        Returns plain dicts (see build_summaries) so they survive the JSON
+        cache serializer and stay small; messages are never loaded.
+        """
+        cache_key = user_key(user_id, 'summaries', offset, limit, int(archived))
+        summaries = cache.get(cache_key)
         
-        if conversations is None:
-            conversations = list(
-                self.filter(user_id=user_id)
-                .select_related()
-                .prefetch_related('messages')
-                .order_by('-updated_at')[:limit]
+        if summaries is None:
+            summaries = self.build_summaries(
+                self.filter(user_id=user_id, is_archived=archived)
+                .order_by('-last_activity', '-pk')[offset:offset + limit]
             )
-            cache.set(cache_key, conversations, 300)  # Cache for 5 minutes
+            cache.set(cache_key, summaries, 300)  # Cache for 5 minutes
         
-        return conversations
+        return summaries
+    
+    def count_user_conversations(self, user_id, archived=False):
+        """Number of a user's conversations, cached like the summaries"""
+        cache_key = user_key(user_id, 'count', int(archived))
+        count = cache.get(cache_key)
+        
+        if count is None:
+            count = self.filter(user_id=user_id, is_archived=archived).count()
+            cache.set(cache_key, count, 300)
+        
+        return count
+    
+    def summary_rows(self, user_id, archived=False):
+        """A user's summaries as a lazy sequence that paginators can slice"""
+        return SummaryRows(self, user_id, archived)
+    
+    def build_summaries(self, queryset):
+        """
+        Summary rows for a conversation queryset, fetched in one query.
+
+        The latest visible message of each conversation is pulled in with
+        correlated subqueries and all previews are decrypted as one batch.
+        """
+        latest = (
+            Message.objects.visible().filter(conversation=models.OuterRef('pk'))
+            .order_by('-created_at')
+        )
+        conversations = list(
+            queryset.only(
+                'id', 'user_id', 'title', 'metadata', 'model_config', 'message_count',
+                'total_tokens', 'last_activity', 'created_at', 'updated_at',
+                'is_archived', 'is_shared'
+            ).annotate(
+                last_role=models.Subquery(latest.values('role')[:1]),
+                last_content=models.Subquery(latest.values('content')[:1]),
+                last_content_legacy=models.Subquery(latest.values('content_legacy')[:1]),
+                last_created_at=models.Subquery(latest.values('created_at')[:1]),
+            )
+        )
+        conversations = counters.apply_pending(conversations)
+        
+        with_preview = [c for c in conversations if c.last_role is not None]
+        stored = [(c.last_content or c.last_content_legacy) for c in with_preview]
+        plaintexts = get_key_ring().decrypt_many(
+            value.stored if isinstance(value, Ciphertext) else value for value in stored
+        )
+        previews = {}
+        for conversation, content in zip(with_preview, plaintexts):
+            content = content or ''
+            previews[conversation.pk] = {
+                'role': conversation.last_role,
+                'content_preview': content[:50] + "..." if len(content) > 50 else content,
+                'created_at': conversation.last_created_at.isoformat(),
+            }
+        
+        return [
+            {
+                'id': str(conversation.id),
+                'user_id': conversation.user_id,
+                'title': conversation.title,
+                'metadata': conversation.metadata,
+                'model_config': conversation.model_config,
+                'message_count': conversation.message_count,
+                'total_tokens': conversation.total_tokens,
+                'last_activity': conversation.last_activity.isoformat(),
+                'created_at': conversation.created_at.isoformat(),
+                'updated_at': conversation.updated_at.isoformat(),
+                'is_archived': conversation.is_archived,
+                'is_shared': conversation.is_shared,
+                'recent_message': previews.get(conversation.pk),
+            }
+            for conversation in conversations
+        ]
     
     def create_conversation(self, user_id, title=None, metadata=None):
         """Create a new conversation with proper initialization"""
@@ -111,9 +354,8 @@ class ConversationManager(models.Manager):
             metadata=metadata or {}
         )
         
-        # Invalidate cache
-        cache_key = f"user_conversations:{user_id}:*"
-        cache.delete_pattern(cache_key)
+        # Invalidate every cached list variant for the user
+        invalidate_user(user_id)
         
         return conversation
 
@@ -165,23 +407,12 @@ class Conversation(TimestampedModel):
     
     def increment_message_count(self, tokens=0):
         """Increment message count and token usage"""
+        Conversation.objects.filter(pk=self.pk).update(
+            message_count=models.F('message_count') + 1,
+            total_tokens=models.F('total_tokens') + tokens,
+        )
         self.message_count += 1
         self.total_tokens += tokens
-        self.save(update_fields=['message_count', 'total_tokens'])
-    
-    def get_recent_messages(self, limit=10):
-        """Get recent messages with caching"""
-        cache_key = f"conversation_messages:{self.id}:{limit}"
-        messages = cache.get(cache_key)
-        
-        if messages is None:
-            messages = list(
-                self.messages.select_related()
-                .order_by('-created_at')[:limit]
-            )
-            cache.set(cache_key, messages, 300)
-        
-        return messages
     
     def get_summary(self):
         """Generate conversation summary"""
@@ -197,31 +428,194 @@ class Conversation(TimestampedModel):
         }
 
 
-class MessageManager(models.Manager):
+# Message.metadata['kind'] of the stored rolling summary of a conversation
+SUMMARY_KIND = 'summary'
+
+
+class MessageQuerySet(models.QuerySet):
+    """
+    QuerySet for messages with batched decryption
+    """
+    
+    def decrypted(self):
+        """Evaluate the queryset and decrypt all contents as one batch"""
+        return decrypt_all(self)
+    
+    def visible(self):
+        """Messages shown in a conversation: not deleted, and not its rolling summary"""
+        # A missing key compares as NULL, so it has to be let through explicitly
+        return self.filter(
+            models.Q(metadata__kind__isnull=True) | ~models.Q(metadata__kind=SUMMARY_KIND),
+            is_deleted=False
+        )
+    
+    def summaries(self):
+        """Rolling conversation summaries (see chat.summaries)"""
+        return self.filter(metadata__kind=SUMMARY_KIND, is_deleted=False)
+    
+    def update(self, **kwargs):
+        """Writing content always drops the legacy copy, as Message.save does"""
+        if 'content' in kwargs:
+            kwargs.setdefault('content_legacy', None)
+        return super().update(**kwargs)
+
+
+def title_from_message(role, content):
+    """Conversation title derived from the first user message, or None"""
+    if role != 'user' or not content:
+        return None
+    # Use first 50 characters of the message as title
+    return content[:50] + "..." if len(content) > 50 else content
+
+
+class MessageManager(models.Manager.from_queryset(MessageQuerySet)):
     """
     Custom manager for Message model with advanced querying
     """
     
-    def create_message(self, conversation, role, content, model=None, metadata=None, tokens=0):
-        """Create a message with proper relationships and caching"""
-        message = self.create(
+    def append(self, conversation, role, content, model=None, metadata=None, tokens=0, **fields):
+        """
+        Add a message to a conversation with one INSERT and one UPDATE.
+
+        Counters, activity, token usage and the auto-title are applied to the
+        conversation row in a single atomic statement, so concurrent writers
+        never lose an increment. With COUNTER_WRITE_BEHIND enabled the
+        counters are buffered in Redis instead (see chat.counters) and the
+        conversation row is only written to set the title.
+        """
+        now = timezone.now()
+        message = self.model(
             conversation=conversation,
             role=role,
             content=content,
             model=model,
             metadata=metadata or {},
-            token_count=tokens
+            token_count=tokens or count_tokens(content, model),
+            **fields
         )
+        # Tells the post_save signal the conversation row is already up to date
+        message._conversation_synced = True
+        
+        updates = {
+            'message_count': models.F('message_count') + 1,
+            'total_tokens': models.F('total_tokens') + message.token_count,
+            'last_activity': now,
+            'updated_at': now,
+        }
+        title = title_from_message(role, content)
+        if title:
+            updates['title'] = models.Case(
+                models.When(title='New Chat', then=models.Value(title)),
+                default=models.F('title'),
+            )
+        
+        write_behind = counters.is_enabled()
+        with transaction.atomic():
+            message.save(force_insert=True)
+            if not write_behind:
+                Conversation.objects.filter(pk=conversation.pk).update(**updates)
+            else:
+                if title and conversation.title == 'New Chat':
+                    Conversation.objects.filter(pk=conversation.pk).update(title=updates['title'])
+                transaction.on_commit(
+                    lambda: self._buffer_counters(conversation.pk, message.token_count, now)
+                )
         
-        # Update conversation
-        conversation.increment_message_count(tokens)
-        conversation.update_activity()
+        # Mirror the update on the caller's instance without reading it back
+        conversation.message_count += 1
+        conversation.total_tokens += message.token_count
+        conversation.last_activity = now
+        conversation.updated_at = now
+        if title and conversation.title == 'New Chat':
+            conversation.title = title
         
-        # Invalidate relevant caches
-        cache.delete(f"conversation_messages:{conversation.id}:*")
+        cache.set(f"conversation_activity:{conversation.id}", now.timestamp(), 3600)
+        invalidate_conversation(conversation.id)
+        invalidate_user(conversation.user_id)
         
         return message
     
+    async def aappend(self, conversation, role, content, **kwargs):
+        """Async variant of append; the transaction runs in a worker thread"""
+        return await sync_to_async(self.append)(conversation, role, content, **kwargs)
+    
+    def _buffer_counters(self, conversation_id, tokens, now, messages=1):
+        """Hand counter deltas to the write-behind buffer, or write them if Redis is down"""
+        if not counters.record(conversation_id, tokens, now, messages=messages):
+            Conversation.objects.filter(pk=conversation_id).update(
+                message_count=models.F('message_count') + messages,
+                total_tokens=models.F('total_tokens') + tokens,
+                last_activity=now,
+                updated_at=now,
+            )
+    
+    def checkpoint(self, message_id, content):
+        """
+        Save the partial content of a streaming reply with one UPDATE.
+
+        Only rows still streaming are touched, so a late checkpoint can never
+        overwrite a finished reply. The token count and counters are left to
+        finish(), which counts the final text once.
+        """
+        return self.filter(pk=message_id, status=Message.STREAMING).update(
+            content=content,
+            updated_at=timezone.now(),
+        )
+    
+    async def acheckpoint(self, message_id, content):
+        return await sync_to_async(self.checkpoint)(message_id, content)
+    
+    def finish(self, message, content, status=None, tokens=0, **fields):
+        """
+        Store the final content of a reply appended as a streaming placeholder.
+
+        The placeholder was already counted by append(); this adds the reply's
+        tokens to the conversation in the same transaction as the message
+        UPDATE (or to the write-behind buffer).
+        """
+        now = timezone.now()
+        status = status or Message.COMPLETE
+        tokens = tokens or count_tokens(content, message.model)
+        added_tokens = max(tokens - message.token_count, 0)
+        write_behind = counters.is_enabled()
+        with transaction.atomic():
+            self.filter(pk=message.pk).update(
+                content=content,
+                status=status,
+                token_count=tokens,
+                updated_at=now,
+                **fields
+            )
+            if not write_behind:
+                Conversation.objects.filter(pk=message.conversation_id).update(
+                    total_tokens=models.F('total_tokens') + added_tokens,
+                    last_activity=now,
+                    updated_at=now,
+                )
+            else:
+                transaction.on_commit(
+                    lambda: self._buffer_counters(message.conversation_id, added_tokens, now, messages=0)
+                )
+        
+        message.content = content
+        message.content_legacy = None
+        message.status = status
+        message.token_count = tokens
+        message.updated_at = now
+        for name, value in fields.items():
+            setattr(message, name, value)
+        
+        invalidate_conversation(message.conversation_id)
+        invalidate_user(message.conversation.user_id)
+        return message
+    
+    async def afinish(self, message, content, **kwargs):
+        return await sync_to_async(self.finish)(message, content, **kwargs)
+    
+    def create_message(self, conversation, role, content, model=None, metadata=None, tokens=0, **fields):
+        """Create a message with proper relationships and caching"""
+        return self.append(conversation, role, content, model=model, metadata=metadata, tokens=tokens, **fields)
+    
     def get_conversation_history(self, conversation_id, limit=100):
         """Get conversation history with proper ordering"""
         return self.filter(conversation_id=conversation_id).order_by('created_at')[:limit]
@@ -231,6 +625,17 @@ class Message(TimestampedModel):
     """
     Enhanced message model with encryption and metadata
     """
+    # Assistant replies are appended as a streaming placeholder and
+    # checkpointed while they are generated
+    STREAMING = 'streaming'
+    COMPLETE = 'complete'
+    ABORTED = 'aborted'
+    STATUS_CHOICES = [
+        (STREAMING, 'Streaming'),
+        (COMPLETE, 'Complete'),
+        (ABORTED, 'Aborted'),
+    ]
+    
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     conversation = models.ForeignKey(
         Conversation, 
@@ -251,8 +656,11 @@ class Message(TimestampedModel):
         db_index=True
     )
     
-    # Encrypted content field
-    content = EncryptedTextField()
+    # Encrypted content, stored as a binary envelope. Rows written before the
+    # envelope existed keep their text ciphertext in content_legacy until
+    # `manage.py migrate_message_storage` rewrites them.
+    content = EncryptedBinaryField(db_column='content_enc', null=True, blank=True, legacy_field='content_legacy')
+    content_legacy = EncryptedTextField(db_column='content', null=True, blank=True, editable=False)
     
     # AI model information
     model = models.CharField(max_length=100, blank=True, null=True, db_index=True)
@@ -265,6 +673,7 @@ class Message(TimestampedModel):
     metadata = models.JSONField(default=dict, blank=True)
     
     # Message status and flags
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=COMPLETE)
     is_edited = models.BooleanField(default=False)
     is_deleted = models.BooleanField(default=False, db_index=True)
     error_message = models.TextField(blank=True, null=True)
@@ -285,6 +694,17 @@ class Message(TimestampedModel):
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
     
+    def save(self, *args, **kwargs):
+        """Drop the legacy copy whenever new content is written"""
+        update_fields = kwargs.get('update_fields')
+        writes_content = update_fields is None or 'content' in update_fields
+        if (writes_content and self.__dict__.get('content') is not None
+                and self.__dict__.get('content_legacy') is not None):
+            self.content_legacy = None
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'content_legacy'}
+        super().save(*args, **kwargs)
+    
     def get_content_hash(self):
         """Generate hash of message content for integrity checking"""
         return hashlib.sha256(self.content.encode('utf-8')).hexdigest()
@@ -321,6 +741,7 @@ class Message(TimestampedModel):
             'response_time': self.response_time,
             'created_at': self.created_at.isoformat(),
             'metadata': self.metadata,
+            'status': self.status,
             'is_edited': self.is_edited
         }
 
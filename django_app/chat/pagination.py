@@ -0,0 +1,84 @@
+"""
+Keyset pagination for conversation messages.
+
+Pages are addressed by an opaque cursor holding the (created_at, id) of the
+row at the page boundary instead of an OFFSET, so fetching a deep page
+costs the same as fetching the first one: the database seeks into the
+(conversation, created_at) index and reads page_size + 1 rows.
+"""
+
+import base64
+import json
+import uuid
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+FORWARD = 'n'
+BACKWARD = 'p'
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor token cannot be decoded"""
+
+
+def encode_cursor(message, direction):
+    """Opaque token pointing just after (or before) `message`"""
+    payload = json.dumps(
+        {'t': message.created_at.isoformat(), 'i': str(message.id), 'd': direction},
+        separators=(',', ':'),
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return (created_at, id, direction) from a cursor token"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        created_at = parse_datetime(payload['t'])
+        message_id = uuid.UUID(payload['i'])
+        direction = payload['d']
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor('Invalid cursor')
+    if created_at is None or direction not in (FORWARD, BACKWARD):
+        raise InvalidCursor('Invalid cursor')
+    return created_at, message_id, direction
+
+
+def paginate_messages(queryset, cursor=None, page_size=50):
+    """
+    One page of messages in (created_at, id) order.
+
+    `queryset` is a Message queryset; the page is decrypted as one batch.
+    Returns (messages, next_cursor, prev_cursor); either cursor is None when
+    there is nothing further in that direction. Without a cursor the first
+    page starts at the oldest message.
+    """
+    direction = FORWARD
+    if cursor:
+        created_at, message_id, direction = decode_cursor(cursor)
+        if direction == FORWARD:
+            # The plain created_at bound keeps the scan on the index range;
+            # the OR only breaks ties between rows with the same timestamp
+            queryset = queryset.filter(created_at__gte=created_at).filter(
+                Q(created_at__gt=created_at) | Q(id__gt=message_id)
+            )
+        else:
+            queryset = queryset.filter(created_at__lte=created_at).filter(
+                Q(created_at__lt=created_at) | Q(id__lt=message_id)
+            )
+
+    if direction == FORWARD:
+        rows = queryset.order_by('created_at', 'id')[:page_size + 1].decrypted()
+        has_more = len(rows) > page_size
+        messages = rows[:page_size]
+        next_cursor = encode_cursor(messages[-1], FORWARD) if has_more else None
+        prev_cursor = encode_cursor(messages[0], BACKWARD) if cursor and messages else None
+    else:
+        rows = queryset.order_by('-created_at', '-id')[:page_size + 1].decrypted()
+        has_more = len(rows) > page_size
+        messages = rows[:page_size][::-1]
+        prev_cursor = encode_cursor(messages[0], BACKWARD) if has_more else None
+        next_cursor = encode_cursor(messages[-1], FORWARD) if messages else None
+    return messages, next_cursor, prev_cursor
@@ -0,0 +1,119 @@
+"""
+Who is connected to a conversation over WebSocket.
+
+Every open socket is one member of a Redis sorted set per conversation,
+``chat:presence:<conversation_id>``, scored with the time its heartbeat
+expires. Joining, heartbeats and leaving are single ZADD/ZREM commands, so
+concurrent connects never overwrite each other, and online_users() drops
+expired members and reads the rest in one round trip. A socket whose
+process died without leaving ages out after PRESENCE_TTL seconds.
+
+All calls use the loop's redis.asyncio client and never block the event
+loop. Without Redis, presence is kept in this process only.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .counters import get_async_redis
+
+logger = logging.getLogger('chat')
+
+KEY_PREFIX = 'chat:presence:'
+
+_lock = threading.Lock()
+_local = {}
+
+
+def _presence_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('PRESENCE_TTL', 60),
+        chat_settings.get('PRESENCE_HEARTBEAT', 20),
+    )
+
+
+def presence_key(conversation_id):
+    return f"{KEY_PREFIX}{conversation_id}"
+
+
+def _member(user_id, channel_name):
+    # Channel names never contain '|', so the user id is everything before the last one
+    return f"{user_id}|{channel_name}"
+
+
+def _user(member):
+    if isinstance(member, bytes):
+        member = member.decode('utf-8')
+    return member.rpartition('|')[0]
+
+
+def heartbeat_interval():
+    return _presence_settings()[1]
+
+
+async def join(conversation_id, user_id, channel_name):
+    """Mark a socket present, or extend its heartbeat; False when Redis failed"""
+    ttl, _ = _presence_settings()
+    key = presence_key(conversation_id)
+    member = _member(user_id, channel_name)
+    expires = time.time() + ttl
+    client = get_async_redis()
+    if client is None:
+        with _lock:
+            _local.setdefault(key, {})[member] = expires
+        return True
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.zadd(key, {member: expires})
+        pipe.expire(key, ttl)
+        await pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"Presence update failed for {key}: {str(e)}")
+        return False
+
+
+async def leave(conversation_id, user_id, channel_name):
+    key = presence_key(conversation_id)
+    member = _member(user_id, channel_name)
+    client = get_async_redis()
+    if client is None:
+        with _lock:
+            members = _local.get(key, {})
+            members.pop(member, None)
+            if not members:
+                _local.pop(key, None)
+        return True
+    try:
+        await client.zrem(key, member)
+        return True
+    except Exception as e:
+        logger.warning(f"Presence removal failed for {key}: {str(e)}")
+        return False
+
+
+async def online_users(conversation_id):
+    """Sorted ids of the users with a live socket on the conversation"""
+    key = presence_key(conversation_id)
+    now = time.time()
+    client = get_async_redis()
+    if client is None:
+        with _lock:
+            members = _local.get(key, {})
+            for member in [m for m, expires in members.items() if expires <= now]:
+                del members[member]
+            live = list(members)
+    else:
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zrange(key, 0, -1)
+            _, live = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Presence lookup failed for {key}: {str(e)}")
+            return []
+    return sorted({_user(member) for member in live})
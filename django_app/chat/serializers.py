@@ -1,7 +1,29 @@
 from rest_framework import serializers
+from . import counters
 from .models import Conversation, Message, FileUpload, ConversationShare, APIUsage
 
-class ConversationSerializer(serializers.ModelSerializer):
+class PendingCountersListSerializer(serializers.ListSerializer):
+    """
+    Merges write-behind counters for a whole page in one Redis round trip
+    """
+    
+    def to_representation(self, data):
+        if hasattr(data, 'all'):
+            data = data.all()
+        return super().to_representation(counters.apply_pending(data))
+
+
+class PendingCountersMixin:
+    """
+    Serializes conversations with unflushed counter deltas included
+    """
+    
+    def to_representation(self, instance):
+        instance = counters.apply_pending([instance])[0]
+        return super().to_representation(instance)
+
+
+class ConversationSerializer(PendingCountersMixin, serializers.ModelSerializer):
     """
     Enhanced serializer for Conversation model
     """
@@ -11,6 +33,7 @@ class ConversationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
+        list_serializer_class = PendingCountersListSerializer
         fields = [
             'id', 'user_id', 'title', 'metadata', 'message_count',
             'total_tokens', 'last_activity', 'model_config',
@@ -38,17 +61,18 @@ class MessageSerializer(serializers.ModelSerializer):
     Enhanced serializer for Message model
     """
     conversation_id = serializers.UUIDField(source='conversation.id', read_only=True)
+    content = serializers.CharField(allow_blank=True)
     content_preview = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
         fields = [
             'id', 'conversation_id', 'role', 'content', 'content_preview',
-            'model', 'token_count', 'response_time', 'metadata',
+            'model', 'token_count', 'response_time', 'metadata', 'status',
             'is_edited', 'is_deleted', 'error_message', 'created_at'
         ]
         read_only_fields = [
-            'id', 'conversation_id', 'token_count', 'response_time',
+            'id', 'conversation_id', 'token_count', 'response_time', 'status',
             'is_edited', 'is_deleted', 'error_message', 'created_at'
         ]
     
@@ -155,7 +179,7 @@ class APIUsageSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
-class ConversationSummarySerializer(serializers.ModelSerializer):
+class ConversationSummarySerializer(PendingCountersMixin, serializers.ModelSerializer):
     """
     Lightweight serializer for conversation summaries
     """
@@ -163,6 +187,7 @@ class ConversationSummarySerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
+        list_serializer_class = PendingCountersListSerializer
         fields = [
             'id', 'title', 'message_count', 'last_activity',
             'is_archived', 'recent_message'
@@ -170,7 +195,7 @@ class ConversationSummarySerializer(serializers.ModelSerializer):
     
     def get_recent_message(self, obj):
         """Get the most recent message preview"""
-        recent_msg = obj.messages.filter(is_deleted=False).order_by('-created_at').first()
+        recent_msg = obj.messages.visible().order_by('-created_at').first()
         if recent_msg:
             return {
                 'role': recent_msg.role,
@@ -1,8 +1,12 @@
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.db import models
 from django.utils import timezone
-from .models import Conversation, Message
+from .access import invalidate_access
+from .cache_keys import invalidate_context, invalidate_conversation, invalidate_user
+from .models import Conversation, Message, title_from_message
+from .tokenizer import count_tokens
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,43 +18,90 @@ def update_conversation_timestamp(sender, instance, created, **kwargs):
     """
     Update conversation's updated_at timestamp when a new message is added
     """
-    if created and instance.conversation:
-        instance.conversation.updated_at = timezone.now()
-        instance.conversation.save(update_fields=['updated_at'])
-        
-        # Update conversation title if it's the first user message
-        if (instance.role == 'user' and 
-            instance.conversation.title == 'New Chat' and
-            instance.content):
-            # Use first 50 characters of the message as title
-            title = instance.content[:50]
-            if len(instance.content) > 50:
-                title += "..."
-            instance.conversation.title = title
-            instance.conversation.save(update_fields=['title'])
+    # MessageManager.append already updated the conversation in the same transaction
+    if not created or getattr(instance, '_conversation_synced', False):
+        return
+    
+    updates = {'updated_at': timezone.now()}
+    
+    # Update conversation title if it's the first user message
+    title = title_from_message(instance.role, instance.content)
+    if title:
+        updates['title'] = models.Case(
+            models.When(title='New Chat', then=models.Value(title)),
+            default=models.F('title'),
+        )
+    Conversation.objects.filter(pk=instance.conversation_id).update(**updates)
 
 @receiver(pre_delete, sender=Conversation)
 def log_conversation_deletion(sender, instance, **kwargs):
     """
     Log when a conversation is deleted
     """
-    message_count = instance.messages.count()
-    logger.info(f"Deleting conversation '{instance.title}' with {message_count} messages for user {instance.user.username}")
+    logger.info(f"Deleting conversation '{instance.title}' with {instance.message_count} messages for user {instance.user_id}")
 
 @receiver(pre_delete, sender=Message)
 def log_message_deletion(sender, instance, **kwargs):
     """
     Log when a message is deleted
     """
-    logger.info(f"Deleting message from conversation '{instance.conversation.title}' by user {instance.conversation.user.username}")
+    logger.info(f"Deleting message {instance.id} from conversation {instance.conversation_id}")
+
+@receiver(pre_save, sender=Message)
+def calculate_token_count(sender, instance, **kwargs):
+    """
+    Calculate token count before the message is inserted
+    """
+    if instance._state.adding and not instance.token_count:
+        instance.token_count = count_tokens(instance.content, instance.model)
 
 @receiver(post_save, sender=Message)
-def calculate_token_count(sender, instance, created, **kwargs):
+def invalidate_message_caches(sender, instance, **kwargs):
+    """
+    Retire every cached page of the conversation when a message changes
+    """
+    # MessageManager.append bumps the namespaces itself
+    if getattr(instance, '_conversation_synced', False):
+        return
+    invalidate_conversation(instance.conversation_id)
+    # An edited message changes the context prefix assembled for the model
+    invalidate_context(instance.conversation_id)
+    if Message.conversation.is_cached(instance):
+        user_id = instance.conversation.user_id
+    else:
+        user_id = Conversation.objects.filter(pk=instance.conversation_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        invalidate_user(user_id)
+
+@receiver(post_delete, sender=Message)
+def invalidate_deleted_message_caches(sender, instance, **kwargs):
+    """
+    Retire cached pages when a message is removed
+    """
+    invalidate_conversation(instance.conversation_id)
+    invalidate_context(instance.conversation_id)
+    # Cascades from a conversation delete are covered by the conversation handler
+    if Message.conversation.is_cached(instance):
+        invalidate_user(instance.conversation.user_id)
+
+@receiver(post_save, sender=Conversation)
+@receiver(post_delete, sender=Conversation)
+def invalidate_conversation_caches(sender, instance, **kwargs):
+    """
+    Retire the owner's cached conversation lists when a conversation changes
+    """
+    invalidate_conversation(instance.pk)
+    invalidate_user(instance.user_id)
+
+@receiver(post_save, sender=Conversation)
+@receiver(post_delete, sender=Conversation)
+def invalidate_conversation_access(sender, instance, created=False, update_fields=None, **kwargs):
     """
-    Calculate and store token count for messages
+    Forget cached WebSocket authorizations when a conversation is deleted or
+    its sharing or owner may have changed
     """
-    if created and instance.content and not instance.token_count:
-        # Simple token estimation (roughly 4 characters per token)
-        estimated_tokens = len(instance.content) // 4
-        instance.token_count = max(1, estimated_tokens)
-        instance.save(update_fields=['token_count']) 
\ No newline at end of file
+    if created:
+        return
+    if update_fields is not None and not {'is_shared', 'user_id'} & set(update_fields):
+        return
+    invalidate_access(instance.pk)
@@ -0,0 +1,242 @@
+"""
+Single-flight coordination of identical chat requests.
+
+Double-clicks, client retries and reconnects can deliver the same user
+message several times at once. Each request claims a lease on its
+idempotency key in Redis (SET NX PX): the client's Idempotency-Key, or
+else a hash of the conversation and the message content. The first claim
+becomes the leader and runs the upstream call. Later claims find the
+leader's reply id under the key and attach to its stream log
+(chat.stream_log), so they receive the same events without a second call.
+
+The leader renews the lease while it generates; if its worker dies the
+lease expires after SINGLE_FLIGHT_LEASE_SECONDS and the next request runs
+again. A finished flight keeps its key for a short window (for derived
+keys SINGLE_FLIGHT_WINDOW_SECONDS, for client keys as long as the stream
+log lives) so late duplicates replay the result; a failed one releases it
+at once. Renewing and landing only touch the key while it still holds
+this flight's token.
+
+Without Redis every request leads and nothing is deduplicated.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .counters import get_redis
+from .stream_log import get_async_redis
+
+logger = logging.getLogger('chat')
+
+KEY_PREFIX = 'chat:flight:'
+
+# Extend (milliseconds > 0) or release (0) the lease, only while it is ours
+SETTLE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+_lock = threading.Lock()
+_stats = {'led': 0, 'followed': 0}
+
+
+def _flight_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return {
+        'enabled': chat_settings.get('SINGLE_FLIGHT_ENABLED', True) and chat_settings.get('STREAM_LOG_ENABLED', True),
+        'lease': chat_settings.get('SINGLE_FLIGHT_LEASE_SECONDS', 30),
+        'window': chat_settings.get('SINGLE_FLIGHT_WINDOW_SECONDS', 10),
+        'log_ttl': chat_settings.get('STREAM_LOG_TTL', 300),
+    }
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def flight_key(user_id, conversation_id, content, idempotency_key=None):
+    """
+    Redis key shared by duplicates of one request: the client's idempotency
+    key, or the conversation and message content. Scoped to the user.
+    """
+    if idempotency_key:
+        basis = f"client:{idempotency_key}"
+    else:
+        basis = f"message:{conversation_id}:{_digest(content)}"
+    return f"{KEY_PREFIX}{user_id}:{_digest(basis)}"
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _count(leader):
+    with _lock:
+        _stats['led' if leader else 'followed'] += 1
+
+
+def get_flight_stats():
+    """Requests that ran upstream versus duplicates that attached to them"""
+    with _lock:
+        stats = dict(_stats)
+    claims = stats['led'] + stats['followed']
+    stats['dedupe_rate'] = stats['followed'] / claims if claims else 0.0
+    return stats
+
+
+class Flight:
+    """
+    Lease on one idempotency key, held by the leader; synchronous, for
+    views and Celery tasks
+    """
+
+    def __init__(self, key, value, leader=True, client=None, client_key=False):
+        self.key = key
+        self.value = value
+        self.leader = leader
+        self.client = client
+        self.client_key = client_key
+        self.options = _flight_settings()
+        self.message_id = json.loads(value)['message_id']
+        self.renewed_at = time.monotonic()
+
+    @staticmethod
+    def _value(message_id, owner):
+        return json.dumps({'message_id': str(message_id), 'owner': owner, 'token': uuid.uuid4().hex})
+
+    @classmethod
+    def _client(cls):
+        return get_redis() if _flight_settings()['enabled'] else None
+
+    @classmethod
+    def claim(cls, key, message_id, owner, client_key=False):
+        """Lead the flight for `key`, or follow the one already running"""
+        value = cls._value(message_id, owner)
+        client = cls._client()
+        if client is None:
+            return cls(key, value, client_key=client_key)
+        lease_ms = _flight_settings()['lease'] * 1000
+        try:
+            for _ in range(2):
+                if client.set(key, value, nx=True, px=lease_ms):
+                    _count(leader=True)
+                    return cls(key, value, client=client, client_key=client_key)
+                current = client.get(key)
+                if current is not None:
+                    _count(leader=False)
+                    return cls(key, _decode(current), leader=False, client_key=client_key)
+                # The leader's lease ran out in between; try again
+        except Exception as e:
+            logger.warning(f"Single-flight claim failed for {key}: {str(e)}")
+        return cls(key, value, client_key=client_key)
+
+    @classmethod
+    def resume(cls, data):
+        """The leader's lease handed over to a Celery task by to_task()"""
+        return cls(data['key'], data['value'], client=cls._client(), client_key=data.get('client_key', False))
+
+    def to_task(self):
+        return {'key': self.key, 'value': self.value, 'client_key': self.client_key}
+
+    def renew_due(self, now=None):
+        if not self.leader or self.client is None:
+            return False
+        now = time.monotonic() if now is None else now
+        return now - self.renewed_at >= self.options['lease'] / 3
+
+    def _settle_ms(self, ok):
+        """Lease left after landing: the dedupe window, or 0 to release"""
+        if not ok:
+            return 0
+        seconds = self.options['log_ttl'] if self.client_key else self.options['window']
+        return int(seconds * 1000)
+
+    def _settle(self, milliseconds):
+        if not self.leader or self.client is None:
+            return False
+        try:
+            return bool(self.client.eval(SETTLE_SCRIPT, 1, self.key, self.value, milliseconds))
+        except Exception as e:
+            logger.warning(f"Single-flight lease update failed for {self.key}: {str(e)}")
+            return False
+
+    def renew(self, extra_seconds=0):
+        """Extend the lease while the reply is being generated (or waits for a retry)"""
+        self.renewed_at = time.monotonic()
+        return self._settle((self.options['lease'] + extra_seconds) * 1000)
+
+    def land(self, ok=True):
+        """Keep the finished flight for late duplicates, or release a failed one"""
+        return self._settle(self._settle_ms(ok))
+
+
+class AsyncFlight(Flight):
+    """
+    Lease on one idempotency key, for the SSE view and WebSocket consumer
+    """
+
+    @classmethod
+    def _client(cls):
+        return get_async_redis() if _flight_settings()['enabled'] else None
+
+    @classmethod
+    async def claim(cls, key, message_id, owner, client_key=False):
+        value = cls._value(message_id, owner)
+        client = cls._client()
+        if client is None:
+            return cls(key, value, client_key=client_key)
+        lease_ms = _flight_settings()['lease'] * 1000
+        try:
+            for _ in range(2):
+                if await client.set(key, value, nx=True, px=lease_ms):
+                    _count(leader=True)
+                    return cls(key, value, client=client, client_key=client_key)
+                current = await client.get(key)
+                if current is not None:
+                    _count(leader=False)
+                    return cls(key, _decode(current), leader=False, client_key=client_key)
+        except Exception as e:
+            logger.warning(f"Single-flight claim failed for {key}: {str(e)}")
+        return cls(key, value, client_key=client_key)
+
+    async def _settle(self, milliseconds):
+        if not self.leader or self.client is None:
+            return False
+        try:
+            return bool(await self.client.eval(SETTLE_SCRIPT, 1, self.key, self.value, milliseconds))
+        except Exception as e:
+            logger.warning(f"Single-flight lease update failed for {self.key}: {str(e)}")
+            return False
+
+    async def renew(self, extra_seconds=0):
+        self.renewed_at = time.monotonic()
+        return await self._settle((self.options['lease'] + extra_seconds) * 1000)
+
+    async def land(self, ok=True):
+        return await self._settle(self._settle_ms(ok))
+
+    async def held(self):
+        """
+        True while the flight still holds its key: the leader has not failed
+        and its lease (or the dedupe window after landing) has not run out.
+        Used by duplicates to keep following a leader that starts late.
+        """
+        client = self.client or self._client()
+        if client is None:
+            return False
+        try:
+            return _decode(await client.get(self.key)) == self.value
+        except Exception as e:
+            logger.warning(f"Single-flight lease check failed for {self.key}: {str(e)}")
+            return False
@@ -0,0 +1,185 @@
+"""
+Per-message Redis Stream log of an assistant generation.
+
+Every event of a generation (stream_start, content deltas, then complete or
+error) is XADDed to ``chat:stream:<message_id>`` while it is produced, and
+the key expires STREAM_LOG_TTL seconds after the last write. The entry id
+doubles as the SSE event id, so a client that reconnects sends it back as
+``Last-Event-ID`` (or in a WebSocket ``resume`` message) and read_events()
+replays everything after it, then keeps tailing until the generation ends.
+No upstream call is repeated.
+
+Without a Redis cache backend the log is disabled and every writer method is
+a no-op returning None.
+"""
+
+import json
+import logging
+import re
+
+from django.conf import settings
+
+from . import counters
+from .counters import get_redis
+
+logger = logging.getLogger('chat')
+
+KEY_PREFIX = 'chat:stream:'
+TERMINAL_EVENTS = ('complete', 'error')
+EVENT_ID_RE = re.compile(r'^\d+-\d+$')
+
+def _log_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return {
+        'enabled': chat_settings.get('STREAM_LOG_ENABLED', True),
+        'ttl': chat_settings.get('STREAM_LOG_TTL', 300),
+        'maxlen': chat_settings.get('STREAM_LOG_MAXLEN', 20000),
+        'idle_timeout': chat_settings.get('STREAM_LOG_IDLE_TIMEOUT', 60),
+    }
+
+
+def stream_key(message_id):
+    return f"{KEY_PREFIX}{message_id}"
+
+
+def is_valid_event_id(event_id):
+    return bool(event_id and EVENT_ID_RE.match(event_id))
+
+
+def get_async_redis():
+    """redis.asyncio client for the running loop, or None without Redis or the log"""
+    if not _log_settings()['enabled']:
+        return None
+    return counters.get_async_redis()
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _entry(payload, owner=None):
+    fields = {'event': json.dumps(payload)}
+    if owner is not None:
+        fields['owner'] = owner
+    return fields
+
+
+class StreamLog:
+    """
+    Synchronous writer, used by Celery tasks
+    """
+
+    def __init__(self, message_id):
+        self.key = stream_key(message_id)
+        self.options = _log_settings()
+        self.client = get_redis() if self.options['enabled'] else None
+
+    @property
+    def enabled(self):
+        return self.client is not None
+
+    def _write(self, payload, owner=None, reset=False):
+        if self.client is None:
+            return None
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            if reset:
+                pipe.delete(self.key)
+            pipe.xadd(self.key, _entry(payload, owner), maxlen=self.options['maxlen'], approximate=True)
+            pipe.expire(self.key, self.options['ttl'])
+            return _decode(pipe.execute()[-2])
+        except Exception as e:
+            # Losing resumability must never fail the generation itself
+            logger.warning(f"Stream log write failed for {self.key}: {str(e)}")
+            self.client = None
+            return None
+
+    def start(self, payload, owner):
+        """Begin (or restart, on a retry) the log; returns the entry id"""
+        return self._write(payload, owner=owner, reset=True)
+
+    def append(self, payload):
+        return self._write(payload)
+
+
+class AsyncStreamLog(StreamLog):
+    """
+    Asynchronous writer, used by the SSE view
+    """
+
+    def __init__(self, message_id):
+        self.key = stream_key(message_id)
+        self.options = _log_settings()
+        self.client = get_async_redis()
+
+    async def _write(self, payload, owner=None, reset=False):
+        if self.client is None:
+            return None
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            if reset:
+                pipe.delete(self.key)
+            pipe.xadd(self.key, _entry(payload, owner), maxlen=self.options['maxlen'], approximate=True)
+            pipe.expire(self.key, self.options['ttl'])
+            return _decode((await pipe.execute())[-2])
+        except Exception as e:
+            logger.warning(f"Stream log write failed for {self.key}: {str(e)}")
+            self.client = None
+            return None
+
+    async def start(self, payload, owner):
+        return await self._write(payload, owner=owner, reset=True)
+
+    async def append(self, payload):
+        return await self._write(payload)
+
+
+async def get_owner(message_id):
+    """User id that started the logged generation, or None if there is no log"""
+    client = get_async_redis()
+    if client is None:
+        return None
+    entries = await client.xrange(stream_key(message_id), count=1)
+    if not entries:
+        return None
+    _, fields = entries[0]
+    return _decode(fields.get(b'owner'))
+
+
+async def read_events(message_id, after=None, while_held=None):
+    """
+    Yield (event_id, payload) for every logged event after `after`.
+
+    Keeps tailing a generation that is still running until its complete or
+    error event, and gives up after STREAM_LOG_IDLE_TIMEOUT seconds without
+    a new event (the generating worker died) or once the log expires.
+
+    `while_held` is the AsyncFlight.held of the request being followed.
+    While it returns True the reader keeps waiting, even for a log that has
+    not started yet because the leader's Celery task is still queued.
+    """
+    client = get_async_redis()
+    if client is None:
+        return
+    key = stream_key(message_id)
+    last_id = after or '0-0'
+    idle_timeout_ms = int(_log_settings()['idle_timeout'] * 1000)
+    block_ms = min(5000, idle_timeout_ms)
+    waited_ms = 0
+
+    while True:
+        response = await client.xread({key: last_id}, count=500, block=block_ms)
+        if not response:
+            waited_ms += block_ms
+            if while_held is not None and await while_held():
+                continue
+            if waited_ms >= idle_timeout_ms or not await client.exists(key):
+                return
+            continue
+        waited_ms = 0
+        for entry_id, fields in response[0][1]:
+            last_id = _decode(entry_id)
+            payload = json.loads(fields[b'event'])
+            yield last_id, payload
+            if payload.get('type') in TERMINAL_EVENTS:
+                return
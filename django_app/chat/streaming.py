@@ -0,0 +1,475 @@
+"""
+Server-sent event streaming of chat completions.
+
+The event stream is a native async generator: under ASGI (Daphne/uvicorn)
+Django drives it on the server's event loop, so a generation in flight
+holds a coroutine rather than a worker thread, and the upstream stream is
+read directly with ``async for``. ORM work goes through the async ORM, or
+through sync_to_async where a transaction is needed.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django_ratelimit.core import is_ratelimited
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .checkpoints import ReplyCheckpoint, start_reply
+from .coalescing import DeltaCoalescer
+from .completion_cache import completion_options, default_options, lookup, replay_pieces, request_key, store
+from .context import build_context
+from .llm_clients import get_async_client
+from .models import APIUsage, Conversation, Message
+from .single_flight import AsyncFlight, flight_key
+from .stream_log import AsyncStreamLog, get_owner, is_valid_event_id, read_events
+from .tasks import schedule_summary
+
+logger = logging.getLogger('chat')
+
+# Generations that outlive their response and pending flushes; referenced so
+# they are not collected
+_background = set()
+
+
+def _keep(task):
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+def sse(payload, event_id=None):
+    """Format one server-sent event, with an id when it can be resumed from"""
+    if event_id:
+        return f"id: {event_id}\ndata: {json.dumps(payload)}\n\n"
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def usage_context(request):
+    """Request details recorded with APIUsage once a stream completes"""
+    request = getattr(request, '_request', request)
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+    return {
+        'endpoint': request.path,
+        'ip_address': forwarded.split(',')[0].strip() or request.META.get('REMOTE_ADDR') or '127.0.0.1',
+        'user_agent': request.META.get('HTTP_USER_AGENT', '')[:500],
+    }
+
+
+async def log_usage(user_id, usage, response_time, tokens):
+    """Record the completed stream; never fails the response"""
+    try:
+        await sync_to_async(APIUsage.log_request)(
+            user_id=user_id,
+            method='POST',
+            status_code=200,
+            response_time=response_time,
+            tokens_used=tokens,
+            **usage
+        )
+    except Exception as e:
+        logger.warning(f"API usage logging failed: {str(e)}")
+
+
+async def upstream_text(stream):
+    """Text deltas of an upstream completion stream, closing it when done"""
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+
+
+async def replay(content):
+    """A cached reply as deltas, yielding to the loop between them like a live stream"""
+    for piece in replay_pieces(content):
+        yield piece
+        await asyncio.sleep(0)
+
+
+async def generate_reply(conversation, message_id, history, model, api_key, user_id, usage, log, send,
+                         options=None, flight=None):
+    """
+    Run one completion to the end, passing SSE frames to `send` (None when
+    finished) and recording every event in the stream log.
+
+    Deltas are coalesced into content frames; a timer releases a pending
+    frame when its window runs out before the next delta arrives. The reply
+    is stored up front as a streaming placeholder and checkpointed in the
+    background, with at most one checkpoint UPDATE in flight. Requests the
+    completion cache can answer are replayed from it instead of calling
+    upstream. The single-flight lease of the request, if any, is renewed
+    while the reply is generated and landed when it ends.
+    """
+    options = options or default_options()
+    loop = asyncio.get_running_loop()
+    coalescer = DeltaCoalescer()
+    # Timer flushes and the read loop both publish; keep log entries in order
+    ordered = asyncio.Lock()
+    timer = None
+    checkpoint = None
+    saving = None
+
+    async def publish(payload):
+        async with ordered:
+            send(sse(payload, await log.append(payload)))
+
+    async def publish_content(text):
+        if text:
+            await publish({'type': 'content', 'content': text})
+
+    async def flush_due():
+        nonlocal timer
+        timer = None
+        if coalescer.due():
+            await publish_content(coalescer.flush())
+        else:
+            arm_timer()
+
+    def arm_timer():
+        nonlocal timer
+        remaining = coalescer.remaining()
+        if timer is None and remaining is not None:
+            timer = loop.call_later(remaining, lambda: _keep(loop.create_task(flush_due())))
+
+    async def settle(status, **fields):
+        """Wait for the checkpoint in flight, then store the final reply"""
+        if saving is not None:
+            await asyncio.gather(saving, return_exceptions=True)
+        return await Message.objects.afinish(checkpoint.message, checkpoint.content, status=status, **fields)
+
+    try:
+        placeholder = await sync_to_async(start_reply)(conversation, model, message_id)
+        checkpoint = ReplyCheckpoint(placeholder)
+
+        start_time = time.time()
+        cache_key = request_key(model, history, options)
+        cached = await sync_to_async(lookup)(model, cache_key) if cache_key else None
+        if cached is not None:
+            deltas = replay(cached['content'])
+        else:
+            client = get_async_client(api_key)
+            deltas = upstream_text(await client.chat.completions.create(
+                model=model,
+                messages=history,
+                stream=True,
+                temperature=options['temperature'],
+                max_tokens=options['max_tokens']
+            ))
+        try:
+            async for content in deltas:
+                checkpoint.add(content)
+                await publish_content(coalescer.add(content))
+                arm_timer()
+                if checkpoint.due() and (saving is None or saving.done()):
+                    saving = _keep(loop.create_task(
+                        Message.objects.acheckpoint(message_id, checkpoint.mark())
+                    ))
+                if flight is not None and flight.renew_due():
+                    _keep(loop.create_task(flight.renew()))
+        finally:
+            await deltas.aclose()
+            if timer is not None:
+                timer.cancel()
+            await publish_content(coalescer.finish())
+
+        response_time = time.time() - start_time
+
+        # Tokens are counted in finish(), off the event loop
+        assistant_msg = await settle(Message.COMPLETE, response_time=response_time)
+        await publish({'type': 'complete', 'message': assistant_msg.get_summary()})
+        if flight is not None:
+            await flight.land(ok=True)
+
+        if cached is None and cache_key:
+            await sync_to_async(store)(model, cache_key, assistant_msg.content, assistant_msg.token_count)
+
+        # A cached reply cost no upstream tokens
+        await log_usage(user_id, usage, response_time, 0 if cached is not None else assistant_msg.token_count)
+        await sync_to_async(schedule_summary)(conversation, api_key)
+
+    except asyncio.CancelledError:
+        logger.info(f"Stream cancelled for conversation {conversation.id}")
+        if checkpoint is not None:
+            await settle(Message.ABORTED, error_message='Stream cancelled')
+        if flight is not None:
+            await flight.land(ok=False)
+        raise
+    except Exception as e:
+        logger.error(f"Streaming response failed: {str(e)}")
+        if checkpoint is not None:
+            try:
+                await settle(Message.ABORTED, error_message=str(e))
+            except Exception as save_error:
+                logger.error(f"Saving aborted reply failed: {str(save_error)}")
+        if flight is not None:
+            await flight.land(ok=False)
+        await publish({'type': 'error', 'error': str(e)})
+    finally:
+        send(None)
+
+
+async def follow_events(flight):
+    """
+    Events of the reply of the request leading `flight`: its stream log,
+    followed for as long as the lease is held, or once that has expired, the
+    stored reply
+    """
+    followed = False
+    async for event_id, payload in read_events(flight.message_id, while_held=flight.held):
+        followed = True
+        yield sse(payload, event_id)
+    if followed:
+        return
+    reply = await Message.objects.filter(pk=flight.message_id, status=Message.COMPLETE).afirst()
+    if reply is not None:
+        yield sse({'type': 'complete', 'message': reply.get_summary()})
+    else:
+        yield sse({'type': 'error', 'error': 'The original request did not finish'})
+
+
+async def stream_chat_events(conversation, message, model, api_key, user_id, usage, options=None,
+                             idempotency_key=None):
+    """
+    Store the user message, stream the completion and store the reply,
+    yielding SSE frames along the way. `usage` comes from usage_context()
+    and `options` from completion_options().
+
+    A duplicate of a request that is still running or just finished (same
+    idempotency key, or same message in the same conversation) follows
+    that request's reply instead; see chat.single_flight.
+
+    The completion runs in its own task. When the stream log is available
+    and the client disconnects, that task carries on so the reply is still
+    stored and can be resumed from chat_stream_resume.
+    """
+    flight = None
+    try:
+        message_id = uuid.uuid4()
+        flight = await AsyncFlight.claim(
+            flight_key(user_id, conversation.id, message, idempotency_key),
+            message_id,
+            user_id,
+            client_key=bool(idempotency_key)
+        )
+        if not flight.leader:
+            logger.info(f"Duplicate request in conversation {conversation.id} follows reply {flight.message_id}")
+            async for frame in follow_events(flight):
+                yield frame
+            return
+
+        user_msg = await Message.objects.aappend(conversation, 'user', message, model=model)
+        yield sse({'type': 'user_message', 'message': user_msg.get_summary()})
+
+        log = AsyncStreamLog(message_id)
+        payload = {'type': 'stream_start', 'message_id': str(message_id), 'conversation_id': str(conversation.id)}
+        yield sse(payload, await log.start(payload, owner=user_id))
+
+        options = options or default_options()
+        history = await sync_to_async(build_context)(conversation, model, max_tokens=options['max_tokens'])
+    except Exception as e:
+        logger.error(f"Streaming response failed: {str(e)}")
+        if flight is not None:
+            await flight.land(ok=False)
+        yield sse({'type': 'error', 'error': str(e)})
+        return
+    except BaseException:
+        # Cancelled or closed before the reply started; let a retry run it
+        if flight is not None:
+            await flight.land(ok=False)
+        raise
+
+    frames = asyncio.Queue()
+    producer = asyncio.ensure_future(generate_reply(
+        conversation, message_id, history, model, api_key, user_id, usage, log, frames.put_nowait, options, flight
+    ))
+    try:
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                break
+            yield frame
+    finally:
+        if not producer.done():
+            if log.enabled:
+                # Nobody is listening any more; finish into the log
+                _keep(producer)
+            else:
+                producer.cancel()
+
+
+def drive_sync(events):
+    """
+    Iterate an async event stream from sync code.
+
+    Only used when serving under WSGI, which would otherwise buffer the whole
+    async stream before sending it. One loop serves the whole response.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(events.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(events.aclose())
+        # Generations the client walked away from still finish into their log
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+def event_stream_response(request, events):
+    """StreamingHttpResponse for an async SSE generator, native under ASGI"""
+    # DRF wraps the Django request
+    if not isinstance(getattr(request, '_request', request), ASGIRequest):
+        events = drive_sync(events)
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def authenticate(request):
+    """
+    Authenticate a plain Django request with DEFAULT_AUTHENTICATION_CLASSES.
+
+    The SSE views are not DRF views, so this gives them the same clients as
+    the API: sessions and API keys. SessionAuthentication enforces CSRF
+    itself, and only for session-authenticated requests. Raises an
+    APIException on failure.
+    """
+    authenticators = [authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    return Request(request, authenticators=authenticators).user
+
+
+async def authenticated_user(request):
+    """The authenticated user, or a JsonResponse to return instead"""
+    try:
+        user = await sync_to_async(authenticate)(request)
+    except exceptions.APIException as e:
+        return JsonResponse({'error': str(e.detail)}, status=e.status_code)
+    if not user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    return user
+
+
+async def chat_stream(request):
+    """
+    Async SSE chat endpoint.
+
+    Accepts the same JSON body as chat_message and streams user_message,
+    content, complete and error events.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    user = await authenticated_user(request)
+    if isinstance(user, JsonResponse):
+        return user
+
+    limited = await sync_to_async(is_ratelimited)(
+        request=request, group='chat.stream', key=lambda group, request: str(user.id),
+        rate='60/m', method='POST', increment=True
+    )
+    if limited:
+        return JsonResponse({'error': 'Rate limit exceeded'}, status=429)
+
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+    conversation_id = data.get('conversation_id')
+    message = (data.get('message') or '').strip()
+    model = data.get('model', 'openai/gpt-4o-mini')
+    api_key = data.get('api_key')
+
+    # Validation
+    if not conversation_id or not message:
+        return JsonResponse({'error': 'Conversation ID and message are required'}, status=400)
+    if not api_key:
+        return JsonResponse({'error': 'API key is required'}, status=400)
+    try:
+        options = completion_options(data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    try:
+        conversation = await Conversation.objects.aget(id=conversation_id, user_id=str(user.id))
+    except (Conversation.DoesNotExist, ValidationError):
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+
+    return event_stream_response(
+        request,
+        stream_chat_events(
+            conversation, message, model, api_key, str(user.id), usage_context(request), options,
+            idempotency_key=data.get('idempotency_key') or request.headers.get('Idempotency-Key')
+        )
+    )
+
+
+# Authentication decides whether CSRF applies; csrf_exempt() itself only
+# wraps async views from Django 5.0
+chat_stream.csrf_exempt = True
+
+
+async def resume_events(message_id, last_event_id):
+    async for event_id, payload in read_events(message_id, after=last_event_id):
+        yield sse(payload, event_id)
+
+
+async def finished_events(message):
+    yield sse({'type': 'complete', 'message': message.get_summary()})
+
+
+async def chat_stream_resume(request, message_id):
+    """
+    Resume an assistant reply by message id.
+
+    Replays the logged events after the `Last-Event-ID` header (or the
+    `last_event_id` query parameter) and follows the generation until it
+    ends. Once the log has expired, a finished reply is sent as a single
+    complete event.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    user = await authenticated_user(request)
+    if isinstance(user, JsonResponse):
+        return user
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    if last_event_id and not is_valid_event_id(last_event_id):
+        return JsonResponse({'error': 'Invalid event id'}, status=400)
+
+    try:
+        owner = await get_owner(message_id)
+    except Exception as e:
+        logger.warning(f"Stream log unavailable: {str(e)}")
+        owner = None
+
+    if owner is not None:
+        if owner != str(user.id):
+            return JsonResponse({'error': 'Stream not found'}, status=404)
+        return event_stream_response(request, resume_events(message_id, last_event_id))
+
+    message = await Message.objects.filter(
+        id=message_id,
+        conversation__user_id=str(user.id),
+        is_deleted=False
+    ).afirst()
+    if message is None:
+        return JsonResponse({'error': 'Stream not found'}, status=404)
+    return event_stream_response(request, finished_events(message))
@@ -0,0 +1,260 @@
+"""
+Rolling summaries of long conversations.
+
+Once the turns a conversation's summary does not cover yet pass
+SUMMARY_THRESHOLD_TOKENS, summarize() folds all but the newest
+SUMMARY_KEEP_RECENT_TOKENS of them into the summary: the previous summary
+and the new turns go into one completion call and the updated summary comes
+out. Each call folds at most SUMMARY_BATCH_TOKENS of turns.
+
+The summary is a system Message tagged metadata['kind'] == 'summary', left
+out of message listings (MessageQuerySet.visible), that records the last
+message it covers. build_context() sends it followed by the turns after
+that message. Run from the summarize_conversation Celery task.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .llm_clients import get_sync_client
+from .models import SUMMARY_KIND, Message
+from .tokenizer import TOKENS_PER_MESSAGE, count_tokens
+
+logger = logging.getLogger('chat')
+
+SUMMARY_HEADER = 'Summary of the earlier conversation:\n'
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI "
+    "assistant. Merge the new turns into the current summary. Keep facts, "
+    "decisions, names, numbers, code identifiers and open questions; drop "
+    "greetings and repetition. Write plain prose in the third person, at most "
+    "{words} words. Reply with the summary only."
+)
+
+_lock = threading.Lock()
+_stats = {
+    'runs': 0,
+    'skipped': 0,
+    'summaries': 0,
+    'messages_summarized': 0,
+    'tokens_saved': 0,
+}
+
+
+def _summary_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return {
+        'enabled': chat_settings.get('SUMMARY_ENABLED', False),
+        'threshold': chat_settings.get('SUMMARY_THRESHOLD_TOKENS', 3000),
+        'keep_recent': chat_settings.get('SUMMARY_KEEP_RECENT_TOKENS', 1000),
+        'batch': chat_settings.get('SUMMARY_BATCH_TOKENS', 6000),
+        'model': chat_settings.get('SUMMARY_MODEL', 'openai/gpt-4o-mini'),
+        'max_tokens': chat_settings.get('SUMMARY_MAX_TOKENS', 500),
+    }
+
+
+def _count(stat, value=1):
+    with _lock:
+        _stats[stat] += value
+
+
+def after(queryset, marker):
+    """Rows after a {'id', 'created_at'} marker, in (created_at, id) order"""
+    if marker is None:
+        return queryset
+    return queryset.filter(
+        Q(created_at__gt=marker['created_at']) | Q(created_at=marker['created_at'], id__gt=marker['id'])
+    )
+
+
+def latest_summary(conversation):
+    """The conversation's rolling summary message, or None"""
+    return Message.objects.summaries().filter(conversation=conversation).order_by('-created_at').first()
+
+
+def covered_through(summary):
+    """Marker of the last message a summary covers"""
+    if summary is None:
+        return None
+    return {'id': summary.metadata['through_id'], 'created_at': summary.metadata['through']}
+
+
+def tokens_saved(summary):
+    """Prompt tokens each request saves by sending the summary instead of the turns it covers"""
+    if summary is None:
+        return 0
+    return max(summary.metadata.get('source_tokens', 0) - summary.token_count - TOKENS_PER_MESSAGE, 0)
+
+
+def _report(summary):
+    metadata = summary.metadata if summary is not None else {}
+    return {
+        'summarized_messages': metadata.get('messages', 0),
+        'summarized_tokens': metadata.get('source_tokens', 0),
+        'summary_tokens': summary.token_count if summary is not None else 0,
+        'prompt_tokens_saved': tokens_saved(summary),
+    }
+
+
+def summary_report(conversation):
+    """What the rolling summary of a conversation covers and saves, or None"""
+    summary = latest_summary(conversation)
+    return _report(summary) if summary is not None else None
+
+
+def needs_summary(conversation):
+    """Cheap check on the stored totals, before queueing the summarizer"""
+    options = _summary_settings()
+    return options['enabled'] and conversation.total_tokens >= options['threshold']
+
+
+def _to_fold(conversation, summary, options):
+    """
+    (id, created_at, prompt tokens) of the turns to fold into the summary
+    next, oldest first; empty while the uncovered turns are under the threshold
+    """
+    rows = after(
+        Message.objects.visible().filter(conversation=conversation),
+        covered_through(summary)
+    ).order_by('created_at', 'id').values_list('id', 'created_at', 'token_count', 'status')
+
+    uncovered = []
+    for pk, created_at, tokens, status in rows:
+        # Never fold past a reply that is still streaming
+        if status == Message.STREAMING:
+            break
+        uncovered.append((pk, created_at, tokens + TOKENS_PER_MESSAGE))
+    if sum(cost for _, _, cost in uncovered) < options['threshold']:
+        return []
+
+    # The newest turns stay verbatim
+    kept = 0
+    split = len(uncovered)
+    while split > 0 and kept + uncovered[split - 1][2] <= options['keep_recent']:
+        split -= 1
+        kept += uncovered[split][2]
+
+    batch = []
+    spent = 0
+    for row in uncovered[:split]:
+        if batch and spent + row[2] > options['batch']:
+            break
+        batch.append(row)
+        spent += row[2]
+    return batch
+
+
+def _prompt(summary, messages, max_tokens):
+    previous = (summary.content or '').removeprefix(SUMMARY_HEADER) if summary is not None else '(none yet)'
+    transcript = '\n\n'.join(f"{message.role}: {message.content or ''}" for message in messages)
+    return [
+        {'role': 'system', 'content': SUMMARY_PROMPT.format(words=max_tokens * 3 // 4)},
+        {'role': 'user', 'content': f"Current summary:\n{previous}\n\nNew turns:\n{transcript}"},
+    ]
+
+
+def _fold(conversation, summary, batch, client, options):
+    """Fold one batch of turns into the summary with one completion call"""
+    messages = Message.objects.filter(pk__in=[pk for pk, _, _ in batch]).order_by('created_at', 'id').decrypted()
+    response = client.chat.completions.create(
+        model=options['model'],
+        messages=_prompt(summary, messages, options['max_tokens']),
+        temperature=0.2,
+        max_tokens=options['max_tokens']
+    )
+    text = (response.choices[0].message.content or '').strip()
+    if not text:
+        raise ValueError('Summarizer returned an empty summary')
+
+    previous = summary.metadata if summary is not None else {}
+    last_id, last_created_at, _ = batch[-1]
+    content = SUMMARY_HEADER + text
+    metadata = {
+        'kind': SUMMARY_KIND,
+        'through': last_created_at.isoformat(),
+        'through_id': str(last_id),
+        'messages': previous.get('messages', 0) + len(batch),
+        'source_tokens': previous.get('source_tokens', 0) + sum(cost for _, _, cost in batch),
+    }
+    saved_before = tokens_saved(summary)
+
+    if summary is None:
+        summary = Message.objects.create(
+            conversation=conversation,
+            role='system',
+            content=content,
+            model=options['model'],
+            metadata=metadata,
+            token_count=count_tokens(content, options['model'])
+        )
+    else:
+        summary.content = content
+        summary.metadata = metadata
+        summary.token_count = count_tokens(content, options['model'])
+        summary.save()
+
+    _count('summaries')
+    _count('messages_summarized', len(batch))
+    _count('tokens_saved', tokens_saved(summary) - saved_before)
+    return summary
+
+
+def summarize(conversation, api_key, model=None, base_url=None):
+    """
+    Bring the rolling summary of `conversation` up to date.
+
+    Returns the per-conversation report, with 'folded' set to the number of
+    messages folded in by this call; None when another worker holds the
+    conversation.
+    """
+    options = _summary_settings()
+    if model:
+        options['model'] = model
+    lock_key = f"summarize:{conversation.id}"
+    if not cache.add(lock_key, 1, 300):
+        return None
+
+    _count('runs')
+    try:
+        summary = latest_summary(conversation)
+        client = None
+        folded = 0
+        while True:
+            batch = _to_fold(conversation, summary, options)
+            if not batch:
+                break
+            client = client or get_sync_client(api_key, base_url=base_url)
+            summary = _fold(conversation, summary, batch, client, options)
+            folded += len(batch)
+        if not folded:
+            _count('skipped')
+        else:
+            logger.info(
+                f"Summarized {folded} messages of conversation {conversation.id}, "
+                f"saving {tokens_saved(summary)} prompt tokens per request"
+            )
+    finally:
+        cache.delete(lock_key)
+
+    report = _report(summary)
+    report['folded'] = folded
+    return report
+
+
+def get_summary_stats():
+    """Summarizer runs, messages folded and prompt tokens saved per request, in this process"""
+    with _lock:
+        stats = dict(_stats)
+    stats['skip_rate'] = stats['skipped'] / stats['runs'] if stats['runs'] else 0.0
+    return stats
+
+
+def reset_summary_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -1,79 +1,132 @@
 import logging
 import time
-import asyncio
+import uuid
 from celery import shared_task
 from django.core.cache import cache
 from django.utils import timezone
 from django.conf import settings
+from django.db import models
 from datetime import timedelta
-import openai
 import aiohttp
 import json
 
+from . import counters
+from .broadcast import ReplyBroadcast
+from .checkpoints import ReplyCheckpoint, start_reply
+from .coalescing import DeltaCoalescer
+from .completion_cache import default_options, lookup, replay_pieces, request_key, store
+from .context import build_context
+from .llm_clients import get_sync_client
 from .models import Conversation, Message, FileUpload, APIUsage
+from .single_flight import Flight
+from .stream_log import StreamLog
+from .summaries import needs_summary, summarize
+from .tokenizer import count_tokens
 
 logger = logging.getLogger('chat')
 
 @shared_task(bind=True, max_retries=3)
-def process_ai_chat_request(self, conversation_id, user_message, model, api_key, user_id):
+def process_ai_chat_request(self, conversation_id, user_message, model, api_key, user_id, message_id=None,
+                           options=None, flight=None, user_message_id=None):
     """
-    Process AI chat request in background with retry logic
+    Process AI chat request in background with retry logic.
+
+    The reply is streamed upstream and every delta is recorded in the
+    stream log of `message_id` (the id the assistant message is stored
+    under), so clients can follow or resume it while it is generated. The
+    message itself is appended first as a streaming placeholder and
+    checkpointed as the reply grows; retries reuse it. `options` are the
+    request's completion_options(); a reply the completion cache already
+    holds is replayed from it. `flight` is the single-flight lease the view
+    claimed for the request; it is renewed while the reply is generated and
+    landed when the task is done.
+
+    The same events are published to the conversation's WebSocket group
+    (chat.broadcast) as they are logged. `user_message_id` is the user
+    message when the caller stored it already, as chat_message and
+    ChatConsumer do; otherwise the first attempt stores it and retries
+    do not.
     """
+    options = options or default_options()
+    flight = Flight.resume(flight) if flight else None
+    if not message_id:
+        # Stable across retries of this task, so they share one placeholder
+        message_id = str(uuid.uuid5(uuid.NAMESPACE_OID, self.request.id) if self.request.id else uuid.uuid4())
+    checkpoint = None
     try:
         start_time = time.time()
         
         # Get conversation
         conversation = Conversation.objects.get(id=conversation_id)
         
-        # Create user message
-        user_msg = Message.objects.create_message(
-            conversation=conversation,
-            role='user',
-            content=user_message,
-            model=model
-        )
+        # Create user message, unless the caller or an earlier attempt stored it
+        if not user_message_id and not self.request.retries:
+            Message.objects.create_message(
+                conversation=conversation,
+                role='user',
+                content=user_message,
+                model=model
+            )
         
-        # Initialize OpenAI client
-        client = openai.AsyncOpenAI(
-            api_key=api_key,
-            base_url="https://openrouter.ai/api/v1"
-        )
+        # Shared keep-alive client for this key
+        client = get_sync_client(api_key)
         
-        # Get conversation history
-        messages = []
-        for msg in conversation.get_recent_messages(limit=20):
-            messages.append({
-                'role': msg.role,
-                'content': msg.content
-            })
+        # Conversation history that fits the model's context window
+        messages = build_context(conversation, model, max_tokens=options['max_tokens'])
         
-        # Make AI request
-        response = asyncio.run(make_ai_request(client, messages, model))
+        # Make AI request, logging deltas and checkpointing the reply as they arrive
+        checkpoint = ReplyCheckpoint(start_reply(conversation, model, message_id))
+        log = StreamLog(message_id)
+        log.start(
+            {'type': 'stream_start', 'message_id': message_id, 'conversation_id': str(conversation_id)},
+            owner=user_id
+        )
+        broadcast = ReplyBroadcast(conversation_id, message_id, model)
+        broadcast.start()
+        cache_key = request_key(model, messages, options)
+        cached = lookup(model, cache_key) if cache_key else None
+        try:
+            content, tokens_used = make_ai_request(
+                client, messages, model, log, checkpoint, options, cached, flight, broadcast
+            )
+        except Exception as exc:
+            log.append({'type': 'error', 'error': str(exc)})
+            broadcast.error(str(exc))
+            raise
         
         # Calculate metrics
         response_time = time.time() - start_time
-        tokens_used = response.get('usage', {}).get('total_tokens', 0)
         
-        # Create assistant message
-        assistant_msg = Message.objects.create_message(
-            conversation=conversation,
-            role='assistant',
-            content=response['choices'][0]['message']['content'],
-            model=model,
-            tokens=tokens_used
+        # Store the finished assistant message
+        assistant_msg = Message.objects.finish(
+            checkpoint.message,
+            content,
+            tokens=tokens_used,
+            response_time=response_time
         )
-        assistant_msg.response_time = response_time
-        assistant_msg.save(update_fields=['response_time'])
+        summary = assistant_msg.get_summary()
+        log.append({'type': 'complete', 'message': summary})
+        broadcast.complete(summary)
+        if cached is None and cache_key:
+            store(model, cache_key, assistant_msg.content, assistant_msg.token_count)
+        if flight is not None:
+            flight.land(ok=True)
+        
+        # Log API usage; the reply is already stored and must not be retried
+        try:
+            APIUsage.log_request(
+                user_id=user_id,
+                endpoint='/api/chat/',
+                method='POST',
+                status_code=200,
+                response_time=response_time,
+                tokens_used=tokens_used,
+                ip_address='0.0.0.0'
+            )
+        except Exception as e:
+            logger.warning(f"API usage logging failed: {str(e)}")
         
-        # Log API usage
-        APIUsage.log_request(
-            user_id=user_id,
-            endpoint='/api/chat/',
-            method='POST',
-            status_code=200,
-            response_time=response_time,
-            tokens_used=tokens_used
-        )
+        schedule_summary(conversation, api_key)
         
         logger.info(f"AI chat request processed successfully for conversation {conversation_id}")
         
@@ -91,19 +144,34 @@ def process_ai_chat_request(self, conversation_id, user_message, model, api_key,
         # Retry logic
         if self.request.retries < self.max_retries:
             logger.info(f"Retrying AI chat request (attempt {self.request.retries + 1})")
-            raise self.retry(countdown=60 * (2 ** self.request.retries))
+            countdown = 60 * (2 ** self.request.retries)
+            if flight is not None:
+                # Duplicates keep following this request through the retry
+                flight.renew(extra_seconds=countdown)
+            raise self.retry(countdown=countdown)
         
-        # Create error message
+        if flight is not None:
+            flight.land(ok=False)
+        
+        # Keep whatever was generated, or explain the failure
         try:
-            conversation = Conversation.objects.get(id=conversation_id)
-            error_msg = Message.objects.create_message(
-                conversation=conversation,
-                role='assistant',
-                content=f"I apologize, but I encountered an error processing your request: {str(exc)}",
-                model=model
-            )
-            error_msg.error_message = str(exc)
-            error_msg.save(update_fields=['error_message'])
+            apology = f"I apologize, but I encountered an error processing your request: {str(exc)}"
+            if checkpoint is not None:
+                Message.objects.finish(
+                    checkpoint.message,
+                    checkpoint.content or apology,
+                    status=Message.ABORTED,
+                    error_message=str(exc)
+                )
+            else:
+                conversation = Conversation.objects.get(id=conversation_id)
+                Message.objects.create_message(
+                    conversation=conversation,
+                    role='assistant',
+                    content=apology,
+                    model=model,
+                    error_message=str(exc)
+                )
         except Exception as e:
             logger.error(f"Failed to create error message: {str(e)}")
         
@@ -113,24 +181,99 @@ def process_ai_chat_request(self, conversation_id, user_message, model, api_key,
         }
 
 
-async def make_ai_request(client, messages, model):
+def upstream_text(stream, usage):
+    """Text deltas of an upstream completion stream; fills `usage` from its last chunk"""
+    with stream:
+        for chunk in stream:
+            if chunk.usage:
+                usage['total_tokens'] = chunk.usage.total_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+def make_ai_request(client, messages, model, log, checkpoint, options=None, cached=None, flight=None,
+                    broadcast=None):
     """
-    Make async AI request with proper error handling
+    Stream an AI request, or replay a `cached` reply, into the stream log,
+    the WebSocket `broadcast` and the reply checkpoint, renewing the
+    single-flight lease as it goes; returns (content, tokens used upstream)
     """
+    options = options or default_options()
+    
+    def emit(text):
+        event_id = log.append({'type': 'content', 'content': text})
+        if broadcast is not None:
+            broadcast.chunk(text, event_id)
+    
     try:
-        response = await client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=4000,
-            stream=False
-        )
-        return response.model_dump()
+        usage = {}
+        if cached is not None:
+            deltas = replay_pieces(cached['content'])
+        else:
+            deltas = upstream_text(client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=options['temperature'],
+                max_tokens=options['max_tokens'],
+                stream=True,
+                stream_options={'include_usage': True}
+            ), usage)
+        # No timer here: a pending frame goes out with the next delta past the window
+        coalescer = DeltaCoalescer()
+        for delta in deltas:
+            checkpoint.add(delta)
+            text = coalescer.add(delta)
+            if text:
+                emit(text)
+            checkpoint.save()
+            if flight is not None and flight.renew_due():
+                flight.renew()
+        text = coalescer.finish()
+        if text:
+            emit(text)
+        content = checkpoint.content
+        if cached is not None:
+            return content, 0
+        return content, usage.get('total_tokens') or count_tokens(content, model)
     except Exception as e:
         logger.error(f"AI request failed: {str(e)}")
         raise
 
 
+def schedule_summary(conversation, api_key):
+    """Queue the summarizer for a conversation long enough to need it; never raises"""
+    try:
+        if needs_summary(conversation):
+            summarize_conversation.delay(str(conversation.id), api_key)
+            return True
+    except Exception as e:
+        logger.warning(f"Queueing summary for conversation {conversation.id} failed: {str(e)}")
+    return False
+
+
+@shared_task(bind=True, max_retries=2)
+def summarize_conversation(self, conversation_id, api_key, model=None):
+    """
+    Fold the older turns of a long conversation into its rolling summary,
+    so the context sent upstream is the summary plus the recent turns
+    """
+    try:
+        conversation = Conversation.objects.get(id=conversation_id)
+        report = summarize(conversation, api_key, model=model)
+        if report is None:
+            return {'success': True, 'skipped': 'in progress'}
+        return {'success': True, **report}
+        
+    except Exception as exc:
+        logger.error(f"Summarizing conversation {conversation_id} failed: {str(exc)}")
+        if self.request.retries < self.max_retries:
+            raise self.retry(countdown=30 * (2 ** self.request.retries))
+        return {
+            'success': False,
+            'error': str(exc)
+        }
+
+
 @shared_task(bind=True, max_retries=2)
 def process_image_generation(self, conversation_id, prompt, model, api_key, user_id):
     """
@@ -142,14 +285,11 @@ def process_image_generation(self, conversation_id, prompt, model, api_key, user
         # Get conversation
         conversation = Conversation.objects.get(id=conversation_id)
         
-        # Initialize OpenAI client
-        client = openai.AsyncOpenAI(
-            api_key=api_key,
-            base_url="https://openrouter.ai/api/v1"
-        )
+        # Shared keep-alive client for this key
+        client = get_sync_client(api_key)
         
         # Generate image
-        response = asyncio.run(generate_image(client, prompt, model))
+        response = generate_image(client, prompt, model)
         
         # Calculate metrics
         response_time = time.time() - start_time
@@ -171,10 +311,9 @@ def process_image_generation(self, conversation_id, prompt, model, api_key, user
             role='assistant',
             content=message_content,
             model=model,
-            metadata=metadata
+            metadata=metadata,
+            response_time=response_time
         )
-        msg.response_time = response_time
-        msg.save(update_fields=['response_time'])
         
         # Log API usage
         APIUsage.log_request(
@@ -207,12 +346,12 @@ def process_image_generation(self, conversation_id, prompt, model, api_key, user
         }
 
 
-async def generate_image(client, prompt, model):
+def generate_image(client, prompt, model):
     """
     Generate image using AI model
     """
     try:
-        response = await client.images.generate(
+        response = client.images.generate(
             model=model,
             prompt=prompt,
             n=1,
@@ -449,6 +588,53 @@ def warm_cache():
         }
 
 
+@shared_task
+def flush_conversation_counters():
+    """
+    Apply write-behind conversation counters buffered in Redis
+    """
+    if not counters.is_enabled():
+        return {'success': True, 'flushed': 0}
+    try:
+        batch_size = settings.CHAT_SETTINGS.get('COUNTER_FLUSH_BATCH', 500)
+        flushed = counters.flush(batch_size=batch_size)
+        if flushed:
+            logger.info(f"Flushed buffered counters for {flushed} conversations")
+        return {'success': True, 'flushed': flushed}
+        
+    except Exception as e:
+        logger.error(f"Counter flush failed: {str(e)}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
+@shared_task
+def abort_stale_replies():
+    """
+    Mark replies whose worker died mid-generation as aborted
+    """
+    try:
+        stale_seconds = getattr(settings, 'CHAT_SETTINGS', {}).get('STALE_REPLY_SECONDS', 600)
+        cutoff = timezone.now() - timedelta(seconds=stale_seconds)
+        aborted = Message.objects.filter(status=Message.STREAMING, updated_at__lt=cutoff).update(
+            status=Message.ABORTED,
+            error_message='Generation stopped before completing',
+            updated_at=timezone.now()
+        )
+        if aborted:
+            logger.info(f"Marked {aborted} stale streaming replies as aborted")
+        return {'success': True, 'aborted': aborted}
+        
+    except Exception as e:
+        logger.error(f"Stale reply cleanup failed: {str(e)}")
+        return {
+            'success': False,
+            'error': str(e)
+        }
+
+
 @shared_task
 def health_check():
     """
@@ -1,3 +1,1570 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gc
+import io
+import json
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+
+from . import access, counters, llm_clients, presence, streaming, typing_indicators, wire
+from .authentication import APIUser
+from .broadcast import conversation_group, notification_group, system_notification, task_completed
+from .coalescing import DeltaCoalescer
+from . import completion_cache
+from .context import build_context, context_window
+from .encryption import VALUE_PREFIX, Ciphertext, KeyRing, UnreadableValue, derive_fallback_key, get_key_ring
+from .cache_keys import context_key, conversation_key, user_key
+from .checkpoints import ReplyCheckpoint, start_reply
+from .exports import InvalidExport, import_records, iter_export
+from .fake_provider import FakeProvider
+from .models import Conversation, Message
+from .serializers import ConversationSerializer
+from .pagination import InvalidCursor, paginate_messages
+from .routing import websocket_urlpatterns
+from .single_flight import AsyncFlight, Flight, flight_key
+from .stream_log import AsyncStreamLog
+from .summaries import SUMMARY_HEADER, latest_summary
+from .tasks import process_ai_chat_request, summarize_conversation
+from .tokenizer import TOKENS_PER_REPLY, clear_cache, count_many, count_messages, count_tokens, encoding_for_model
+from .wire import msgpack
+
+try:
+    import fakeredis
+except ImportError:  # optional test dependency
+    fakeredis = None
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+MEMORY_CHANNEL_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+OLD_KEY = Fernet.generate_key().decode()
+NEW_KEY = Fernet.generate_key().decode()
+
+
+class KeyRingTests(TestCase):
+    """
+    Every stored format stays readable across key changes
+    """
+
+    def test_tagged_value_round_trip(self):
+        key_ring = KeyRing(NEW_KEY)
+        value = key_ring.encrypt('Hello')
+        self.assertTrue(value.startswith(f'{VALUE_PREFIX}{key_ring.primary_id}$'))
+        self.assertEqual(key_ring.decrypt(value), 'Hello')
+
+    def test_retired_key_still_reads(self):
+        value = KeyRing(OLD_KEY).encrypt('Hello')
+        envelope = KeyRing(OLD_KEY).seal('Hello')
+        key_ring = KeyRing(NEW_KEY, [OLD_KEY])
+        self.assertEqual((key_ring.decrypt(value), key_ring.decrypt(envelope)), ('Hello', 'Hello'))
+        self.assertEqual(key_ring.get_stats()['reads_by_key'], {key_ring.key_id_of(value): 2})
+        with self.assertRaises(UnreadableValue):
+            KeyRing(NEW_KEY).decrypt(value)
+
+    def test_legacy_multifernet_token(self):
+        value = base64.b64encode(Fernet(OLD_KEY).encrypt(b'Hello')).decode()
+        key_ring = KeyRing(NEW_KEY, [OLD_KEY])
+        self.assertEqual(key_ring.decrypt(value), 'Hello')
+        self.assertEqual(key_ring.get_stats()['legacy_reads'], 1)
+        with self.assertRaises(UnreadableValue):
+            KeyRing(NEW_KEY).decrypt(value)
+
+    @override_settings(ENCRYPTION_KEY='', SECRET_KEY='fallback-secret')
+    def test_fallback_key_derived_from_secret_key(self):
+        value = get_key_ring().encrypt('Hello')
+        self.assertEqual(KeyRing(derive_fallback_key()).decrypt(value), 'Hello')
+        with self.settings(SECRET_KEY='another-secret'):
+            with self.assertRaises(UnreadableValue):
+                get_key_ring().decrypt(value)
+
+    def test_plaintext_passes_through(self):
+        key_ring = KeyRing(NEW_KEY)
+        self.assertEqual(key_ring.decrypt('Written before encryption'), 'Written before encryption')
+        self.assertEqual(key_ring.get_stats()['plaintext_reads'], 1)
+
+    def test_rotation_reseals_with_primary_key(self):
+        retired = KeyRing(OLD_KEY)
+        key_ring = KeyRing(NEW_KEY, [OLD_KEY])
+        legacy = base64.b64encode(Fernet(OLD_KEY).encrypt(b'Hello')).decode()
+        for value in (retired.encrypt('Hello'), retired.seal('Hello'), legacy):
+            self.assertTrue(key_ring.needs_rotation(value))
+            rotated = key_ring.rotate(value)
+            self.assertEqual(key_ring.key_id_of(rotated), key_ring.primary_id)
+            self.assertEqual(KeyRing(NEW_KEY).decrypt(rotated), 'Hello')
+            self.assertIs(key_ring.rotate(rotated), rotated)
+
+    def test_rotation_refuses_unreadable_values(self):
+        key_ring = KeyRing(NEW_KEY)
+        lost = KeyRing(OLD_KEY)
+        legacy = base64.b64encode(Fernet(OLD_KEY).encrypt(b'Hello')).decode()
+        for value in (lost.encrypt('Hello'), lost.seal('Hello'), legacy):
+            with self.assertRaises(UnreadableValue):
+                key_ring.rotate(value)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class LazyDecryptionTests(TestCase):
+    """
+    Message content is decrypted on first read only, and never re-encrypted unread
+    """
+
+    def setUp(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        self.message = Message.objects.create(conversation=conversation, role='user', content='Secret text')
+        get_key_ring().reset_stats()
+
+    def decrypts(self):
+        return get_key_ring().get_stats()['decrypt_count']
+
+    def stored(self):
+        return Message.objects.filter(pk=self.message.pk).values_list('content', flat=True)[0]
+
+    def test_content_is_decrypted_once_on_first_read(self):
+        message = Message.objects.get(pk=self.message.pk)
+        self.assertIsInstance(message.__dict__['content'], Ciphertext)
+        self.assertEqual(self.decrypts(), 0)
+
+        self.assertEqual(message.content, 'Secret text')
+        self.assertEqual(message.content, 'Secret text')
+        self.assertEqual(self.decrypts(), 1)
+        self.assertEqual(message.__dict__['content'], 'Secret text')
+
+    def test_unread_content_is_saved_back_byte_for_byte(self):
+        stored = self.stored()
+        message = Message.objects.get(pk=self.message.pk)
+        message.is_edited = True
+        message.save()
+        self.assertEqual(self.stored(), stored)
+        self.assertEqual(self.decrypts(), 0)
+        self.assertEqual(get_key_ring().get_stats()['encrypt_count'], 0)
+
+    def test_read_content_is_resealed_on_save(self):
+        stored = self.stored()
+        message = Message.objects.get(pk=self.message.pk)
+        message.content = message.content + '!'
+        message.save()
+        self.assertNotEqual(self.stored(), stored)
+        self.assertEqual(Message.objects.get(pk=self.message.pk).content, 'Secret text!')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class BulkDecryptTests(TestCase):
+    """
+    Batch decryption keeps order across every stored format, pooled or not
+    """
+
+    POOLED = {'BULK_DECRYPT_POOL': 'thread', 'BULK_DECRYPT_WORKERS': 4, 'BULK_DECRYPT_MIN_BATCH': 2}
+
+    def stored_values(self):
+        """(stored value, plaintext) pairs in every format the key ring reads"""
+        key_ring = get_key_ring()
+        values = []
+        for index in range(12):
+            text = f'message {index} ' + 'x' * 1500 * (index % 3)
+            kind = index % 4
+            if kind == 0:
+                values.append((key_ring.seal(text), text))
+            elif kind == 1:
+                values.append((key_ring.encrypt(text), text))
+            elif kind == 2:
+                values.append((base64.b64encode(key_ring.primary.encrypt(text.encode())).decode(), text))
+            else:
+                values.append((text, text))
+        return values
+
+    def test_decrypt_many_preserves_order(self):
+        values = self.stored_values()
+        expected = [text for _, text in values]
+        for chat_settings in ({'BULK_DECRYPT_POOL': 'off'}, self.POOLED):
+            with self.settings(CHAT_SETTINGS=chat_settings):
+                self.assertEqual(get_key_ring().decrypt_many(value for value, _ in values), expected)
+
+    def test_decrypted_queryset_preserves_order(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        expected = []
+        for stored, text in self.stored_values():
+            message = Message.objects.append(conversation, 'user', text)
+            if not isinstance(stored, bytes):
+                # Rows written before the envelope column existed
+                Message.objects.filter(pk=message.pk).update(content=None, content_legacy=Ciphertext(stored))
+            expected.append(text)
+
+        with self.settings(CHAT_SETTINGS=self.POOLED):
+            messages = Message.objects.filter(conversation=conversation).order_by('created_at').decrypted()
+            with self.assertNumQueries(0):
+                contents = [message.content for message in messages]
+        self.assertEqual(contents, expected)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class MessageEnvelopeTests(TestCase):
+    """
+    Message bodies are stored as binary envelopes, with the text column as a fallback
+    """
+
+    def test_envelope_round_trip(self):
+        key_ring = KeyRing(NEW_KEY, [OLD_KEY])
+        for text in ('Hello', 'x' * 5000, 'Grüße 👋 ' * 200):
+            envelope = key_ring.seal(text)
+            self.assertEqual(key_ring.key_id_of(envelope), key_ring.primary_id)
+            self.assertEqual(key_ring.decrypt(envelope), text)
+        self.assertEqual(key_ring.decrypt(KeyRing(OLD_KEY).seal('Hello')), 'Hello')
+        self.assertLess(len(key_ring.seal('Hello')), len(key_ring.encrypt('Hello')))
+
+    def test_large_bodies_are_compressed(self):
+        key_ring = KeyRing(NEW_KEY)
+        self.assertLess(len(key_ring.seal('x' * 5000)), 500)
+        with self.settings(CHAT_SETTINGS={'CONTENT_COMPRESSION': 'off'}):
+            self.assertGreater(len(key_ring.seal('x' * 5000)), 5000)
+
+    def test_legacy_rows_read_until_migrated(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        message = Message.objects.create(conversation=conversation, role='user', content='placeholder')
+        stored = Message.objects.filter(pk=message.pk).values_list('content', flat=True)[0]
+        self.assertEqual(get_key_ring().key_id_of(stored.stored), get_key_ring().primary_id)
+
+        legacy = get_key_ring().encrypt('Written as text')
+        Message.objects.filter(pk=message.pk).update(content=None, content_legacy=Ciphertext(legacy))
+        self.assertEqual(Message.objects.get(pk=message.pk).content, 'Written as text')
+
+        call_command('migrate_message_storage', stdout=io.StringIO())
+        stored, legacy = Message.objects.filter(pk=message.pk).values_list('content', 'content_legacy')[0]
+        self.assertIsNone(legacy)
+        self.assertEqual(get_key_ring().decrypt(stored.stored), 'Written as text')
+        self.assertEqual(Message.objects.get(pk=message.pk).content, 'Written as text')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class KeyRotationTests(TestCase):
+    """
+    Rotating to a new key never overwrites content it cannot decrypt
+    """
+
+    def stored(self, message):
+        return bytes(Message.objects.filter(pk=message.pk).values_list('content', flat=True)[0].stored)
+
+    def test_unreadable_envelopes_raise(self):
+        key_ring = get_key_ring()
+        envelope = key_ring.seal('Hello')
+        tampered = envelope[:-1] + bytes([envelope[-1] ^ 1])
+        for value in (envelope[:3], b'\x00' * 7 + envelope[7:], tampered):
+            with self.assertRaises(UnreadableValue):
+                key_ring.open(value)
+        self.assertEqual(key_ring.decrypt_many([envelope, tampered]), ['Hello', None])
+
+    def test_unreadable_content_reads_empty_and_is_saved_unchanged(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        with self.settings(ENCRYPTION_KEY=OLD_KEY):
+            message = Message.objects.append(conversation, 'user', 'Written with a lost key')
+        stored = self.stored(message)
+
+        with self.settings(ENCRYPTION_KEY=NEW_KEY):
+            message = Message.objects.get(pk=message.pk)
+            self.assertEqual(message.content, '')
+            message.save()
+            self.assertEqual(Message.objects.filter(pk=message.pk).decrypted()[0].content, '')
+        self.assertEqual(self.stored(message), stored)
+
+    def test_rotation_skips_unreadable_rows(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        lost_key = Fernet.generate_key().decode()
+        with self.settings(ENCRYPTION_KEY=OLD_KEY):
+            retired = Message.objects.append(conversation, 'user', 'Retired key')
+        with self.settings(ENCRYPTION_KEY=lost_key):
+            lost = Message.objects.append(conversation, 'user', 'Lost key')
+        lost_stored = self.stored(lost)
+
+        with self.settings(ENCRYPTION_KEY=NEW_KEY, ENCRYPTION_RETIRED_KEYS=[OLD_KEY]):
+            out = io.StringIO()
+            call_command('rotate_message_keys', stdout=out)
+            self.assertIn('1 of 2 messages rotated', out.getvalue())
+            self.assertIn(str(lost.pk), out.getvalue())
+            self.assertEqual(get_key_ring().key_id_of(self.stored(retired)), get_key_ring().primary_id)
+            self.assertEqual(Message.objects.get(pk=retired.pk).content, 'Retired key')
+        self.assertEqual(self.stored(lost), lost_stored)
+        with self.settings(ENCRYPTION_KEY=lost_key):
+            self.assertEqual(Message.objects.get(pk=lost.pk).content, 'Lost key')
+
+    def test_unreadable_legacy_rows_are_left_on_the_legacy_column(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        message = Message.objects.append(conversation, 'user', 'placeholder')
+        lost = KeyRing(Fernet.generate_key()).encrypt('Lost key')
+        Message.objects.filter(pk=message.pk).update(content=None, content_legacy=Ciphertext(lost))
+
+        for command in ('rotate_message_keys', 'migrate_message_storage'):
+            out = io.StringIO()
+            call_command(command, stdout=out)
+            self.assertIn(f'Skipped 1 messages no key in the ring can decrypt: {message.pk}', out.getvalue())
+        message = Message.objects.get(pk=message.pk)
+        self.assertEqual((message.content, message.__dict__['content_legacy'].stored), ('', lost))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class MessageAppendTests(TestCase):
+    """
+    Write cost and bookkeeping of MessageManager.append
+    """
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(user_id='user-1')
+
+    def test_append_is_one_insert_and_one_update(self):
+        # SAVEPOINT, INSERT, UPDATE, RELEASE SAVEPOINT
+        with self.assertNumQueries(4):
+            Message.objects.append(self.conversation, 'user', 'Hello there')
+
+    def test_write_cost_does_not_grow_with_history(self):
+        for index in range(20):
+            Message.objects.append(self.conversation, 'user', f'message {index}')
+        with self.assertNumQueries(4):
+            Message.objects.append(self.conversation, 'assistant', 'reply', model='openai/gpt-4o-mini')
+
+    def test_counters_activity_and_tokens(self):
+        before = self.conversation.last_activity
+        Message.objects.append(self.conversation, 'user', 'x' * 40)
+        Message.objects.append(self.conversation, 'assistant', 'reply', tokens=7, response_time=0.5)
+
+        stored = Conversation.objects.get(pk=self.conversation.pk)
+        self.assertEqual(stored.message_count, 2)
+        self.assertEqual(stored.total_tokens, count_tokens('x' * 40) + 7)
+        self.assertGreater(stored.last_activity, before)
+        self.assertEqual(stored.message_count, self.conversation.message_count)
+        self.assertEqual(stored.total_tokens, self.conversation.total_tokens)
+        self.assertEqual(Message.objects.get(role='assistant').response_time, 0.5)
+
+    def test_title_only_set_from_first_user_message(self):
+        Message.objects.append(self.conversation, 'assistant', 'Welcome')
+        Message.objects.append(self.conversation, 'user', 'How do I bake bread?')
+        Message.objects.append(self.conversation, 'user', 'And cookies?')
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).title, 'How do I bake bread?')
+        self.assertEqual(self.conversation.title, 'How do I bake bread?')
+
+    def test_write_behind_falls_back_without_redis(self):
+        chat_settings = dict(settings.CHAT_SETTINGS, COUNTER_WRITE_BEHIND=True)
+        with self.settings(CHAT_SETTINGS=chat_settings), self.captureOnCommitCallbacks(execute=True):
+            Message.objects.append(self.conversation, 'user', 'x' * 40)
+        stored = Conversation.objects.get(pk=self.conversation.pk)
+        self.assertEqual((stored.message_count, stored.total_tokens), (1, count_tokens('x' * 40)))
+
+    def test_plain_create_still_titles_conversation(self):
+        # INSERT plus a single conversation UPDATE from the post_save signal
+        with self.assertNumQueries(2):
+            message = Message.objects.create(conversation=self.conversation, role='user', content='y' * 60)
+        self.assertEqual(message.token_count, count_tokens('y' * 60))
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).title, 'y' * 50 + '...')
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(CACHES=LOCMEM_CACHE)
+class CounterBufferTests(TestCase):
+    """
+    Write-behind counters buffered in Redis and flushed to the database
+    """
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch.object(counters, 'get_redis', lambda: self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.settings_override = self.settings(
+            CHAT_SETTINGS=dict(settings.CHAT_SETTINGS, COUNTER_WRITE_BEHIND=True)
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.conversation = Conversation.objects.create(user_id='user-1')
+
+    def append(self, content, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.append(self.conversation, 'user', content, **kwargs)
+
+    def stored(self):
+        return Conversation.objects.get(pk=self.conversation.pk)
+
+    def test_appends_are_buffered_and_merged_on_read(self):
+        self.append('x' * 40)
+        self.append('reply', tokens=7)
+
+        stored = self.stored()
+        self.assertEqual((stored.message_count, stored.total_tokens), (0, 0))
+        delta = counters.pending([self.conversation.pk])[str(self.conversation.pk)]
+        self.assertEqual((delta['message_count'], delta['total_tokens']), (2, count_tokens('x' * 40) + 7))
+        self.assertEqual(self.redis.smembers(counters.DIRTY_KEY), {str(self.conversation.pk).encode()})
+
+        merged, = counters.apply_pending([stored])
+        self.assertIsNot(merged, stored)
+        self.assertEqual((merged.message_count, merged.total_tokens), (2, count_tokens('x' * 40) + 7))
+        self.assertGreater(merged.last_activity, stored.last_activity)
+        self.assertEqual(counters.apply_pending([merged]), [merged])
+
+    def test_flush_writes_deltas_and_clears_the_buffer(self):
+        self.append('x' * 40)
+        self.append('y' * 40)
+
+        self.assertEqual(counters.flush(), 1)
+        stored = self.stored()
+        self.assertEqual((stored.message_count, stored.total_tokens), (2, count_tokens('x' * 40) * 2))
+        self.assertEqual(stored.last_activity, self.conversation.last_activity)
+        self.assertFalse(self.redis.exists(counters._key(self.conversation.pk)))
+        self.assertFalse(self.redis.smembers(counters.DIRTY_KEY))
+        self.assertEqual(counters.flush(), 0)
+
+    def test_counts_recorded_during_a_flush_survive_it(self):
+        self.append('x' * 40)
+        read_pending = counters.pending
+
+        def pending_then_append(conversation_ids):
+            deltas = read_pending(conversation_ids)
+            # Lands after the flush read the hash and before it settles
+            self.append('late', tokens=5)
+            return deltas
+
+        with mock.patch.object(counters, 'pending', pending_then_append):
+            self.assertEqual(counters.flush(), 1)
+        stored = self.stored()
+        self.assertEqual((stored.message_count, stored.total_tokens), (1, count_tokens('x' * 40)))
+        delta = counters.pending([self.conversation.pk])[str(self.conversation.pk)]
+        self.assertEqual((delta['message_count'], delta['total_tokens']), (1, 5))
+        self.assertTrue(self.redis.sismember(counters.DIRTY_KEY, str(self.conversation.pk)))
+
+        counters.flush()
+        stored = self.stored()
+        self.assertEqual((stored.message_count, stored.total_tokens), (2, count_tokens('x' * 40) + 5))
+        self.assertEqual(stored.last_activity, self.conversation.last_activity)
+        self.assertFalse(self.redis.exists(counters._key(self.conversation.pk)))
+
+    def test_redis_errors_fall_back_to_the_database(self):
+        self.redis.pipeline = mock.Mock(side_effect=ConnectionError('Redis is down'))
+        self.append('x' * 40)
+        stored = self.stored()
+        self.assertEqual((stored.message_count, stored.total_tokens), (1, count_tokens('x' * 40)))
+        self.assertEqual(counters.pending([self.conversation.pk]), {})
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentAppendTests(TransactionTestCase):
+    """
+    Concurrent writers must not lose counter updates
+    """
+
+    def test_concurrent_appends_keep_every_increment(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        writers, per_writer = 4, 5
+
+        def write():
+            try:
+                local = Conversation.objects.get(pk=conversation.pk)
+                for index in range(per_writer):
+                    Message.objects.append(local, 'user', f'message {index}')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.message_count, writers * per_writer)
+
+
+class MessagePaginationTests(TestCase):
+    """
+    Keyset pagination over (created_at, id)
+    """
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(user_id='user-1')
+        for index in range(7):
+            Message.objects.create(conversation=self.conversation, role='user', content=f'message {index}')
+        # Ties on created_at must still page without gaps or repeats
+        Message.objects.filter(content__isnull=False).update(created_at=timezone.now())
+        self.history = Message.objects.filter(conversation=self.conversation)
+        self.expected = list(self.history.order_by('created_at', 'id').values_list('id', flat=True))
+
+    def test_forward_and_backward_walks_cover_every_message_once(self):
+        seen, cursor, pages = [], None, []
+        while True:
+            messages, next_cursor, prev_cursor = paginate_messages(self.history, cursor, page_size=3)
+            seen += [message.id for message in messages]
+            pages.append((cursor, prev_cursor))
+            if not next_cursor:
+                break
+            cursor = next_cursor
+        self.assertEqual(seen, self.expected)
+        self.assertIsNone(pages[0][1])
+
+        back, prev_cursor = [], pages[-1][1]
+        while prev_cursor:
+            messages, _, prev_cursor = paginate_messages(self.history, prev_cursor, page_size=3)
+            back = [message.id for message in messages] + back
+        self.assertEqual(back, self.expected[:len(back)])
+        self.assertEqual(len(back), 6)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            paginate_messages(self.history, 'not-a-cursor')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CacheNamespaceTests(TestCase):
+    """
+    Generation counters retire every key of a namespace at once
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(user_id='user-1')
+
+    def test_append_retires_conversation_and_user_keys(self):
+        page_key = conversation_key(self.conversation.id, 'messages', 'start', 50)
+        list_key = user_key('user-1', 'conversations', 10)
+        cache.set(page_key, ['stale'])
+        cache.set(list_key, ['stale'])
+
+        Message.objects.append(self.conversation, 'user', 'Hello')
+
+        self.assertNotEqual(conversation_key(self.conversation.id, 'messages', 'start', 50), page_key)
+        self.assertNotEqual(user_key('user-1', 'conversations', 10), list_key)
+
+    def test_bump_survives_evicted_generation(self):
+        key = conversation_key(self.conversation.id, 'recent', 10)
+        cache.delete(f"gen:conversation:{self.conversation.id}")
+        self.assertNotEqual(conversation_key(self.conversation.id, 'recent', 10), key)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConversationListTests(TestCase):
+    """
+    The conversation list keeps DRF's page-number pagination contract
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='lister')
+        Conversation.objects.bulk_create(
+            Conversation(user_id=str(self.user.id), title=f'Chat {index}') for index in range(55)
+        )
+        self.client.force_login(self.user)
+
+    def test_pages_have_count_links_and_serializer_fields(self):
+        first = self.client.get('/api/conversations/').json()
+        self.assertEqual(set(first), {'count', 'next', 'previous', 'results'})
+        self.assertEqual((first['count'], len(first['results']), first['previous']), (55, 50, None))
+        self.assertTrue(first['next'].endswith('/api/conversations/?page=2'))
+        self.assertLessEqual(set(ConversationSerializer.Meta.fields), set(first['results'][0]))
+
+        second = self.client.get(first['next']).json()
+        self.assertEqual((second['count'], len(second['results']), second['next']), (55, 5, None))
+        self.assertIsNotNone(second['previous'])
+        ids = [row['id'] for row in first['results'] + second['results']]
+        self.assertEqual(len(set(ids)), 55)
+
+        self.assertEqual(self.client.get('/api/conversations/?page=3').status_code, 404)
+        self.assertEqual(self.client.get('/api/conversations/?archived=1').json()['count'], 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ExportImportTests(TestCase):
+    """
+    NDJSON export and bulk import round trip
+    """
+
+    def test_round_trip_preserves_content_and_timestamps(self):
+        conversation = Conversation.objects.create(user_id='user-1', title='Trip')
+        for index in range(5):
+            Message.objects.append(conversation, 'user', f'message {index} ' + 'x' * 2000 * index)
+        before = [(m.id, m.created_at, m.content) for m in Message.objects.order_by('created_at').decrypted()]
+
+        lines = list(iter_export(Conversation.objects.filter(user_id='user-1'), batch_size=2))
+        Conversation.objects.all().delete()
+        counts = import_records(lines, batch_size=2, user_id='user-2')
+
+        self.assertEqual(counts, {'conversation': 1, 'message': 5, 'file': 0})
+        after = [(m.id, m.created_at, m.content) for m in Message.objects.order_by('created_at').decrypted()]
+        self.assertEqual(after, before)
+        self.assertEqual(Conversation.objects.get().user_id, 'user-2')
+
+    def test_rejects_unknown_records(self):
+        with self.assertRaises(InvalidExport):
+            import_records(['{"type": "user", "id": 1}'])
+
+    def test_import_keeps_timestamps_without_touching_field_options(self):
+        conversation = Conversation.objects.create(user_id='user-1', title='Old')
+        Message.objects.append(conversation, 'user', 'Hello')
+        Conversation.objects.update(last_activity=timezone.now() - timedelta(days=30))
+        before = Conversation.objects.values_list('created_at', 'updated_at', 'last_activity').get()
+
+        lines = list(iter_export(Conversation.objects.all()))
+        Conversation.objects.all().delete()
+        import_records(lines)
+
+        self.assertEqual(Conversation.objects.values_list('created_at', 'updated_at', 'last_activity').get(), before)
+        self.assertTrue(Conversation._meta.get_field('last_activity').auto_now)
+        self.assertTrue(Message._meta.get_field('created_at').auto_now_add)
+
+    def test_skip_existing_leaves_existing_rows_alone(self):
+        conversation = Conversation.objects.create(user_id='user-1', title='Kept')
+        lines = list(iter_export(Conversation.objects.all()))
+        Conversation.objects.update(title='Edited')
+        stamped = Conversation.objects.values_list('updated_at', flat=True).get()
+
+        counts = import_records(lines, skip_existing=True)
+
+        self.assertEqual(counts['conversation'], 0)
+        conversation.refresh_from_db()
+        self.assertEqual((conversation.title, conversation.updated_at), ('Edited', stamped))
+
+    def test_export_checks_ids_before_streaming(self):
+        user = User.objects.create_user(username='exporter')
+        mine = Conversation.objects.create(user_id=str(user.id))
+        theirs = Conversation.objects.create(user_id='someone-else')
+        self.client.force_login(user)
+
+        response = self.client.get('/api/conversations/export/', {'id': 'not-a-uuid'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/conversations/export/', {'id': [str(mine.id), str(theirs.id)]})
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get('/api/conversations/export/', {'id': str(mine.id)})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['type'] for line in lines], ['header', 'conversation'])
+
+
+@override_settings(CHAT_SETTINGS={'LLM_POOL_MAX_KEYS': 2})
+class LLMClientPoolTests(TestCase):
+    """
+    Upstream clients are shared per API key and bounded by LRU
+    """
+
+    def setUp(self):
+        llm_clients.close_all()
+        llm_clients.reset_pool_stats()
+
+    def tearDown(self):
+        llm_clients.close_all()
+
+    def test_clients_are_reused_per_key(self):
+        first = llm_clients.get_sync_client('key-a')
+        self.assertIs(llm_clients.get_sync_client('key-a'), first)
+        self.assertIsNot(llm_clients.get_sync_client('key-b'), first)
+
+        stats = llm_clients.get_pool_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_least_recently_used_key_is_evicted(self):
+        first = llm_clients.get_sync_client('key-a')
+        llm_clients.get_sync_client('key-b')
+        llm_clients.get_sync_client('key-a')
+        llm_clients.get_sync_client('key-c')
+
+        self.assertEqual(llm_clients.get_pool_stats()['evicted_lru'], 1)
+        self.assertIs(llm_clients.get_sync_client('key-a'), first)
+        self.assertEqual(llm_clients.get_pool_stats()['clients'], 2)
+
+    def test_evicted_client_stays_open_until_unused(self):
+        with FakeProvider(chunks=4, delay=0) as provider:
+            client = llm_clients.get_sync_client('key-a', base_url=provider.base_url)
+            stream = client.chat.completions.create(
+                model='fake/model', messages=[{'role': 'user', 'content': 'Hi'}], stream=True
+            )
+            first = next(iter(stream))
+            llm_clients.get_sync_client('key-b')
+            llm_clients.get_sync_client('key-c')
+            self.assertEqual(llm_clients.get_pool_stats()['evicted_lru'], 1)
+
+            # The stream that was in flight during eviction still finishes
+            rest = list(stream)
+            self.assertFalse(client.is_closed())
+            self.assertTrue(rest)
+            self.assertIsNotNone(first)
+
+        http_client = client._client
+        del client, stream, first, rest
+        gc.collect()
+        self.assertTrue(http_client.is_closed)
+
+    def test_async_clients_are_bound_to_their_loop(self):
+        async def lookup():
+            return llm_clients.get_async_client('key-a'), llm_clients.get_async_client('key-a')
+
+        first, again = asyncio.run(lookup())
+        self.assertIs(first, again)
+        second, _ = asyncio.run(lookup())
+        self.assertIsNot(second, first)
+
+    def test_connections_are_reused(self):
+        with FakeProvider(chunks=1, delay=0) as provider:
+            for _ in range(3):
+                client = llm_clients.get_sync_client('key-a', base_url=provider.base_url)
+                client.chat.completions.create(model='fake/model', messages=[{'role': 'user', 'content': 'Hi'}])
+
+        stats = llm_clients.get_pool_stats()
+        self.assertEqual((stats['requests'], stats['new_connections']), (3, 1))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class StreamResumeTests(TestCase):
+    """
+    Resuming a reply whose stream log is gone
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='resume-owner')
+        self.conversation = Conversation.objects.create(user_id=str(self.user.id))
+        self.reply = Message.objects.append(self.conversation, 'assistant', 'Finished reply')
+
+    async def test_finished_reply_is_sent_as_complete_event(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/api/chat/stream/{self.reply.id}/')
+
+        frames = [frame.decode() async for frame in response.streaming_content]
+        self.assertEqual(len(frames), 1)
+        self.assertIn('"type": "complete"', frames[0])
+        self.assertIn('Finished reply', frames[0])
+
+    async def test_other_users_cannot_resume(self):
+        stranger = await User.objects.acreate_user(username='stranger')
+        await self.async_client.aforce_login(stranger)
+        response = await self.async_client.get(f'/api/chat/stream/{self.reply.id}/')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_rejects_malformed_event_id(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(
+            f'/api/chat/stream/{self.reply.id}/', headers={'Last-Event-ID': 'not-an-id'}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ChatStreamTests(TransactionTestCase):
+    """
+    SSE framing of chat_stream, natively under ASGI and through drive_sync under WSGI
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='streamer')
+        self.conversation = Conversation.objects.create(user_id=str(self.user.id))
+        self.body = json.dumps({
+            'conversation_id': str(self.conversation.id), 'message': 'Hi', 'model': 'fake/model', 'api_key': 'key'
+        })
+
+    def events(self, frames):
+        """Payloads of the SSE frames, checking each one is a complete event"""
+        payloads = []
+        for frame in frames:
+            frame = frame.decode() if isinstance(frame, bytes) else frame
+            self.assertTrue(frame.endswith('\n\n'), frame)
+            lines = frame.strip('\n').split('\n')
+            self.assertTrue(lines[-1].startswith('data: '), frame)
+            self.assertTrue(all(line.startswith('id: ') for line in lines[:-1]), frame)
+            payloads.append(json.loads(lines[-1][len('data: '):]))
+        return payloads
+
+    def assert_streamed_reply(self, response, payloads):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual((response['Cache-Control'], response['X-Accel-Buffering']), ('no-cache', 'no'))
+
+        types = [payload['type'] for payload in payloads]
+        self.assertEqual(types[:2], ['user_message', 'stream_start'])
+        self.assertEqual(types[-1], 'complete')
+        self.assertEqual(set(types[2:-1]), {'content'})
+        text = ''.join(payload['content'] for payload in payloads if payload['type'] == 'content')
+        self.assertEqual(text, 'word ' * 12)
+        self.assertEqual(payloads[-1]['message']['content'], 'word ' * 12)
+        reply = Message.objects.get(pk=payloads[1]['message_id'])
+        self.assertEqual((reply.status, reply.content), (Message.COMPLETE, 'word ' * 12))
+
+    def test_asgi_stream_is_native(self):
+        async def scenario():
+            await self.async_client.aforce_login(self.user)
+            response = await self.async_client.post(
+                '/api/chat/stream/', self.body, content_type='application/json'
+            )
+            return response, [frame async for frame in response.streaming_content]
+
+        with FakeProvider(chunks=12, delay=0, text='word ') as provider, \
+                self.settings(OPENROUTER_BASE_URL=provider.base_url), \
+                mock.patch.object(streaming, 'drive_sync', wraps=streaming.drive_sync) as drive_sync:
+            response, frames = async_to_sync(scenario)()
+        self.assertFalse(drive_sync.called)
+        self.assert_streamed_reply(response, self.events(frames))
+
+    def test_wsgi_stream_is_driven_synchronously(self):
+        self.client.force_login(self.user)
+        with FakeProvider(chunks=12, delay=0, text='word ') as provider, \
+                self.settings(OPENROUTER_BASE_URL=provider.base_url), \
+                mock.patch.object(streaming, 'drive_sync', wraps=streaming.drive_sync) as drive_sync:
+            response = self.client.post('/api/chat/stream/', self.body, content_type='application/json')
+            frames = list(response.streaming_content)
+        self.assertTrue(drive_sync.called)
+        self.assert_streamed_reply(response, self.events(frames))
+
+    def test_requests_are_validated_before_streaming(self):
+        self.client.force_login(self.user)
+        response = self.client.post('/api/chat/stream/', json.dumps({'message': 'Hi'}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.streaming)
+        self.assertEqual(self.client.get('/api/chat/stream/').status_code, 405)
+
+    def test_api_key_clients_stream_without_a_csrf_token(self):
+        api_key = 'sk-' + 'x' * 40
+        self.conversation.user_id = str(APIUser(api_key).id)
+        self.conversation.save()
+        client = Client(enforce_csrf_checks=True)
+        with FakeProvider(chunks=12, delay=0, text='word ') as provider, \
+                self.settings(OPENROUTER_BASE_URL=provider.base_url):
+            response = client.post(
+                '/api/chat/stream/', self.body, content_type='application/json',
+                headers={'Authorization': f'Bearer {api_key}'}
+            )
+            frames = list(response.streaming_content)
+        self.assert_streamed_reply(response, self.events(frames))
+
+        response = client.post('/api/chat/stream/', self.body, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    def test_session_clients_still_need_a_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        response = client.post('/api/chat/stream/', self.body, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('CSRF', response.json()['error'])
+        self.assertFalse(Message.objects.exists())
+
+    def test_other_users_conversations_are_not_found(self):
+        self.client.force_login(User.objects.create_user(username='stranger'))
+        response = self.client.post('/api/chat/stream/', self.body, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Message.objects.exists())
+
+
+class DeltaCoalescerTests(TestCase):
+    """
+    Streamed deltas are batched by window and size
+    """
+
+    def test_first_delta_is_sent_immediately(self):
+        coalescer = DeltaCoalescer(window=0.03, max_bytes=512)
+        self.assertEqual(coalescer.add('Hel', now=0.0), 'Hel')
+        self.assertIsNone(coalescer.add('lo', now=0.01))
+        self.assertIsNone(coalescer.add(' wor', now=0.02))
+        self.assertEqual(coalescer.add('ld', now=0.045), 'lo world')
+
+    def test_size_threshold_and_finish(self):
+        coalescer = DeltaCoalescer(window=10, max_bytes=4)
+        coalescer.add('a', now=0.0)
+        self.assertIsNone(coalescer.add('bc', now=0.1))
+        self.assertEqual(coalescer.add('de', now=0.2), 'bcde')
+        self.assertIsNone(coalescer.add('f', now=0.3))
+        self.assertTrue(coalescer.due(now=10.4))
+        self.assertEqual(coalescer.finish(), 'f')
+        self.assertEqual((coalescer.deltas, coalescer.frames, coalescer.bytes), (4, 3, 6))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ReplyCheckpointTests(TestCase):
+    """
+    Streaming replies are stored up front and saved in bounded batches
+    """
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(user_id='user-1')
+        self.placeholder = start_reply(self.conversation, 'fake/model', uuid.uuid4())
+
+    def test_checkpoint_is_one_update_per_interval(self):
+        checkpoint = ReplyCheckpoint(self.placeholder, every_tokens=4, every_seconds=60)
+        with self.assertNumQueries(2):
+            for _ in range(8):
+                checkpoint.add('abcd')
+                checkpoint.save()
+
+        stored = Message.objects.get(pk=self.placeholder.pk)
+        self.assertEqual((stored.status, stored.content), (Message.STREAMING, 'abcd' * 8))
+
+    def test_finish_completes_reply_and_counts_tokens(self):
+        Message.objects.finish(self.placeholder, 'Done', tokens=12, response_time=0.25)
+
+        stored = Message.objects.get(pk=self.placeholder.pk)
+        self.assertEqual((stored.status, stored.content, stored.token_count), (Message.COMPLETE, 'Done', 12))
+        conversation = Conversation.objects.get(pk=self.conversation.pk)
+        self.assertEqual((conversation.message_count, conversation.total_tokens), (1, 12))
+        # A checkpoint arriving after the reply finished changes nothing
+        self.assertEqual(Message.objects.checkpoint(self.placeholder.pk, 'late'), 0)
+
+    def test_content_update_drops_legacy_copy(self):
+        Message.objects.filter(pk=self.placeholder.pk).update(content_legacy='old text')
+        Message.objects.filter(pk=self.placeholder.pk).update(content='new text')
+        stored = Message.objects.get(pk=self.placeholder.pk)
+        self.assertIsNone(stored.content_legacy)
+        self.assertEqual(stored.content, 'new text')
+
+    def test_task_streams_into_placeholder(self):
+        with FakeProvider(chunks=30, delay=0, text='word ') as provider, \
+                self.settings(OPENROUTER_BASE_URL=provider.base_url):
+            result = process_ai_chat_request.run(
+                str(self.conversation.id), 'Hi', 'fake/model', 'key', 'user-1', message_id=str(self.placeholder.id)
+            )
+
+        self.assertTrue(result['success'])
+        stored = Message.objects.get(pk=self.placeholder.pk)
+        self.assertEqual((stored.status, stored.content), (Message.COMPLETE, 'word ' * 30))
+
+    def test_view_stores_the_user_message_before_queueing(self):
+        user = User.objects.create_user(username='queued')
+        self.conversation.user_id = str(user.id)
+        self.conversation.save()
+        self.client.force_login(user)
+        body = {'conversation_id': str(self.conversation.id), 'message': 'Hi', 'api_key': 'key'}
+        with mock.patch.object(process_ai_chat_request, 'delay', return_value=mock.Mock(id='task-1')) as delay:
+            response = self.client.post('/api/chat/', body, content_type='application/json')
+
+        self.assertEqual(response.status_code, 202)
+        user_message = self.conversation.messages.get(role='user')
+        self.assertEqual(response.json()['user_message_id'], str(user_message.id))
+        self.assertEqual(delay.call_args.kwargs['user_message_id'], str(user_message.id))
+
+    def test_retries_do_not_store_the_user_message_again(self):
+        with FakeProvider(chunks=3, delay=0) as provider, \
+                self.settings(OPENROUTER_BASE_URL=provider.base_url):
+            result = process_ai_chat_request.apply(
+                (str(self.conversation.id), 'Hi', 'fake/model', 'key', 'user-1'),
+                {'message_id': str(self.placeholder.id)},
+                retries=1
+            ).get()
+
+        self.assertTrue(result['success'])
+        self.assertFalse(self.conversation.messages.filter(role='user').exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TokenizerTests(TestCase):
+    """
+    Per-model token counts, cached by content hash
+    """
+
+    def setUp(self):
+        clear_cache()
+
+    def test_models_map_to_their_encoding(self):
+        self.assertEqual(encoding_for_model('openai/gpt-4o-mini'), 'o200k_base')
+        self.assertEqual(encoding_for_model('openai/gpt-4-turbo'), 'cl100k_base')
+        self.assertEqual(encoding_for_model('anthropic/claude-3.5-sonnet'), 'cl100k_base')
+
+    def test_batch_matches_single_counts_and_hits_cache(self):
+        texts = ['Hello there, how are you?', 'def main():\n    return 42\n', '', 'Hello there, how are you?']
+        counts = count_many(texts, 'openai/gpt-4o')
+        self.assertEqual(counts, [count_tokens(text, 'openai/gpt-4o') for text in texts])
+        self.assertEqual(counts[2], 0)
+        self.assertGreater(counts[1], 5)
+        # Special-token text is counted like any other text
+        self.assertGreater(count_tokens('<|endoftext|>'), 1)
+
+    def test_history_includes_message_framing(self):
+        history = [{'role': 'user', 'content': 'Hi'}, {'role': 'assistant', 'content': 'Hello!'}]
+        self.assertEqual(count_messages(history), count_tokens('Hi') + count_tokens('Hello!') + 3 * 2 + 3)
+
+    def test_count_is_stored_when_message_is_written(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        message = Message.objects.append(conversation, 'assistant', 'Tokens are counted once.', model='openai/gpt-4o')
+        self.assertEqual(
+            Message.objects.get(pk=message.pk).token_count,
+            count_tokens('Tokens are counted once.', 'openai/gpt-4o')
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHAT_SETTINGS={'CONTEXT_WINDOWS': {'tiny': 60}})
+class ContextBuilderTests(TestCase):
+    """
+    History sent to the model, within its context window
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(user_id='user-1')
+        for index in range(6):
+            role = 'user' if index % 2 == 0 else 'assistant'
+            Message.objects.append(self.conversation, role, f'turn {index}')
+
+    def test_turns_are_oldest_first(self):
+        context = build_context(self.conversation, 'openai/gpt-4o')
+        self.assertEqual([turn['content'] for turn in context], [f'turn {index}' for index in range(6)])
+        self.assertEqual(context[0]['role'], 'user')
+
+    def test_oldest_turns_dropped_to_fit_budget(self):
+        Message.objects.append(self.conversation, 'user', 'word ' * 20)
+        # 60 - 10 reserved - 3 for the reply leaves room for the last message and one more
+        context = build_context(self.conversation, 'tiny-model', max_tokens=10)
+        self.assertLessEqual(count_messages(context), context_window('tiny-model') - 10)
+        self.assertEqual(context[-1]['content'], 'word ' * 20)
+        self.assertLess(len(context), 7)
+
+    def test_next_turn_only_fetches_new_messages(self):
+        build_context(self.conversation, 'openai/gpt-4o')
+        Message.objects.append(self.conversation, 'user', 'turn 6')
+        # Cache read, one query for the rows after the cached ones, one for the text
+        with self.assertNumQueries(2):
+            context = build_context(self.conversation, 'openai/gpt-4o')
+        self.assertEqual(context[-1]['content'], 'turn 6')
+        self.assertEqual(len(context), 7)
+
+    def test_cache_holds_no_message_text(self):
+        build_context(self.conversation, 'openai/gpt-4o')
+        budget = context_window('openai/gpt-4o') - 4000 - TOKENS_PER_REPLY
+        cached = cache.get(context_key(self.conversation.id, budget))
+        self.assertEqual(len(cached['turns']), 6)
+        for turn in cached['turns']:
+            self.assertEqual(set(turn), {'id', 'tokens', 'created_at'})
+
+    def test_streaming_reply_left_out_until_finished(self):
+        build_context(self.conversation, 'openai/gpt-4o')
+        reply = start_reply(self.conversation, 'openai/gpt-4o', uuid.uuid4())
+        Message.objects.checkpoint(reply.pk, 'partial')
+        self.assertEqual(build_context(self.conversation, 'openai/gpt-4o')[-1]['content'], 'turn 5')
+
+        Message.objects.finish(reply, 'done', status=Message.COMPLETE)
+        self.assertEqual(build_context(self.conversation, 'openai/gpt-4o')[-1]['content'], 'done')
+
+    def test_edit_invalidates_cached_context(self):
+        build_context(self.conversation, 'openai/gpt-4o')
+        message = Message.objects.filter(conversation=self.conversation).order_by('created_at').first()
+        message.content = 'edited'
+        message.save()
+        self.assertEqual(build_context(self.conversation, 'openai/gpt-4o')[0]['content'], 'edited')
+
+
+class SummarizingProvider(FakeProvider):
+    """FakeProvider that numbers its summaries and keeps the requests"""
+
+    def __init__(self):
+        super().__init__(chunks=1, delay=0)
+        self.bodies = []
+
+    def reply(self, request_body):
+        self.bodies.append(request_body)
+        return [f'Summary {len(self.bodies)}.']
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHAT_SETTINGS={
+    'SUMMARY_ENABLED': True,
+    'SUMMARY_THRESHOLD_TOKENS': 200,
+    'SUMMARY_KEEP_RECENT_TOKENS': 100,
+})
+class ConversationSummaryTests(TestCase):
+    """
+    Rolling summaries folding older turns out of the prompt
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.create(user_id='user-1')
+        self.append_turns(range(12))
+
+    def append_turns(self, numbers):
+        for index in numbers:
+            role = 'user' if index % 2 == 0 else 'assistant'
+            Message.objects.append(self.conversation, role, f'turn {index} ' + 'word ' * 40)
+
+    def summarize(self, provider):
+        with self.settings(OPENROUTER_BASE_URL=provider.base_url):
+            return summarize_conversation.run(str(self.conversation.id), 'key')
+
+    def test_summary_replaces_older_turns_in_context(self):
+        before = build_context(self.conversation, 'openai/gpt-4o')
+        with SummarizingProvider() as provider:
+            result = self.summarize(provider)
+
+        self.assertTrue(result['success'])
+        self.assertEqual(result['folded'], 10)
+        self.assertGreater(result['prompt_tokens_saved'], 0)
+        context = build_context(self.conversation, 'openai/gpt-4o')
+        self.assertEqual(context[0], {'role': 'system', 'content': SUMMARY_HEADER + 'Summary 1.'})
+        self.assertEqual([turn['content'][:7] for turn in context[1:]], ['turn 10', 'turn 11'])
+        self.assertEqual(count_messages(before) - count_messages(context), result['prompt_tokens_saved'])
+
+        # The summary is not a message of the conversation
+        self.assertEqual(Message.objects.visible().filter(conversation=self.conversation).count(), 12)
+        summary = Conversation.objects.build_summaries(Conversation.objects.filter(pk=self.conversation.pk))[0]
+        self.assertTrue(summary['recent_message']['content_preview'].startswith('turn 11'))
+
+    def test_summary_is_updated_with_new_turns_only(self):
+        with SummarizingProvider() as provider:
+            self.summarize(provider)
+            self.append_turns(range(12, 18))
+            result = self.summarize(provider)
+
+        self.assertEqual(result['folded'], 6)
+        self.assertEqual(result['summarized_messages'], 16)
+        self.assertEqual(Message.objects.summaries().filter(conversation=self.conversation).count(), 1)
+        prompt = provider.bodies[-1]['messages'][-1]['content']
+        self.assertIn('Summary 1.', prompt)
+        self.assertIn('turn 10', prompt)
+        self.assertNotIn('turn 9 ', prompt)
+        self.assertEqual(latest_summary(self.conversation).content, SUMMARY_HEADER + 'Summary 2.')
+        self.assertEqual(build_context(self.conversation, 'openai/gpt-4o')[1]['content'][:7], 'turn 16')
+
+    def test_short_history_is_left_alone(self):
+        Message.objects.filter(conversation=self.conversation).update(is_deleted=True)
+        self.append_turns(range(3))
+        with SummarizingProvider() as provider:
+            result = self.summarize(provider)
+
+        self.assertEqual((result['folded'], provider.requests), (0, 0))
+        self.assertIsNone(latest_summary(self.conversation))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHAT_SETTINGS={'COMPLETION_CACHE_ENABLED': True})
+class CompletionCacheTests(TestCase):
+    """
+    Exact-match completion cache and its replay
+    """
+
+    def setUp(self):
+        cache.clear()
+        completion_cache.reset_completion_cache_stats()
+
+    def options(self, **data):
+        return completion_cache.completion_options(data)
+
+    def ask(self, provider, options):
+        conversation = Conversation.objects.create(user_id='user-1')
+        with self.settings(OPENROUTER_BASE_URL=provider.base_url):
+            result = process_ai_chat_request.run(
+                str(conversation.id), 'Hi', 'fake/model', 'key', 'user-1', options=options
+            )
+        return result, Message.objects.get(pk=result['message_id'])
+
+    def test_only_deterministic_or_opted_in_requests_are_cached(self):
+        self.assertTrue(completion_cache.should_cache(self.options(temperature=0)))
+        self.assertFalse(completion_cache.should_cache(self.options(temperature=0.7)))
+        self.assertTrue(completion_cache.should_cache(self.options(temperature=0.7, cache=True)))
+        self.assertFalse(completion_cache.should_cache(self.options(temperature=0, cache=False)))
+        with self.settings(CHAT_SETTINGS={}):
+            self.assertFalse(completion_cache.should_cache(self.options(temperature=0)))
+        with self.assertRaises(ValueError):
+            self.options(temperature=3)
+
+    def test_key_ignores_everything_but_the_request(self):
+        options = self.options(temperature=0)
+        key = completion_cache.completion_key('m', [{'role': 'user', 'content': 'Hi'}], options)
+        self.assertEqual(
+            key, completion_cache.completion_key('m', [{'content': 'Hi', 'role': 'user', 'name': 'x'}], options)
+        )
+        self.assertNotEqual(
+            key, completion_cache.completion_key('m', [{'role': 'user', 'content': 'Hi'}], self.options(temperature=0.1))
+        )
+
+    def test_identical_request_is_replayed_without_upstream_call(self):
+        with FakeProvider(chunks=20, delay=0, text='cached ') as provider:
+            first, reply = self.ask(provider, self.options(temperature=0))
+            second, replayed = self.ask(provider, self.options(temperature=0))
+
+        self.assertEqual(provider.requests, 1)
+        self.assertEqual((replayed.status, replayed.content), (Message.COMPLETE, reply.content))
+        self.assertEqual(second['tokens_used'], 0)
+        stats = completion_cache.get_completion_cache_stats()
+        self.assertEqual((stats['models']['fake/model']['hits'], stats['models']['fake/model']['misses']), (1, 1))
+
+    def test_sampled_request_is_not_cached(self):
+        with FakeProvider(chunks=5, delay=0) as provider:
+            self.ask(provider, self.options(temperature=0.7))
+            self.ask(provider, self.options(temperature=0.7))
+        self.assertEqual(provider.requests, 2)
+
+    @override_settings(CHAT_SETTINGS={'COMPLETION_CACHE_ENABLED': True, 'COMPLETION_CACHE_MAX_ENTRIES': 2})
+    def test_least_recently_used_entry_is_evicted(self):
+        for key in ('a', 'b', 'c'):
+            completion_cache.store('m', key, f'reply {key}')
+            if key == 'b':
+                # Using "a" makes "b" the least recently used
+                completion_cache.lookup('m', 'a')
+        self.assertIsNone(completion_cache.lookup('m', 'b'))
+        self.assertEqual(completion_cache.lookup('m', 'a')['content'], 'reply a')
+        self.assertEqual(completion_cache.replay_pieces('one two  three'), ['one ', 'two  ', 'three'])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SingleFlightTests(TestCase):
+    """
+    Idempotency keys of chat requests; without Redis every request leads
+    """
+
+    def test_duplicates_share_a_key(self):
+        key = flight_key('user-1', 'conv-1', 'Hi')
+        self.assertEqual(key, flight_key('user-1', 'conv-1', 'Hi'))
+        self.assertNotEqual(key, flight_key('user-2', 'conv-1', 'Hi'))
+        self.assertNotEqual(key, flight_key('user-1', 'conv-1', 'Hi again'))
+        self.assertEqual(flight_key('user-1', 'conv-1', 'Hi', 'abc'), flight_key('user-1', 'conv-2', 'Bye', 'abc'))
+
+    def test_every_request_leads_without_redis(self):
+        key = flight_key('user-1', 'conv-1', 'Hi')
+        first = Flight.claim(key, 'reply-1', 'test')
+        second = Flight.claim(key, 'reply-2', 'test')
+        self.assertTrue(first.leader and second.leader)
+        self.assertEqual(second.message_id, 'reply-2')
+        self.assertFalse(first.land())
+
+    def test_task_lands_handed_over_flight(self):
+        conversation = Conversation.objects.create(user_id='user-1')
+        flight = Flight.claim(flight_key('user-1', conversation.id, 'Hi'), uuid.uuid4(), 'test')
+        with FakeProvider(chunks=3, delay=0) as provider:
+            with self.settings(OPENROUTER_BASE_URL=provider.base_url):
+                result = process_ai_chat_request.run(
+                    str(conversation.id), 'Hi', 'fake/model', 'key', 'user-1',
+                    message_id=flight.message_id, flight=flight.to_task()
+                )
+        self.assertEqual(result['message_id'], flight.message_id)
+        self.assertEqual(Message.objects.get(pk=flight.message_id).status, Message.COMPLETE)
+
+    def follow_late_leader(self, start_leader):
+        """
+        Frames a duplicate receives when the leader only acts once the
+        duplicate has waited through several empty reads
+        """
+        server = fakeredis.FakeServer()
+        key = flight_key('user-1', 'conv-1', 'Hi')
+
+        async def scenario():
+            leader = await AsyncFlight.claim(key, uuid.uuid4(), 'user-1')
+            follower = await AsyncFlight.claim(key, uuid.uuid4(), 'user-1')
+            self.assertFalse(follower.leader)
+            frames = asyncio.ensure_future(self.collect(streaming.follow_events(follower)))
+            await asyncio.sleep(0.3)
+            self.assertFalse(frames.done())
+            await start_leader(leader)
+            return await asyncio.wait_for(frames, 5)
+
+        with mock.patch.object(counters, 'get_async_redis', lambda: fakeredis.aioredis.FakeRedis(server=server)), \
+                self.settings(CHAT_SETTINGS={'STREAM_LOG_IDLE_TIMEOUT': 0.05}):
+            return [json.loads(frame.split('data: ', 1)[1]) for frame in asyncio.run(scenario())]
+
+    async def collect(self, events):
+        return [frame async for frame in events]
+
+    @skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_duplicate_follows_a_leader_that_starts_late(self):
+        async def start_leader(leader):
+            # The leader's Celery task leaves the queue and generates the reply
+            log = AsyncStreamLog(leader.message_id)
+            await log.start({'type': 'stream_start', 'message_id': leader.message_id}, owner='user-1')
+            await log.append({'type': 'content', 'content': 'Hello'})
+            await log.append({'type': 'complete', 'message': {'content': 'Hello'}})
+            await leader.land(ok=True)
+
+        payloads = self.follow_late_leader(start_leader)
+        self.assertEqual([payload['type'] for payload in payloads], ['stream_start', 'content', 'complete'])
+
+    @skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_duplicate_stops_when_the_leader_fails(self):
+        async def start_leader(leader):
+            await leader.land(ok=False)
+
+        payloads = self.follow_late_leader(start_leader)
+        self.assertEqual(payloads, [{'type': 'error', 'error': 'The original request did not finish'}])
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHANNEL_LAYERS=MEMORY_CHANNEL_LAYER)
+class ReplyBroadcastTests(TestCase):
+    """
+    Replies generated by the Celery task are pushed to the conversation's group
+    """
+
+    def setUp(self):
+        self.layer = get_channel_layer()
+        self.conversation = Conversation.objects.create(user_id='user-1')
+        async_to_sync(self.layer.group_add)(conversation_group(self.conversation.id), 'listener')
+
+    def run_task(self, **kwargs):
+        with FakeProvider(chunks=5, delay=0, text='tok ') as provider:
+            with self.settings(OPENROUTER_BASE_URL=provider.base_url):
+                return process_ai_chat_request.run(
+                    str(self.conversation.id), 'Hi', 'fake/model', 'key', 'user-1', **kwargs
+                )
+
+    def received(self):
+        events = []
+        while not events or events[-1]['type'] not in ('message_complete', 'error'):
+            events.append(json.loads(async_to_sync(self.layer.receive)('listener')['frames']['json']))
+        return events
+
+    def test_reply_is_streamed_to_the_group(self):
+        result = self.run_task()
+        events = self.received()
+
+        self.assertEqual(events[0]['type'], 'message_start')
+        self.assertEqual(events[-1]['type'], 'message_complete')
+        chunks = [event for event in events if event['type'] == 'message_chunk']
+        self.assertTrue(chunks)
+        self.assertEqual(''.join(event['content'] for event in chunks), events[-1]['content'])
+        self.assertEqual({event['message_id'] for event in events}, {result['message_id']})
+
+    def test_stored_user_message_is_not_duplicated(self):
+        user_message = Message.objects.create_message(conversation=self.conversation, role='user', content='Hi')
+        self.run_task(user_message_id=str(user_message.id))
+        self.assertEqual(self.conversation.messages.filter(role='user').count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PresenceTests(TestCase):
+    """
+    Sockets present on a conversation; kept in this process without Redis
+    """
+
+    def test_online_users_are_counted_per_user(self):
+        async def scenario():
+            await presence.join('conv-1', 'user-1', 'socket-a')
+            await presence.join('conv-1', 'user-1', 'socket-b')
+            await presence.join('conv-1', 'user-2', 'socket-c')
+            await presence.join('conv-2', 'user-3', 'socket-d')
+            both = await presence.online_users('conv-1')
+            await presence.leave('conv-1', 'user-1', 'socket-a')
+            still = await presence.online_users('conv-1')
+            await presence.leave('conv-1', 'user-1', 'socket-b')
+            return both, still, await presence.online_users('conv-1')
+
+        both, still, after_leaving = asyncio.run(scenario())
+        self.assertEqual(both, ['user-1', 'user-2'])
+        self.assertEqual(still, ['user-1', 'user-2'])
+        self.assertEqual(after_leaving, ['user-2'])
+
+    @override_settings(CHAT_SETTINGS={'PRESENCE_TTL': 0})
+    def test_sockets_without_heartbeat_expire(self):
+        async def scenario():
+            await presence.join('conv-3', 'user-1', 'socket-a')
+            return await presence.online_users('conv-3')
+
+        self.assertEqual(asyncio.run(scenario()), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConversationAccessTests(TestCase):
+    """
+    Cached WebSocket authorization: owner or shared, invalidated on changes
+    """
+
+    def setUp(self):
+        access.reset_access_cache()
+        self.conversation = Conversation.objects.create(user_id='owner')
+
+    def authorize(self, user_id):
+        return async_to_sync(access.authorize)(user_id, str(self.conversation.id))
+
+    def test_owner_and_shared_conversations_are_allowed(self):
+        decision, conversation = self.authorize('owner')
+        self.assertEqual(decision, {'allowed': True, 'owner': True})
+        self.assertEqual(conversation.pk, self.conversation.pk)
+        self.assertFalse(self.authorize('stranger')[0]['allowed'])
+        self.assertFalse(async_to_sync(access.authorize)('owner', 'not-a-uuid')[0]['allowed'])
+
+        self.conversation.is_shared = True
+        self.conversation.save()
+        self.assertEqual(self.authorize('stranger')[0], {'allowed': True, 'owner': False})
+
+    def test_repeat_connects_skip_the_database(self):
+        self.authorize('owner')
+        with self.assertNumQueries(0):
+            decision, conversation = self.authorize('owner')
+        self.assertTrue(decision['allowed'])
+        self.assertIsNone(conversation)
+        self.assertEqual(access.get_access_stats()['local_hits'], 1)
+
+    def test_deleting_the_conversation_revokes_access(self):
+        self.authorize('owner')
+        self.conversation.delete()
+        self.assertFalse(self.authorize('owner')[0]['allowed'])
+
+    def load_then_revoke(self):
+        """_load that sees the row as it was, then has sharing revoked under it"""
+        load = access._load
+
+        async def racing_load(conversation_id):
+            conversation = await load(conversation_id)
+            await database_sync_to_async(Conversation.objects.filter(pk=conversation_id).update)(is_shared=False)
+            access.invalidate_access(conversation_id)
+            return conversation
+        return mock.patch.object(access, '_load', racing_load)
+
+    def test_decision_loaded_before_an_invalidation_is_not_cached(self):
+        Conversation.objects.filter(pk=self.conversation.pk).update(is_shared=True)
+        with self.load_then_revoke():
+            self.assertTrue(self.authorize('stranger')[0]['allowed'])
+        self.assertFalse(self.authorize('stranger')[0]['allowed'])
+        self.assertEqual(access.get_access_stats()['misses'], 2)
+
+    @skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_store_is_skipped_after_an_invalidation(self):
+        server = fakeredis.FakeServer()
+        sync_client = fakeredis.FakeRedis(server=server)
+        with mock.patch.object(access, 'get_redis', lambda: sync_client), \
+                mock.patch.object(access, 'get_async_redis', lambda: fakeredis.aioredis.FakeRedis(server=server)):
+            Conversation.objects.filter(pk=self.conversation.pk).update(is_shared=True)
+            with self.load_then_revoke():
+                self.assertTrue(self.authorize('stranger')[0]['allowed'])
+            self.assertFalse(sync_client.exists(access.access_key(self.conversation.id)))
+            self.assertEqual(access.get_access_stats()['stale'], 1)
+
+            self.assertFalse(self.authorize('stranger')[0]['allowed'])
+            access.reset_access_cache()
+            self.assertFalse(self.authorize('stranger')[0]['allowed'])
+            self.assertEqual(access.get_access_stats()['redis_hits'], 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CHANNEL_LAYERS=MEMORY_CHANNEL_LAYER,
+                   CHAT_SETTINGS={'TYPING_DEBOUNCE_MS': 20, 'TYPING_TIMEOUT': 5})
+class TypingIndicatorTests(TestCase):
+    """
+    Typing indicators are debounced per typist and batched per conversation
+    """
+
+    def setUp(self):
+        typing_indicators.reset_typing_stats()
+
+    def test_repeats_and_undone_changes_are_dropped(self):
+        batcher = typing_indicators.TypingBatcher('group', layer=None)
+        batcher.update('user-1', True, now=0)
+        batcher.update('user-1', True, now=1)
+        self.assertEqual(batcher.take(), {'user-1': True})
+
+        batcher.update('user-1', False, now=2)
+        batcher.update('user-1', True, now=2.1)
+        self.assertEqual(batcher.take(), {})
+
+        # No typing_stop arrives
+        batcher.expire(now=8)
+        self.assertEqual(batcher.take(), {'user-1': False})
+        self.assertTrue(batcher.idle)
+        stats = typing_indicators.get_typing_stats()
+        self.assertEqual((stats['received'], stats['dropped'], stats['expired']), (4, 3, 1))
+
+    def test_typists_are_batched_into_one_group_event(self):
+        layer = get_channel_layer()
+
+        async def scenario():
+            await layer.group_add('chat_typing', 'listener')
+            for user_id in ('user-1', 'user-2', 'user-1'):
+                typing_indicators.set_typing('chat_typing', layer, user_id, True)
+            first = await asyncio.wait_for(layer.receive('listener'), 1)
+            typing_indicators.set_typing('chat_typing', layer, 'user-1', False)
+            typing_indicators.set_typing('chat_typing', layer, 'user-2', False)
+            second = await asyncio.wait_for(layer.receive('listener'), 1)
+            while typing_indicators.get_typing_stats()['active_conversations']:
+                await asyncio.sleep(0.01)
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        self.assertEqual(first['users'], {'user-1': True, 'user-2': True})
+        self.assertEqual(second['users'], {'user-1': False, 'user-2': False})
+        stats = typing_indicators.get_typing_stats()
+        self.assertEqual((stats['forwarded'], stats['batches'], stats['dropped']), (4, 2, 1))
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+@override_settings(CACHES=LOCMEM_CACHE, CHANNEL_LAYERS=MEMORY_CHANNEL_LAYER)
+class WireProtocolTests(TransactionTestCase):
+    """
+    MessagePack subprotocol, JSON fallback and group frames encoded once
+    """
+
+    def setUp(self):
+        access.reset_access_cache()
+        self.conversation = Conversation.objects.create(user_id='anonymous')
+
+    async def connect(self, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/', subprotocols=subprotocols
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    def test_msgpack_is_negotiated(self):
+        async def scenario():
+            communicator, subprotocol = await self.connect(['chat.msgpack', 'chat.json'])
+            welcome = msgpack.unpackb(await communicator.receive_from())
+            await communicator.send_to(bytes_data=msgpack.packb({'type': 'ping'}))
+            pong = msgpack.unpackb(await communicator.receive_from())
+            await communicator.send_to(text_data=json.dumps({'type': 'ping'}))
+            text_pong = msgpack.unpackb(await communicator.receive_from())
+            await communicator.disconnect()
+            return subprotocol, welcome, pong, text_pong
+
+        subprotocol, welcome, pong, text_pong = async_to_sync(scenario)()
+        self.assertEqual(subprotocol, 'chat.msgpack')
+        self.assertEqual(welcome['type'], 'connection_established')
+        self.assertEqual((pong['type'], text_pong['type']), ('pong', 'pong'))
+
+    def test_group_frames_are_shared_by_both_encodings(self):
+        async def scenario():
+            binary, _ = await self.connect(['chat.msgpack'])
+            text, subprotocol = await self.connect()
+            await binary.receive_from()
+            await text.receive_from()
+            wire.reset_wire_stats()
+            await get_channel_layer().group_send(
+                conversation_group(self.conversation.id),
+                wire.group_event('reply_event', {'type': 'message_chunk', 'content': 'Hi'})
+            )
+            frames = await binary.receive_from(), await text.receive_from()
+            await binary.disconnect()
+            await text.disconnect()
+            return subprotocol, frames
+
+        subprotocol, (binary_frame, text_frame) = async_to_sync(scenario)()
+        self.assertIsNone(subprotocol)
+        self.assertEqual(msgpack.unpackb(binary_frame), json.loads(text_frame))
+        stats = wire.get_wire_stats()['codecs']
+        self.assertEqual((stats['json']['encodes'], stats['json']['shared']), (1, 1))
+        self.assertEqual((stats['msgpack']['encodes'], stats['msgpack']['shared']), (1, 1))
+
+    def test_notifications_are_encoded_once_per_group(self):
+        async def scenario():
+            sockets = []
+            for subprotocols in (['chat.msgpack'], None, None):
+                communicator = WebsocketCommunicator(
+                    URLRouter(websocket_urlpatterns), '/ws/notifications/', subprotocols=subprotocols
+                )
+                connected, _ = await communicator.connect()
+                self.assertTrue(connected)
+                await communicator.receive_from()
+                sockets.append(communicator)
+            wire.reset_wire_stats()
+            await get_channel_layer().group_send(
+                notification_group('anonymous'), system_notification('Maintenance', 'Back soon', level='warning')
+            )
+            await get_channel_layer().group_send(
+                notification_group('anonymous'), task_completed('task-1', 'file_upload', {'ok': True})
+            )
+            frames = [[await socket.receive_from() for _ in range(2)] for socket in sockets]
+            for socket in sockets:
+                await socket.disconnect()
+            return frames
+
+        (binary, text, other_text) = async_to_sync(scenario)()
+        self.assertEqual([msgpack.unpackb(frame) for frame in binary], [json.loads(frame) for frame in text])
+        self.assertEqual(text, other_text)
+        notification, completed = map(json.loads, text)
+        self.assertEqual((notification['type'], notification['level']), ('system_notification', 'warning'))
+        self.assertEqual((completed['type'], completed['result']), ('task_completed', {'ok': True}))
+        stats = wire.get_wire_stats()['codecs']
+        self.assertEqual((stats['json']['encodes'], stats['json']['shared']), (2, 4))
+        self.assertEqual((stats['msgpack']['encodes'], stats['msgpack']['shared']), (2, 2))
@@ -0,0 +1,202 @@
+"""
+Token counting with the providers' BPE encodings.
+
+Counts come from tiktoken with the encoding the model family uses
+(o200k_base for GPT-4o/o-series, cl100k_base for GPT-4/3.5 and as the
+stand-in for other providers). When tiktoken is not installed or its
+encoding files cannot be loaded (they are downloaded on first use; set
+TIKTOKEN_CACHE_DIR to ship them with the app), a regex approximation of the
+same pre-tokenization is used instead.
+
+Counts are cached in-process by content hash, so re-counting a history only
+encodes messages not seen before. Message.token_count is filled from here
+once, when the message is written.
+"""
+
+import hashlib
+import logging
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    import tiktoken
+except ImportError:  # optional dependency
+    tiktoken = None
+
+logger = logging.getLogger('chat')
+
+APPROXIMATE = 'approximate'
+
+# Longest prefix wins; model names are matched with and without the
+# OpenRouter "provider/" prefix
+MODEL_ENCODINGS = {
+    'gpt-4o': 'o200k_base',
+    'gpt-4.1': 'o200k_base',
+    'gpt-4.5': 'o200k_base',
+    'gpt-5': 'o200k_base',
+    'o1': 'o200k_base',
+    'o3': 'o200k_base',
+    'o4': 'o200k_base',
+    'chatgpt-4o': 'o200k_base',
+    'gpt-4': 'cl100k_base',
+    'gpt-3.5': 'cl100k_base',
+    'text-embedding-3': 'cl100k_base',
+}
+
+# Per-message framing of the chat format (role and separators), and the
+# tokens that prime the assistant's reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Same split as the GPT pre-tokenizer: contractions, words, 1-3 digit
+# groups, punctuation runs and whitespace
+PIECE_RE = re.compile(r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+")
+
+_lock = threading.Lock()
+_counts = OrderedDict()
+_encodings = {}
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _tokenizer_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('TOKENIZER_DEFAULT_ENCODING', 'cl100k_base'),
+        chat_settings.get('TOKENIZER_CACHE_SIZE', 20000),
+    )
+
+
+def encoding_for_model(model=None):
+    """Name of the encoding used to count tokens for `model`"""
+    default, _ = _tokenizer_settings()
+    if not model:
+        return default
+    name = model.rsplit('/', 1)[-1].lower()
+    best = None
+    for prefix in MODEL_ENCODINGS:
+        if name.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return MODEL_ENCODINGS[best] if best else default
+
+
+def get_encoding(name):
+    """tiktoken encoding, or None when counts have to be approximated"""
+    if name in _encodings:
+        return _encodings[name]
+    encoding = None
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.get_encoding(name)
+        except Exception as e:
+            logger.warning(f"Tokenizer encoding {name} unavailable, approximating counts: {str(e)}")
+    _encodings[name] = encoding
+    return encoding
+
+
+def backend(model=None):
+    """'tiktoken' or 'approximate', for the encoding `model` uses"""
+    return 'tiktoken' if get_encoding(encoding_for_model(model)) is not None else APPROXIMATE
+
+
+def approximate_count(text):
+    """Token estimate from the pre-tokenizer split, without the BPE merges"""
+    count = 0
+    for piece in PIECE_RE.findall(text):
+        stripped = piece.strip()
+        if not stripped:
+            count += 1 if piece.count('\n') < 2 else math.ceil(len(piece) / 4)
+        elif stripped.isalpha():
+            # Common words are one token; long or rare ones split every few letters
+            count += max(1, math.ceil(len(stripped) / 6))
+        else:
+            count += max(1, math.ceil(len(stripped) / 3))
+    return count
+
+
+def _key(encoding_name, text):
+    return (encoding_name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+
+
+def _remember(key, count, cache_size):
+    with _lock:
+        _counts[key] = count
+        _counts.move_to_end(key)
+        while len(_counts) > cache_size:
+            _counts.popitem(last=False)
+
+
+def count_many(texts, model=None):
+    """
+    Token counts for a batch of texts, in order.
+
+    Cached texts are not encoded again; the rest are encoded in one batch.
+    """
+    encoding_name = encoding_for_model(model)
+    _, cache_size = _tokenizer_settings()
+    results = [0] * len(texts)
+    missing = {}
+    with _lock:
+        for index, text in enumerate(texts):
+            if not text:
+                continue
+            key = _key(encoding_name, text)
+            if key in _counts:
+                _counts.move_to_end(key)
+                results[index] = _counts[key]
+                _stats['hits'] += 1
+            else:
+                missing.setdefault(key, []).append(index)
+                _stats['misses'] += 1
+
+    if missing:
+        keys = list(missing)
+        batch = [texts[missing[key][0]] for key in keys]
+        encoding = get_encoding(encoding_name)
+        if encoding is not None:
+            # encode_ordinary: user text may contain "<|endoftext|>" and must be counted, not rejected
+            counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(batch)]
+        else:
+            counts = [approximate_count(text) for text in batch]
+        for key, count in zip(keys, counts):
+            _remember(key, count, cache_size)
+            for index in missing[key]:
+                results[index] = count
+    return results
+
+
+def count_tokens(text, model=None):
+    """Token count of one text"""
+    if not text:
+        return 0
+    return count_many([text], model)[0]
+
+
+def count_messages(messages, model=None):
+    """
+    Prompt tokens for a chat history of {'role', 'content'} dicts,
+    including the chat format's per-message overhead
+    """
+    contents = [message.get('content') or '' for message in messages]
+    return sum(count_many(contents, model)) + TOKENS_PER_MESSAGE * len(messages) + TOKENS_PER_REPLY
+
+
+def get_tokenizer_stats():
+    """Cache hit/miss counts and the backend in use"""
+    with _lock:
+        stats = dict(_stats)
+        stats['cached'] = len(_counts)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    stats['backend'] = backend()
+    return stats
+
+
+def clear_cache():
+    with _lock:
+        _counts.clear()
+        for name in _stats:
+            _stats[name] = 0
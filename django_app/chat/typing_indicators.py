@@ -0,0 +1,165 @@
+"""
+Debounced, batched typing indicators.
+
+Clients send typing_start/typing_stop on every keystroke burst; forwarding
+each one is a channel-layer publish and a frame per group member. Instead
+each process keeps one TypingBatcher per conversation. It records the
+latest state of every local typist and publishes the changes as a single
+typing_batch group event, at most once per TYPING_DEBOUNCE_MS: the first
+change goes out at once, later ones wait for the window. Repeats of the
+state already shown, and changes undone within the window, are dropped.
+A typist who never sends typing_stop is announced as stopped
+TYPING_TIMEOUT seconds after their last typing_start.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import wire
+
+logger = logging.getLogger('chat')
+
+_lock = threading.Lock()
+_stats = {'received': 0, 'forwarded': 0, 'dropped': 0, 'expired': 0, 'batches': 0}
+
+_batchers = {}
+
+
+def _typing_settings():
+    chat_settings = getattr(settings, 'CHAT_SETTINGS', {})
+    return (
+        chat_settings.get('TYPING_DEBOUNCE_MS', 500) / 1000,
+        chat_settings.get('TYPING_TIMEOUT', 6),
+    )
+
+
+def _count(stat, value=1):
+    with _lock:
+        _stats[stat] += value
+
+
+class TypingBatcher:
+    """
+    Typing state of one conversation's typists on this process
+    """
+
+    def __init__(self, group, layer, window=None, timeout=None):
+        default_window, default_timeout = _typing_settings()
+        self.group = group
+        self.layer = layer
+        self.window = default_window if window is None else window
+        self.timeout = default_timeout if timeout is None else timeout
+        self.shown = set()  # users last announced as typing
+        self.expires = {}  # typing users -> when they count as stopped
+        self.pending = {}  # users -> state to announce with the next batch
+        self.task = None
+
+    def update(self, user_id, is_typing, now=None):
+        """Record a typing_start/typing_stop; returns True if it is queued"""
+        now = time.monotonic() if now is None else now
+        _count('received')
+        if is_typing:
+            self.expires[user_id] = now + self.timeout
+        else:
+            self.expires.pop(user_id, None)
+
+        shown = user_id in self.shown
+        if self.pending.get(user_id, shown) == is_typing:
+            _count('dropped')
+            return False
+        if user_id in self.pending:
+            # Undone within the window: neither frame is forwarded
+            del self.pending[user_id]
+            _count('dropped', 2)
+            return False
+        self.pending[user_id] = is_typing
+        return True
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        for user_id, expires in list(self.expires.items()):
+            if expires <= now:
+                del self.expires[user_id]
+                if user_id in self.shown:
+                    self.pending[user_id] = False
+                    _count('expired')
+                elif self.pending.pop(user_id, False):
+                    _count('dropped')
+
+    def take(self):
+        """The pending changes, as announced from now on"""
+        batch, self.pending = self.pending, {}
+        for user_id, is_typing in batch.items():
+            if is_typing:
+                self.shown.add(user_id)
+            else:
+                self.shown.discard(user_id)
+        return batch
+
+    @property
+    def idle(self):
+        return not self.pending and not self.expires
+
+    async def run(self, key):
+        """Publish batches until nobody is typing and a window passed quietly"""
+        try:
+            while True:
+                self.expire()
+                if self.pending:
+                    await self.publish(self.take())
+                elif not self.expires:
+                    break
+                await asyncio.sleep(self.window)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Typing batcher for {self.group} failed: {str(e)}")
+        finally:
+            if _batchers.get(key) is self:
+                del _batchers[key]
+
+    async def publish(self, batch):
+        _count('forwarded', len(batch))
+        _count('batches')
+        timestamp = timezone.now().isoformat()
+        await self.layer.group_send(self.group, wire.group_event(
+            'typing_batch',
+            {'type': 'typing_batch', 'users': batch, 'timestamp': timestamp},
+            users=batch,
+            timestamp=timestamp
+        ))
+
+
+def set_typing(group, layer, user_id, is_typing):
+    """Queue a typist's state for the group; must be called on the consumer's loop"""
+    key = (asyncio.get_running_loop(), group)
+    batcher = _batchers.get(key)
+    if batcher is None:
+        batcher = _batchers[key] = TypingBatcher(group, layer)
+    queued = batcher.update(user_id, is_typing)
+    if batcher.task is None or batcher.task.done():
+        if batcher.idle:
+            del _batchers[key]
+        else:
+            batcher.task = asyncio.ensure_future(batcher.run(key))
+    return queued
+
+
+def get_typing_stats():
+    """Typing frames received, forwarded in batches and dropped, in this process"""
+    with _lock:
+        stats = dict(_stats)
+    stats['drop_rate'] = stats['dropped'] / stats['received'] if stats['received'] else 0.0
+    stats['active_conversations'] = len(_batchers)
+    return stats
+
+
+def reset_typing_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import streaming, views
 from django.views.generic import TemplateView
 
 # Create router for ViewSets
@@ -13,7 +13,8 @@ urlpatterns = [
     
     # Chat endpoints
     path('api/chat/', views.chat_message, name='chat_message'),
-    path('api/chat/stream/', views.chat_message, name='chat_message_stream'),
+    path('api/chat/stream/', streaming.chat_stream, name='chat_message_stream'),
+    path('api/chat/stream/<uuid:message_id>/', streaming.chat_stream_resume, name='chat_stream_resume'),
     
     # Image generation
     path('api/image/', views.generate_image, name='generate_image'),
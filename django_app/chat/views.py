@@ -4,14 +4,13 @@ from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from django.conf import settings
+from django.db import models
 from .models import Conversation, Message
 from .serializers import ConversationSerializer, MessageSerializer
 import openai
 from tavily import TavilyClient
-import json
 import logging
 import time
-import asyncio
 from django.http import JsonResponse, StreamingHttpResponse, HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
@@ -25,10 +24,26 @@ import hashlib
 import uuid
 import os
 
-from .models import Conversation, Message, FileUpload, APIUsage
+from .models import Conversation, Message, FileUpload
 from .serializers import ConversationSerializer, MessageSerializer, FileUploadSerializer
 from .tasks import process_ai_chat_request, process_image_generation, process_file_upload
 from .authentication import APIKeyAuthentication
+from .encryption import get_key_ring
+from . import counters
+from .access import get_access_stats
+from .broadcast import get_broadcast_stats
+from .coalescing import get_coalescing_stats
+from .completion_cache import completion_options, get_completion_cache_stats
+from .llm_clients import get_pool_stats
+from .single_flight import Flight, flight_key, get_flight_stats
+from .summaries import get_summary_stats, summary_report
+from .tokenizer import get_tokenizer_stats
+from .typing_indicators import get_typing_stats
+from .wire import get_wire_stats
+from .cache_keys import conversation_key
+from .pagination import InvalidCursor, paginate_messages
+from .exports import iter_export
+from .streaming import event_stream_response, stream_chat_events, usage_context
 
 logger = logging.getLogger('chat')
 channel_layer = get_channel_layer()
@@ -48,19 +63,20 @@ class ConversationViewSet(viewsets.ModelViewSet):
     throttle_classes = [UserRateThrottle]
     
     def get_queryset(self):
-        """Get conversations for the current user with caching"""
-        user_id = self.get_user_id()
-        cache_key = f"user_conversations:{user_id}"
-        
-        conversations = cache.get(cache_key)
-        if conversations is None:
-            conversations = Conversation.objects.filter(
-                user_id=user_id,
-                is_archived=False
-            ).order_by('-last_activity')
-            cache.set(cache_key, conversations, 300)  # Cache for 5 minutes
-        
-        return conversations
+        """Get conversations for the current user"""
+        return Conversation.objects.filter(
+            user_id=self.get_user_id(),
+            is_archived=False
+        ).order_by('-last_activity')
+    
+    def list(self, request):
+        """List conversations as cached summary rows, paginated like any other list"""
+        archived = request.GET.get('archived') in ('1', 'true')
+        rows = Conversation.objects.summary_rows(self.get_user_id(), archived=archived)
+        page = self.paginate_queryset(rows)
+        if page is None:
+            return Response(rows[:])
+        return self.get_paginated_response(page)
     
     def create(self, request):
         """Create a new conversation with enhanced features"""
@@ -75,9 +91,6 @@ class ConversationViewSet(viewsets.ModelViewSet):
                 metadata=metadata
             )
             
-            # Invalidate cache
-            cache.delete(f"user_conversations:{user_id}")
-            
             serializer = self.get_serializer(conversation)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
             
@@ -88,6 +101,35 @@ class ConversationViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Stream all of the user's conversations as NDJSON"""
+        conversations = Conversation.objects.filter(user_id=self.get_user_id())
+        ids = request.GET.getlist('id')
+        if ids:
+            # Check ids and ownership now: once streaming starts the status is sent
+            try:
+                ids = {uuid.UUID(conversation_id) for conversation_id in ids}
+            except ValueError:
+                return Response(
+                    {'error': 'Invalid conversation id'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            conversations = conversations.filter(pk__in=ids)
+            if conversations.count() != len(ids):
+                return Response(
+                    {'error': 'Conversation not found'},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+        
+        response = StreamingHttpResponse(
+            iter_export(conversations),
+            content_type='application/x-ndjson'
+        )
+        response['Content-Disposition'] = 'attachment; filename="conversations.ndjson"'
+        response['Cache-Control'] = 'no-cache'
+        return response
+    
     @action(detail=True, methods=['post'])
     def archive(self, request, pk=None):
         """Archive a conversation"""
@@ -96,10 +138,6 @@ class ConversationViewSet(viewsets.ModelViewSet):
             conversation.is_archived = True
             conversation.save(update_fields=['is_archived'])
             
-            # Invalidate cache
-            user_id = self.get_user_id()
-            cache.delete(f"user_conversations:{user_id}")
-            
             return Response({'status': 'archived'})
             
         except Exception as e:
@@ -114,32 +152,37 @@ class ConversationViewSet(viewsets.ModelViewSet):
         """Get messages for a conversation with pagination"""
         try:
             conversation = self.get_object()
-            page = int(request.GET.get('page', 1))
-            page_size = int(request.GET.get('page_size', 50))
+            cursor = request.GET.get('cursor') or None
+            page_size = max(1, min(int(request.GET.get('page_size', 50)), 200))
             
-            # Calculate offset
-            offset = (page - 1) * page_size
+            # Get messages with caching; any change to the conversation bumps
+            # its namespace, which retires every cached page at once
+            cache_key = conversation_key(pk, 'messages', cursor or 'start', page_size)
+            page = cache.get(cache_key)
             
-            # Get messages with caching
-            cache_key = f"conversation_messages:{pk}:{page}:{page_size}"
-            messages_data = cache.get(cache_key)
-            
-            if messages_data is None:
-                messages = Message.objects.filter(
-                    conversation=conversation,
-                    is_deleted=False
-                ).order_by('created_at')[offset:offset + page_size]
-                
-                messages_data = [msg.get_summary() for msg in messages]
-                cache.set(cache_key, messages_data, 300)  # Cache for 5 minutes
+            if page is None:
+                messages, next_cursor, prev_cursor = paginate_messages(
+                    Message.objects.visible().filter(conversation=conversation),
+                    cursor=cursor,
+                    page_size=page_size
+                )
+                page = {
+                    'messages': [msg.get_summary() for msg in messages],
+                    'next': next_cursor,
+                    'prev': prev_cursor,
+                }
+                cache.set(cache_key, page, 300)  # Cache for 5 minutes
             
             return Response({
-                'messages': messages_data,
-                'page': page,
+                'messages': page['messages'],
                 'page_size': page_size,
-                'has_more': len(messages_data) == page_size
+                'next': page['next'],
+                'prev': page['prev'],
+                'has_more': page['next'] is not None
             })
             
+        except InvalidCursor as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             logger.error(f"Message retrieval failed: {str(e)}")
             return Response(
@@ -151,7 +194,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
     def analytics(self, request, pk=None):
         """Get conversation analytics"""
         try:
-            conversation = self.get_object()
+            conversation = counters.apply_pending([self.get_object()])[0]
             
             # Calculate analytics
             total_messages = conversation.message_count
@@ -159,7 +202,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
             
             # Get model usage breakdown
             model_usage = {}
-            for message in conversation.messages.filter(model__isnull=False, is_deleted=False):
+            for message in conversation.messages.visible().filter(model__isnull=False):
                 model = message.model
                 if model not in model_usage:
                     model_usage[model] = {'count': 0, 'tokens': 0}
@@ -177,6 +220,7 @@ class ConversationViewSet(viewsets.ModelViewSet):
                 'total_tokens': total_tokens,
                 'model_usage': model_usage,
                 'avg_response_time': float(avg_response_time),
+                'summary': summary_report(conversation),
                 'created_at': conversation.created_at.isoformat(),
                 'last_activity': conversation.last_activity.isoformat()
             }
@@ -215,6 +259,7 @@ def chat_message(request):
         model = data.get('model', 'openai/gpt-4o-mini')
         stream = data.get('stream', False)
         api_key = data.get('api_key')
+        idempotency_key = data.get('idempotency_key') or request.headers.get('Idempotency-Key')
         
         # Validation
         if not conversation_id or not message:
@@ -229,6 +274,12 @@ def chat_message(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        # Sampling parameters and the completion cache opt-in
+        try:
+            options = completion_options(data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
         # Get conversation
         try:
             conversation = Conversation.objects.get(id=conversation_id)
@@ -243,22 +294,58 @@ def chat_message(request):
         
         if stream:
             # Return streaming response
-            return StreamingHttpResponse(
-                stream_chat_response(conversation, message, model, api_key, user_id),
-                content_type='text/event-stream'
+            return event_stream_response(
+                request,
+                stream_chat_events(
+                    conversation, message, model, api_key, user_id, usage_context(request), options,
+                    idempotency_key=idempotency_key
+                )
             )
         else:
-            # Process asynchronously with Celery
-            task_result = process_ai_chat_request.delay(
-                conversation_id=str(conversation_id),
-                user_message=message,
-                model=model,
-                api_key=api_key,
-                user_id=user_id
+            # Duplicates of a request in flight follow its reply instead of queueing another
+            reply_id = str(uuid.uuid4())
+            flight = Flight.claim(
+                flight_key(user_id, conversation.id, message, idempotency_key),
+                reply_id,
+                user_id,
+                client_key=bool(idempotency_key)
             )
+            if not flight.leader:
+                return Response({
+                    'status': 'duplicate',
+                    'message_id': flight.message_id,
+                    'message': 'An identical request is already being processed'
+                }, status=status.HTTP_202_ACCEPTED)
+            
+            # Store the user message here, once; retries of the task skip it
+            user_message = Message.objects.create_message(
+                conversation=conversation,
+                role='user',
+                content=message,
+                model=model
+            )
+            
+            # Process asynchronously with Celery
+            try:
+                task_result = process_ai_chat_request.delay(
+                    conversation_id=str(conversation_id),
+                    user_message=message,
+                    model=model,
+                    api_key=api_key,
+                    user_id=user_id,
+                    message_id=reply_id,
+                    options=options,
+                    flight=flight.to_task(),
+                    user_message_id=str(user_message.id)
+                )
+            except Exception:
+                flight.land(ok=False)
+                raise
             
             return Response({
                 'task_id': task_result.id,
+                'message_id': reply_id,
+                'user_message_id': str(user_message.id),
                 'status': 'processing',
                 'message': 'Request is being processed'
             }, status=status.HTTP_202_ACCEPTED)
@@ -271,103 +358,6 @@ def chat_message(request):
         )
 
 
-def stream_chat_response(conversation, message, model, api_key, user_id):
-    """
-    Generator function for streaming chat responses
-    """
-    try:
-        # Create user message
-        user_msg = Message.objects.create_message(
-            conversation=conversation,
-            role='user',
-            content=message,
-            model=model
-        )
-        
-        # Send user message event
-        yield f"data: {json.dumps({'type': 'user_message', 'message': user_msg.get_summary()})}\n\n"
-        
-        # Initialize OpenAI client
-        client = openai.AsyncOpenAI(
-            api_key=api_key,
-            base_url="https://openrouter.ai/api/v1"
-        )
-        
-        # Get conversation history
-        messages = []
-        for msg in conversation.get_recent_messages(limit=20):
-            messages.append({
-                'role': msg.role,
-                'content': msg.content
-            })
-        
-        # Stream AI response
-        start_time = time.time()
-        full_response = ""
-        
-        async def stream_ai_response():
-            nonlocal full_response
-            
-            stream = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                stream=True,
-                temperature=0.7,
-                max_tokens=4000
-            )
-            
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    full_response += content
-                    yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-        
-        # Run async generator
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        async_gen = stream_ai_response()
-        try:
-            while True:
-                chunk = loop.run_until_complete(async_gen.__anext__())
-                yield chunk
-        except StopAsyncIteration:
-            pass
-        finally:
-            loop.close()
-        
-        # Calculate metrics
-        response_time = time.time() - start_time
-        
-        # Create assistant message
-        assistant_msg = Message.objects.create_message(
-            conversation=conversation,
-            role='assistant',
-            content=full_response,
-            model=model,
-            tokens=len(full_response.split())  # Rough token estimate
-        )
-        assistant_msg.response_time = response_time
-        assistant_msg.save(update_fields=['response_time'])
-        
-        # Send completion event
-        yield f"data: {json.dumps({'type': 'complete', 'message': assistant_msg.get_summary()})}\n\n"
-        
-        # Log API usage
-        APIUsage.log_request(
-            user_id=user_id,
-            endpoint='/api/chat/stream/',
-            method='POST',
-            status_code=200,
-            response_time=response_time,
-            tokens_used=len(full_response.split())
-        )
-        
-    except Exception as e:
-        logger.error(f"Streaming response failed: {str(e)}")
-        yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
-
-
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 @ratelimit(key='user', rate='10/m', method='POST')
@@ -755,6 +745,17 @@ def dashboard_metrics(request):
             'messages_today': messages_today,
             'active_users': active_users,
             'avg_response_time': avg_response_time,
+            'encryption': get_key_ring().get_stats(),
+            'llm_clients': get_pool_stats(),
+            'stream_coalescing': get_coalescing_stats(),
+            'ws_stream': get_broadcast_stats(),
+            'ws_access': get_access_stats(),
+            'typing': get_typing_stats(),
+            'ws_wire': get_wire_stats(),
+            'tokenizer': get_tokenizer_stats(),
+            'completion_cache': get_completion_cache_stats(),
+            'single_flight': get_flight_stats(),
+            'summaries': get_summary_stats(),
             'status': 'online',
             'timestamp': datetime.now().isoformat()
         })
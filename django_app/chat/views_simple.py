@@ -10,9 +10,10 @@ from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib import messages
+from .context import build_context
+from .llm_clients import get_sync_client
 from .models import Conversation, Message
 import json
-import openai
 from django.conf import settings
 import asyncio
 import time
@@ -20,9 +21,7 @@ import time
 def home(request):
     """Main chat interface"""
     if request.user.is_authenticated:
-        conversations = Conversation.objects.filter(
-            user_id=str(request.user.id)
-        ).order_by('-last_activity')[:10]
+        conversations = Conversation.objects.get_user_conversations(str(request.user.id), limit=10)
         
         return render(request, 'chat/simple_chat.html', {
             'conversations': conversations
@@ -77,7 +76,7 @@ def send_message(request):
             )
         
         # Save user message
-        user_message = Message.objects.create(
+        user_message = Message.objects.create_message(
             conversation=conversation,
             role='user',
             content=message_content
@@ -94,18 +93,10 @@ def send_message(request):
         
         # Generate AI response
         try:
-            client = openai.OpenAI(
-                api_key=api_key,
-                base_url="https://openrouter.ai/api/v1"
-            )
+            client = get_sync_client(api_key)
             
-            # Get conversation history
-            messages = []
-            for msg in conversation.messages.filter(is_deleted=False).order_by('created_at')[-10:]:
-                messages.append({
-                    "role": msg.role,
-                    "content": msg.content
-                })
+            # Conversation history that fits the model's context window
+            messages = build_context(conversation, model, max_tokens=1000)
             
             response = client.chat.completions.create(
                 model=model,
@@ -117,7 +108,7 @@ def send_message(request):
             ai_response = response.choices[0].message.content
             
             # Save AI message
-            ai_message = Message.objects.create(
+            ai_message = Message.objects.create_message(
                 conversation=conversation,
                 role='assistant',
                 content=ai_response,
@@ -159,7 +150,7 @@ def get_conversation(request, conversation_id):
         )
         
         messages = []
-        for msg in conversation.messages.filter(is_deleted=False).order_by('created_at'):
+        for msg in conversation.messages.visible().order_by('created_at').decrypted():
             messages.append({
                 'id': str(msg.id),
                 'role': msg.role,
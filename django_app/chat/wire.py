@@ -0,0 +1,110 @@
+"""
+Wire encodings of WebSocket frames.
+
+Clients pick an encoding through the WebSocket subprotocol: offering
+``chat.msgpack`` gets binary MessagePack frames, while ``chat.json`` or no
+subprotocol at all gets JSON text frames as before. Either side may send
+JSON text at any time. MessagePack needs the optional msgpack package;
+without it the server only accepts ``chat.json``.
+
+Events sent to a channel-layer group carry the payload already encoded in
+every format (group_event), so each consumer in the group writes the shared
+frame instead of serializing the payload again.
+"""
+
+import json
+import logging
+import threading
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+logger = logging.getLogger('chat')
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# Subprotocol name -> encoding, in the order the server prefers them
+SUBPROTOCOLS = {
+    'chat.msgpack': MSGPACK,
+    'chat.json': JSON,
+}
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _count(codec, stat, value=1):
+    with _lock:
+        counts = _stats.setdefault(codec, {'frames': 0, 'bytes': 0, 'encodes': 0, 'shared': 0})
+        counts[stat] += value
+
+
+def available(codec):
+    return codec == JSON or (codec == MSGPACK and msgpack is not None)
+
+
+def negotiate(offered):
+    """(subprotocol to accept or None, encoding) for the subprotocols a client offered"""
+    for subprotocol, codec in SUBPROTOCOLS.items():
+        if subprotocol in offered and available(codec):
+            return subprotocol, codec
+    return None, JSON
+
+
+def encode(payload, codec=JSON):
+    """A payload as a text (JSON) or bytes (MessagePack) frame"""
+    _count(codec, 'encodes')
+    if codec == MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload)
+
+
+def decode(text_data=None, bytes_data=None):
+    """Payload of a received frame; raises ValueError when it is malformed"""
+    if text_data is not None:
+        payload = json.loads(text_data)
+    elif msgpack is None:
+        raise ValueError('Binary frames need the chat.msgpack subprotocol')
+    else:
+        payload = msgpack.unpackb(bytes_data, raw=False)
+    if not isinstance(payload, dict):
+        raise ValueError('Frames must hold an object')
+    return payload
+
+
+def frames(payload):
+    """The payload encoded once in every available format, for a group event"""
+    return {codec: encode(payload, codec) for codec in SUBPROTOCOLS.values() if available(codec)}
+
+
+def group_event(handler, payload, **fields):
+    """Channel-layer event for `handler` carrying the encoded frames of `payload`"""
+    return {'type': handler, 'frames': frames(payload), **fields}
+
+
+def frame_kwargs(frame, codec, shared=False):
+    """send() keyword arguments for an encoded frame"""
+    _count(codec, 'frames')
+    _count(codec, 'bytes', len(frame))
+    if shared:
+        _count(codec, 'shared')
+    if isinstance(frame, bytes):
+        return {'bytes_data': frame}
+    return {'text_data': frame}
+
+
+def get_wire_stats():
+    """Frames, bytes and encodes per encoding, in this process"""
+    with _lock:
+        codecs = {codec: dict(counts) for codec, counts in _stats.items()}
+    for counts in codecs.values():
+        counts['bytes_per_frame'] = counts['bytes'] / counts['frames'] if counts['frames'] else 0.0
+    return {'msgpack_available': msgpack is not None, 'codecs': codecs}
+
+
+def reset_wire_stats():
+    with _lock:
+        _stats.clear()
@@ -35,6 +35,18 @@ app.conf.beat_schedule = {
         'schedule': crontab(minute='*/30'),  # Every 30 minutes
     },
     
+    # Apply write-behind conversation counters
+    'flush-conversation-counters': {
+        'task': 'chat.tasks.flush_conversation_counters',
+        'schedule': settings.CHAT_SETTINGS.get('COUNTER_FLUSH_INTERVAL', 10),
+    },
+    
+    # Close out replies left streaming by a worker that died
+    'abort-stale-replies': {
+        'task': 'chat.tasks.abort_stale_replies',
+        'schedule': crontab(minute='*/5'),  # Every 5 minutes
+    },
+    
     # Health check every 5 minutes
     'health-check': {
         'task': 'chat.tasks.health_check',
@@ -47,11 +59,14 @@ app.conf.update(
     # Task routing
     task_routes={
         'chat.tasks.process_ai_chat_request': {'queue': 'ai_requests'},
+        'chat.tasks.summarize_conversation': {'queue': 'ai_requests'},
         'chat.tasks.process_image_generation': {'queue': 'image_generation'},
         'chat.tasks.process_file_upload': {'queue': 'file_processing'},
         'chat.tasks.cleanup_old_data': {'queue': 'maintenance'},
         'chat.tasks.generate_analytics_report': {'queue': 'analytics'},
         'chat.tasks.warm_cache': {'queue': 'maintenance'},
+        'chat.tasks.flush_conversation_counters': {'queue': 'maintenance'},
+        'chat.tasks.abort_stale_replies': {'queue': 'maintenance'},
         'chat.tasks.health_check': {'queue': 'monitoring'},
     },
     
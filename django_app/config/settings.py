@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -179,8 +179,14 @@ CHANNEL_LAYERS = {
 # External API settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'openai/gpt-4o-mini')
+OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
 TAVILY_API_KEY = os.getenv('TAVILY_API_KEY', '')
 
+# Message encryption keys (Fernet). New values are written with ENCRYPTION_KEY;
+# retired keys stay readable until rotate_message_keys re-encrypts their rows.
+ENCRYPTION_KEY = config('ENCRYPTION_KEY', default='')
+ENCRYPTION_RETIRED_KEYS = config('ENCRYPTION_RETIRED_KEYS', default='', cast=Csv())
+
 # Caching
 CACHES = {
     'default': {
@@ -331,6 +337,70 @@ CHAT_SETTINGS = {
         'application/pdf', 'text/plain', 'text/markdown',
         'application/json', 'text/csv'
     ],
+    # Bulk decryption of message pages: 'thread', 'process' (opt-in) or 'off'
+    'BULK_DECRYPT_POOL': config('BULK_DECRYPT_POOL', default='thread'),
+    'BULK_DECRYPT_WORKERS': config('BULK_DECRYPT_WORKERS', default=0, cast=int),  # 0 = one per CPU
+    'BULK_DECRYPT_MIN_BATCH': 64,  # smaller pages are decrypted inline
+    # Message bodies above the threshold are compressed before encryption: 'zlib', 'zstd' or 'off'
+    'CONTENT_COMPRESSION': config('CONTENT_COMPRESSION', default='zlib'),
+    'CONTENT_COMPRESSION_THRESHOLD': 1024,  # bytes
+    # Buffer conversation counters in Redis and flush them from Celery beat
+    'COUNTER_WRITE_BEHIND': config('COUNTER_WRITE_BEHIND', default=False, cast=bool),
+    'COUNTER_FLUSH_INTERVAL': 10,  # seconds
+    'COUNTER_FLUSH_BATCH': 500,
+    # Pooled keep-alive clients for the upstream LLM API, one per API key
+    'LLM_POOL_MAX_KEYS': 256,  # least recently used keys beyond this are closed
+    'LLM_POOL_IDLE_SECONDS': 300,
+    'LLM_MAX_CONNECTIONS': 500,  # per client, i.e. concurrent streams per key
+    'LLM_MAX_KEEPALIVE': 50,
+    'LLM_KEEPALIVE_EXPIRY': 60,  # seconds an idle connection stays open
+    'LLM_TIMEOUT': 120,
+    # Per-message Redis Stream of generated tokens, for resuming interrupted streams
+    'STREAM_LOG_ENABLED': True,
+    'STREAM_LOG_TTL': 300,  # seconds after the last token
+    'STREAM_LOG_MAXLEN': 20000,  # entries per message
+    'STREAM_LOG_IDLE_TIMEOUT': 60,  # stop following a generation that went quiet
+    # WebSocket connect authorization (chat.access): in-process LRU in front of Redis
+    'ACCESS_CACHE_LOCAL_TTL': 15,  # seconds another process may keep a revoked decision
+    'ACCESS_CACHE_TTL': 300,
+    'ACCESS_CACHE_MAX_ENTRIES': 10000,
+    # Typing indicators (chat.typing_indicators): one batched group event per window
+    'TYPING_DEBOUNCE_MS': 500,
+    'TYPING_TIMEOUT': 6,  # seconds after the last typing_start without a typing_stop
+    # WebSocket presence (chat.presence): one sorted-set member per open socket
+    'PRESENCE_TTL': 60,  # seconds a socket stays present without a heartbeat
+    'PRESENCE_HEARTBEAT': 20,
+    # Replies generated by Celery workers are pushed to the conversation's WebSocket group
+    'WS_STREAM_ENABLED': True,
+    'WS_STREAM_SEND_TIMEOUT': 2,  # seconds; a slower group send is dropped
+    # Streamed deltas are batched into one frame per window or size threshold
+    'STREAM_COALESCE_WINDOW_MS': 30,  # 0 sends every delta on its own
+    'STREAM_COALESCE_BYTES': 512,
+    # Replies are saved while they stream: one UPDATE per checkpoint, not per token
+    'CHECKPOINT_EVERY_TOKENS': 64,
+    'CHECKPOINT_EVERY_SECONDS': 2,
+    'STALE_REPLY_SECONDS': 600,  # streaming replies untouched this long are marked aborted
+    # Token counts (chat.tokenizer); models without a known encoding use the default
+    'TOKENIZER_DEFAULT_ENCODING': 'cl100k_base',
+    'TOKENIZER_CACHE_SIZE': 20000,  # counts cached by content hash
+    # Model context (chat.context); windows of unknown models, assembled history cache
+    'CONTEXT_DEFAULT_WINDOW': 8192,
+    'CONTEXT_CACHE_TTL': 3600,
+    # Exact-match completion cache (chat.completion_cache); sampled requests only when opted in
+    'COMPLETION_CACHE_ENABLED': config('COMPLETION_CACHE_ENABLED', default=False, cast=bool),
+    'COMPLETION_CACHE_TTL': 3600,
+    'COMPLETION_CACHE_MAX_ENTRIES': 10000,  # least recently used entries are evicted past this
+    # Single-flight: duplicates of a request in flight follow its reply (needs the stream log)
+    'SINGLE_FLIGHT_ENABLED': True,
+    'SINGLE_FLIGHT_LEASE_SECONDS': 30,  # renewed while generating; a dead leader's lease runs out
+    'SINGLE_FLIGHT_WINDOW_SECONDS': 10,  # finished requests still absorb duplicates this long
+    # Rolling summaries (chat.summaries): older turns are folded into one summary message
+    'SUMMARY_ENABLED': config('SUMMARY_ENABLED', default=False, cast=bool),
+    'SUMMARY_THRESHOLD_TOKENS': 3000,  # uncovered history that triggers a summary
+    'SUMMARY_KEEP_RECENT_TOKENS': 1000,  # newest turns always sent verbatim
+    'SUMMARY_BATCH_TOKENS': 6000,  # turns folded per completion call
+    'SUMMARY_MODEL': 'openai/gpt-4o-mini',
+    'SUMMARY_MAX_TOKENS': 500,
 }
 
 # AI Model Configuration
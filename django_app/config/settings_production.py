@@ -127,8 +127,13 @@ CSRF_COOKIE_SECURE = False  # Handled by reverse proxy
 
 # API Keys (will be provided by users)
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
+OPENROUTER_BASE_URL = os.environ.get('OPENROUTER_BASE_URL', 'https://openrouter.ai/api/v1')
 TAVILY_API_KEY = os.environ.get('TAVILY_API_KEY', '')
 
+# Message encryption keys (comma-separated retired keys stay readable)
+ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', '')
+ENCRYPTION_RETIRED_KEYS = [key for key in os.environ.get('ENCRYPTION_RETIRED_KEYS', '').split(',') if key]
+
 # Cache configuration
 CACHES = {
     'default': {